@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import weakref
+import threading
+import concurrent.futures
+
+from Context import Context
+
+class AsyncContext(object):
+    '''
+    AsyncContext - awaitable interface to a Context for asyncio applications.
+
+    Blocking work runs on a dedicated thread pool, so the event loop is never held
+    up, with at most concurrency operations in progress in each event loop, so it can
+    serve several loops in turn (e.g. successive asyncio.run()). Concurrent requests for the
+    same file share a single retrieval. The on-disk state is that of the wrapped
+    Context, so synchronous and asynchronous users of a StorageArea see the same files.
+    '''
+
+    def __init__(self, context: Context, concurrency: int = 8):
+        self.context = context
+        self.concurrency = concurrency
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        self.close()
+
+    async def getFile(self, filename: str, overwrite: bool = False) -> str:
+        '''
+        Awaitable Context.getFile(). Cancelling every caller waiting for a file
+        abandons its transfer, which a later call resumes
+        '''
+        flight = self._inflight.get(filename)
+        if flight is None or overwrite is True:
+            cancel = threading.Event()
+            task = asyncio.ensure_future(self._run(self.context.getFile, filename, overwrite, cancel))
+            flight = {'task': task, 'cancel': cancel, 'waiters': 0}
+            self._inflight[filename] = flight
+            task.add_done_callback(functools.partial(self._landed, filename, flight))
+
+        flight['waiters'] += 1
+        try:
+            return await asyncio.shield(flight['task'])
+        except asyncio.CancelledError:
+            if flight['waiters'] == 1 and not flight['task'].done():
+                # Nobody else wants the file, stop retrieving it
+                flight['cancel'].set()
+                flight['task'].cancel()
+            raise
+        finally:
+            flight['waiters'] -= 1
+
+    def _landed(self, filename: str, flight: dict, task):
+        '''
+        Forget a finished retrieval
+        '''
+        if self._inflight.get(filename) is flight:
+            del self._inflight[filename]
+        if not task.cancelled():
+            # Retrieve the exception so that asyncio does not report it as lost
+            task.exception()
+
+    async def refresh(self, progress=None, staleOnly: bool = False) -> dict:
+        '''
+        Awaitable Context.refresh(), retrieving up to concurrency files at a time.
+        progress is called as in Context.refresh()
+        '''
+        filenames = await self._run(self.context.refreshList, staleOnly)
+        report = {}
+        total = len(filenames)
+
+        async def refreshOne(filename):
+            cancel = threading.Event()
+            try:
+                result = await self._run(self.context.refreshFile, filename, 0, cancel)
+            except asyncio.CancelledError:
+                cancel.set()
+                raise
+            report[filename] = result
+            if progress is not None:
+                progress(filename, result, len(report), total)
+
+        await asyncio.gather(*[refreshOne(filename) for filename in filenames])
+        return report
+
+    async def load(self, location: str, merge: bool = False, incremental: bool = False) -> dict:
+        '''
+        Awaitable Context.load()
+        '''
+        return await self._run(self.context.load, location, merge, incremental)
+
+    async def _run(self, function, *args):
+        '''
+        Run a blocking Context method on the thread pool
+        '''
+        # A semaphore belongs to the loop it is first used in
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, functools.partial(function, *args))
+
+    def close(self):
+        '''
+        Shut down the thread pool once work in progress has finished
+        '''
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import pathlib
+
+class BlobStore(object):
+    '''
+    BlobStore - content-addressed store of file payloads shared by the contexts of
+    a StorageArea. Blobs are named by their SHA-256 and contexts reference them
+    through hard links, so the link count of a blob is its reference count and a
+    blob is removed when the last context file linked to it goes away.
+
+    Files linked to a blob share its data: they must be treated as read-only.
+    Where hard links are not possible (e.g. the area spans file systems) files
+    are simply not deduplicated.
+    '''
+
+    def __init__(self, path: pathlib.Path, logger):
+        self.path = path
+        self.logger = logger
+
+    def blobPath(self, sha256: str) -> pathlib.Path:
+        '''
+        Return the location of a blob
+        '''
+        return self.path / sha256[:2] / sha256
+
+    def has(self, sha256: str) -> bool:
+        return self.blobPath(sha256).is_file()
+
+    def link(self, sha256: str, target: str) -> bool:
+        '''
+        Make target a reference to an existing blob, replacing any file already
+        there. Returns False if there is no such blob
+        '''
+        blob = self.blobPath(sha256)
+        temp = target + ".link"
+        try:
+            if os.path.exists(temp):
+                os.remove(temp)
+            os.link(str(blob), temp)
+        except OSError:
+            return False
+        os.replace(temp, target)
+        self.logger.debug("B: Linked " + target + " to blob " + sha256)
+        return True
+
+    def adopt(self, source: str, sha256: str):
+        '''
+        Store a newly retrieved file as a blob. If the blob already exists, source
+        is replaced by a reference to it and its own copy of the data is released
+        '''
+        blob = self.blobPath(sha256)
+        try:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            os.link(source, str(blob))
+            self.logger.debug("B: Added blob " + sha256)
+            return
+        except FileExistsError:
+            pass
+        except OSError as err:
+            self.logger.info("B: Cannot deduplicate " + source + ", " + str(err))
+            return
+
+        if os.path.samefile(source, str(blob)):
+            return
+        self.link(sha256, source)
+
+    def release(self, sha256: str):
+        '''
+        Remove a blob once no context file refers to it any more
+        '''
+        if sha256 is None:
+            return
+        blob = self.blobPath(sha256)
+        try:
+            if blob.stat().st_nlink <= 1:
+                self.logger.debug("B: Releasing blob " + sha256)
+                blob.unlink()
+        except OSError:
+            pass
+
+    def references(self, sha256: str) -> int:
+        '''
+        Return the number of context files referring to a blob
+        '''
+        try:
+            return self.blobPath(sha256).stat().st_nlink - 1
+        except OSError:
+            return 0
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import base64
+
+class BlockMap(object):
+    '''
+    BlockMap - records which fixed-size blocks of a file are held in its sparse
+    block file. It is kept in the descriptor entry of the file as
+    {'blockSize', 'size', 'bitmap', ...validators}, the bitmap base64-encoded
+    with one bit per block.
+    '''
+
+    def __init__(self, blockSize: int, size: int = None, bitmap: bytes = b'', validators: dict = None):
+        self.blockSize = blockSize
+        self.size = size
+        self.bitmap = bytearray(bitmap)
+        self.validators = dict(validators or {})
+
+    @staticmethod
+    def fromEntry(blocks: dict):
+        validators = {key: blocks[key] for key in ('etag', 'lastModified') if key in blocks}
+        return BlockMap(blocks['blockSize'], blocks.get('size'), base64.b64decode(blocks.get('bitmap', '')),
+                        validators)
+
+    def toEntry(self) -> dict:
+        blocks = {'blockSize': self.blockSize, 'bitmap': base64.b64encode(bytes(self.bitmap)).decode('ascii')}
+        if self.size is not None:
+            blocks['size'] = self.size
+        blocks.update(self.validators)
+        return blocks
+
+    def count(self) -> int:
+        '''
+        Return the number of blocks in the file, or None while its size is unknown
+        '''
+        if self.size is None:
+            return None
+        return (self.size + self.blockSize - 1) // self.blockSize
+
+    def has(self, block: int) -> bool:
+        byte = block // 8
+        return byte < len(self.bitmap) and self.bitmap[byte] & (1 << (block % 8)) != 0
+
+    def add(self, first: int, last: int):
+        '''
+        Mark blocks first to last (inclusive) as held
+        '''
+        for block in range(first, last + 1):
+            byte = block // 8
+            if byte >= len(self.bitmap):
+                self.bitmap.extend(bytes(byte + 1 - len(self.bitmap)))
+            self.bitmap[byte] |= 1 << (block % 8)
+
+    def addAll(self):
+        self.bitmap = bytearray()
+        if self.count():
+            self.add(0, self.count() - 1)
+
+    def missing(self, first: int, last: int) -> list:
+        '''
+        Return the (first, last) runs of blocks between first and last which are not held
+        '''
+        runs = []
+        for block in range(first, last + 1):
+            if self.has(block):
+                continue
+            if runs and runs[-1][1] == block - 1:
+                runs[-1] = (runs[-1][0], block)
+            else:
+                runs.append((block, block))
+        return runs
+
+    def complete(self) -> bool:
+        '''
+        True when every block of the file is held
+        '''
+        count = self.count()
+        return count is not None and not self.missing(0, count - 1)
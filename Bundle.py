@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import tarfile
+
+# Layout of a bundle: <context>/desc.json, followed by <context>/files/<filename>
+# for every file held, for each context in turn
+DESCRIPTOR = "desc.json"
+FILES = "files"
+
+# Compressions a bundle can be written with
+COMPRESSIONS = (None, 'gz', 'bz2', 'xz')
+
+def openBundle(target, mode: str, compression: str = None):
+    '''
+    Open a bundle, a path or a binary file object, as a tar stream. Bundles are
+    written with the given compression and read with whichever they have
+    '''
+    if mode == 'w':
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown bundle compression ' + str(compression))
+        mode = 'w|' + (compression or '')
+    else:
+        mode = 'r|*'
+    if isinstance(target, str):
+        return tarfile.open(target, mode)
+    return tarfile.open(fileobj=target, mode=mode)
+
+def addMember(tar, name: str, handle, size: int, mtime: float = 0):
+    '''
+    Stream size bytes from handle into the bundle as name
+    '''
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    tar.addfile(info, handle)
+
+def addDescriptor(tar, prefix: str, desc: dict):
+    data = json.dumps(desc, indent=4).encode('utf-8')
+    addMember(tar, prefix + "/" + DESCRIPTOR, io.BytesIO(data), len(data))
+
+def readBundle(tar, resolve, skipExisting: bool = True) -> dict:
+    '''
+    Import the contexts of a bundle opened for reading. resolve(name) returns the
+    Context a bundled context is imported into, or None to pass over it.
+    Returns (context, filename) pairs of the files 'imported', 'skipped' because
+    they were already held, and 'failed'
+    '''
+    report = {'imported': [], 'skipped': [], 'failed': []}
+    contexts = {}
+    for member in tar:
+        prefix, sep, rest = member.name.partition('/')
+        if not member.isfile():
+            continue
+        if rest == DESCRIPTOR:
+            desc = json.load(tar.extractfile(member))
+            ctxt = resolve(desc['name'])
+            if ctxt is not None:
+                ctxt._importDescriptor(desc)
+                contexts[prefix] = (ctxt, desc)
+        elif rest.startswith(FILES + "/") and prefix in contexts:
+            ctxt, desc = contexts[prefix]
+            filename = rest[len(FILES) + 1:]
+            outcome = ctxt._importFile(filename, desc['files'].get(filename), tar.extractfile(member), skipExisting)
+            report[outcome].append((ctxt.name, filename))
+    return report
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import zlib
+import fnmatch
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is not available without the zstandard package
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    # lz4 compression is not available without the lz4 package
+    lz4 = None
+
+class Codec(object):
+    '''
+    Codec - a compression format for files at rest. Compressed copies are named
+    after the plain file with suffix appended
+    '''
+    name = None
+    suffix = None
+
+    def open(self, path: str):
+        '''
+        Return a binary file object reading the plain content of a compressed file
+        '''
+        raise NotImplementedError
+
+    def writer(self, path: str):
+        '''
+        Return a binary file object compressing what is written into path
+        '''
+        raise NotImplementedError
+
+    def compress(self, source: str, chunkSize: int = 1048576) -> str:
+        '''
+        Write a compressed copy of source next to it and return its path; source is kept
+        '''
+        target = source + self.suffix
+        temp = target + ".tmp"
+        with open(source, 'rb') as plain, self.writer(temp) as packed:
+            while True:
+                chunk = plain.read(chunkSize)
+                if not chunk:
+                    break
+                packed.write(chunk)
+        os.replace(temp, target)
+        return target
+
+    def decompress(self, source: str, target: str, chunkSize: int = 1048576):
+        '''
+        Write the plain content of the compressed file source into target
+        '''
+        temp = target + ".tmp"
+        with self.open(source) as packed, open(temp, 'wb') as plain:
+            while True:
+                chunk = packed.read(chunkSize)
+                if not chunk:
+                    break
+                plain.write(chunk)
+        os.replace(temp, target)
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    suffix = '.gz'
+
+    def open(self, path: str):
+        return gzip.open(path, 'rb')
+
+    def writer(self, path: str):
+        return gzip.open(path, 'wb', compresslevel=6)
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    suffix = '.zst'
+
+    def open(self, path: str):
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+    def writer(self, path: str):
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+
+class LZ4Codec(Codec):
+    name = 'lz4'
+    suffix = '.lz4'
+
+    def open(self, path: str):
+        return lz4.frame.open(path, 'rb')
+
+    def writer(self, path: str):
+        return lz4.frame.open(path, 'wb')
+
+# Codecs usable here, by name
+CODECS = {'gzip': GzipCodec()}
+if zstandard is not None:
+    CODECS['zstd'] = ZstdCodec()
+if lz4 is not None:
+    CODECS['lz4'] = LZ4Codec()
+
+def getCodec(name: str) -> Codec:
+    '''
+    Return the codec called name, or None if it is unknown or its package is not installed
+    '''
+    return CODECS.get(name)
+
+def match(rules: list, filename: str) -> str:
+    '''
+    Return the codec name of the first (pattern, codec) rule whose glob pattern
+    matches filename, or None
+    '''
+    for pattern, codec in rules or []:
+        if fnmatch.fnmatchcase(filename, pattern):
+            return codec
+    return None
+
+def transferDecoder(encoding: str):
+    '''
+    Return a decompressor for a Content-Encoding, None for an identity transfer.
+    Raises ValueError for encodings that were not asked for
+    '''
+    if encoding is None or encoding.strip().lower() in ('', 'identity'):
+        return None
+    if encoding.strip().lower() in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    raise ValueError('Unsupported Content-Encoding ' + encoding)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import io
+import ssl
+import time
+import socket
+import threading
+import http.client
+import urllib
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Statuses worth retrying after a pause
+RETRY_STATUSES = (429, 502, 503, 504)
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+class ConnectionPool(object):
+    '''
+    ConnectionPool - persistent HTTP(S) connections shared by all the contexts of a
+    StorageArea. Connections are kept alive per host and reused by later requests,
+    which saves a TCP/TLS handshake per file. Failed requests are retried with
+    exponential backoff.
+
+    URLs with other schemes (e.g. file://), or which go through a proxy, are
+    passed to urllib.
+    '''
+
+    def __init__(self, logger, poolSize: int = 4, timeout: float = 60.0, retries: int = 3,
+                 backoff: float = 0.5, maxRedirects: int = 10, metrics = None):
+        self.logger = logger
+        self.metrics = metrics
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxRedirects = maxRedirects
+        self.lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._context = None
+
+    def open(self, url: str, headers: dict = None):
+        '''
+        Issue a GET request for url and return the response, which must be closed
+        (or used in a with statement) to hand its connection back to the pool.
+
+        Raises urllib.error.HTTPError for error statuses and urllib.error.URLError
+        if the host cannot be reached
+        '''
+        headers = dict(headers or {})
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or self._proxied(parts):
+            return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+
+        for redirect in range(self.maxRedirects + 1):
+            response = self._request(url, headers)
+            if response.status not in REDIRECT_STATUSES:
+                break
+            location = response.headers.get('Location')
+            body = response.read()
+            response.close()
+            if location is None:
+                raise urllib.error.HTTPError(url, response.status, 'Redirect without Location', response.headers,
+                                             io.BytesIO(body))
+            url = urllib.parse.urljoin(url, location)
+            self.logger.debug("P: Redirected to " + url)
+            if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+        else:
+            raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers,
+                                         io.BytesIO(body))
+
+        if response.status >= 300:
+            body = response.read()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+
+    def _request(self, url: str, headers: dict):
+        '''
+        Send one request, retrying on connection failures and transient statuses
+        '''
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        selector = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        headers.setdefault('User-Agent', 'FileCache')
+
+        attempt = 0
+        while True:
+            slot = self._slot(key)
+            slot.acquire()
+            conn, reused = self._connection(key)
+            try:
+                conn.request('GET', selector, headers=headers)
+                response = PooledResponse(self, key, conn, conn.getresponse(), url)
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                slot.release()
+                if reused:
+                    # The server dropped an idle connection, that is not worth a retry
+                    self.logger.debug("P: Stale connection to " + str(key[1]) + ", reconnecting")
+                    continue
+                if attempt >= self.retries or isinstance(err, socket.gaierror):
+                    raise urllib.error.URLError(err)
+                self.logger.debug("P: Request for " + url + " failed, retrying: " + str(err))
+            else:
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                response.read()
+                response.close()
+                self.logger.debug("P: " + url + " returned " + str(response.status) + ", retrying")
+
+            if self.metrics is not None:
+                self.metrics.count('retries')
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def _slot(self, key: tuple):
+        '''
+        Return the semaphore bounding the number of connections to a host
+        '''
+        with self.lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.poolSize)
+            return self._slots[key]
+
+    def _connection(self, key: tuple):
+        '''
+        Return an idle connection to a host, or a new one, and whether it was reused
+        '''
+        with self.lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, host, port = key
+        self.logger.debug("P: Connecting to " + str(host))
+        if scheme == 'https':
+            if self._context is None:
+                self._context = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self._context), False
+        return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key: tuple, conn):
+        '''
+        Return a connection to the pool, or just its slot if conn is None
+        '''
+        if conn is not None:
+            with self.lock:
+                self._idle.setdefault(key, []).append(conn)
+        self._slot(key).release()
+
+    def close(self):
+        '''
+        Close all idle connections
+        '''
+        with self.lock:
+            for key, idle in self._idle.items():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def _proxied(self, parts) -> bool:
+        '''
+        Return True if requests to this URL should go through a proxy
+        '''
+        proxies = urllib.request.getproxies()
+        return parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname or '')
+
+class PooledResponse(object):
+    '''
+    Response on a pooled connection; closing it returns the connection to the pool
+    '''
+
+    def __init__(self, pool: ConnectionPool, key: tuple, conn, response, url: str):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def read(self, amt: int = None) -> bytes:
+        return self.response.read(amt)
+
+    def geturl(self) -> str:
+        return self.url
+
+    def close(self):
+        if self.conn is None:
+            return
+        # The connection can only be reused once the body has been consumed
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+            self.pool.release(self.key, None)
+        self.conn = None
@@ -3,11 +3,29 @@ import json
 import os
 import urllib
 import urllib.request
+import http.client
 import pathlib
 import copy
 import getpass
+import threading
+import time
+import contextlib
+import concurrent.futures
+import hashlib
+import tarfile
 
 import StorageArea
+from FileLock import FileLock
+from Fetcher import isIntact, discard, copyContent, hashFile, rangeValidator, heldSize
+from BlockMap import BlockMap
+from Prefetcher import Prefetcher, HINT
+from Codecs import getCodec, match
+from SourceSelector import rewrite
+from Throttle import BULK
+from Bundle import openBundle, addDescriptor, addMember, readBundle, FILES
+
+# Entry keys describing the local copy of a file, which are not carried by exported descriptors
+LOCAL_KEYS = ('path', 'mtime', 'atime', 'hits', 'gdsf', 'fetched', 'codec', 'stored', 'storedSize', 'blocks')
 
 class Context(object):
     '''
@@ -16,77 +34,947 @@ class Context(object):
     '''
 
     def __init__(self, name: str, path: pathlib.Path, store: StorageArea):
+        self.name = name
         self.path = path
         self.store = store
-        self.descriptor = {'name': name, 'author': getpass.getuser(), 'files': {}}
+        self._descriptor = {'name': name, 'author': getpass.getuser(), 'files': {}}
+        self._pending = False
+        self.lock = threading.RLock()
+        self.fileLock = FileLock(str(path / ".lock"))
+        self.journal = store.journalFor(name, path)
+        self._hostSlots = {}
+        self._entryLocks = {}
+        self._accesses = {}
+        self._held = None
+        self._blobs = {}
+        self._used = 0
+        self.prefetcher = None
+
+    @property
+    def descriptor(self) -> dict:
+        '''
+        The Context metadata, read from storage on first use if restore was deferred
+        '''
+        if self._pending:
+            with self.lock:
+                if self._pending:
+                    self._pending = False
+                    self.restore()
+        return self._descriptor
+
+    @property
+    def restored(self) -> bool:
+        '''
+        False while a deferred restore has not happened yet
+        '''
+        return not self._pending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Hold the Context against other threads and processes, with the descriptor
+        brought up to date with their changes, while it is being modified
+        '''
+        with self.lock:
+            with self.fileLock:
+                self.sync()
+                yield
 
-    def addFile(self, url: str, filename: str):
+    def sync(self):
+        '''
+        Pick up changes to the descriptor stored by other processes
+        '''
+        with self.lock:
+            if self.store.writable:
+                if self.journal.sync(self.descriptor):
+                    self._resetUsage()
+                self._reapplyAccesses()
+
+    @contextlib.contextmanager
+    def _entryLock(self, filename: str):
+        '''
+        Hold the lock of a file while it is being retrieved, so that concurrent
+        requests for it from other threads or processes wait for the first one.
+        The lock file is only there while the lock is held
+        '''
+        with self.lock:
+            if filename not in self._entryLocks:
+                self._entryLocks[filename] = FileLock(str(self.path / ("." + filename + ".lock")))
+            lock = self._entryLocks[filename]
+        lock.acquire()
+        try:
+            yield lock
+        finally:
+            lock.release(True)
+
+    def addFile(self, url, filename: str):
         """
         Add an item to the Context. It does not load it into storage.
 
+        url may be a list of URLs serving the same file, the first being its
+        primary source; the file is then retrieved from whichever is fastest.
+
         If the store area is not writable, this method will return without updating anything
         """
         if not self.store.writable:
             self.store.logger.error("C: Storage in not writable, aborting")
             return
 
-        self.descriptor['files'][filename] = {'url': url, 'loaded': False}
+        with self.transaction():
+            self.descriptor['files'][filename] = newEntry(url)
+
+            # Update stored desc
+            self.updateDescriptor(filename)
 
-         # Update stored desc
-        self.writeDescriptor()
+    def addFiles(self, files: list):
+        '''
+        Add several items to the Context, given as (url, filename) pairs, with a
+        single descriptor write. They are not loaded into storage. As in addFile(),
+        url may be a list of URLs.
 
-    def getFile(self, filename: str, overwrite: bool = False) -> str:
+        If the store area is not writable, this method will return without updating anything
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return
+
+        with self.transaction():
+            for url, filename in files:
+                self.descriptor['files'][filename] = newEntry(url)
+            self.writeDescriptor()
+
+    def getFile(self, filename: str, overwrite: bool = False, cancel = None) -> str:
         '''
         Return the filename of the file in the storage, retrieving data from a
         remote location and storing it in the local storage if necessary. If overwrite is true
         the file if retrieved irresepctively of whether it is in local storage.
 
-        If the store area is not writable, this method will return None
+        A file held for longer than its time-to-live (see setTTL()) is revalidated
+        with a conditional request and only transferred again if it has changed.
+
+        Setting the threading.Event cancel abandons a transfer in progress, raising
+        FetchCancelled; it can be resumed by a later call.
+
+        While data is being retrieved no queued prefetch is started (see prefetch()).
+
+        A file kept compressed (see setCompression()) is decompressed next to its
+        compressed copy; compact() removes such plain copies again.
+
+        If the StorageArea has tiers (see StorageArea), a file missing here is
+        copied from the first tier holding it before the remote location is tried,
+        and files retrieved are written through to the writable tiers.
+
+        If the store area is not writable, only files already held are returned;
+        this method will return None for others
+        '''
+        path = self._obtain(filename, overwrite, cancel)
+        if path is None:
+            return None
+        return self._materialise(filename, path)
+
+    def _obtain(self, filename: str, overwrite: bool = False, cancel = None) -> str:
+        '''
+        Make sure a file is in local storage, as getFile() does, without
+        decompressing it. Returns the path of its plain copy
         '''
         self.store.logger.debug("C: Get file " + filename + " from storage")
 
+        if not self.store.writable:
+            # Files already held can still be used
+            entry = self.peekFile(filename)
+            if entry is None:
+                self.store.logger.error("C: Storage in not writable and file is not held, aborting")
+                return None
+            return entry['path']
+
+        # Look for a usable copy before waiting for anybody else
+        with self.lock:
+            found, path, current = self._lookup(filename, overwrite)
+        if path is not None:
+            self._record(filename)
+            self.store.metrics.count('hits', self.name)
+        if found is False or path is not None:
+            return path
+
+        # Only one thread or process retrieves a file at a time; the others wait
+        # and then reuse the result
+        with self._foreground(), self._entryLock(filename):
+            self._record(filename)
+            with self.transaction():
+                found, path, current = self._lookup(filename, overwrite)
+                if path is not None:
+                    # Somebody else retrieved it meanwhile
+                    self.store.metrics.count('hits', self.name)
+                if found is False or path is not None:
+                    return path
+                self.store.metrics.count('misses', self.name)
+                entry = self.descriptor['files'][filename]
+                url = entry['url']
+                sources = self._sources(entry)
+                known = entry.get('sha256')
+                size = entry.get('size')
+                previous = known if 'path' in entry else None
+                rules = self.descriptor.get('compression')
+
+            # Retrieve the file and update records
+            # Determine filename for output file
+            outfile = str(self.path / filename)
+            blobs = self.store.blobs
+
+            linked = False
+            meta = None
+            if blobs is not None and known is not None and current is None and overwrite is False \
+                    and blobs.link(known, outfile):
+                # The content is already in the area, no need to retrieve it
+                self.store.logger.info("C: Linking file " + str(outfile) + " to stored content")
+                info = os.stat(outfile)
+                meta = {'size': info.st_size, 'sha256': known, 'mtime': info.st_mtime}
+                linked = True
+            elif current is None and overwrite is False:
+                # A lower tier may hold it already
+                meta = self.store.fillFromTiers(self, filename, url, outfile)
+
+            if meta is None:
+                # Retrieve data into file
+                self.store.logger.info("C: Creating file " + str(outfile) + " from " + url)
+                try:
+                    with self.store.metrics.span('download', self.name, url=url, filename=filename), \
+                            self.store.throttle.scope(self.name):
+                        meta = self.store.fetcher.fetchFrom(sources, outfile, current, cancel, size,
+                                                            self.name, bool(rules))
+                except (OSError, http.client.HTTPException) as err:
+                    self.store.logger.error("C: Failed to retrieve file, " + str(err))
+                    self.store.metrics.count('failures', self.name)
+                    return None
+                if meta.get('notModified') is True:
+                    self.store.metrics.count('notModified', self.name)
+                else:
+                    self.store.metrics.count('downloads', self.name)
+                    self.store.metrics.count('bytes', self.name, meta.pop('transferred'))
+
+            if not linked:
+                if blobs is not None and 'sha256' in meta:
+                    blobs.adopt(outfile, meta['sha256'])
+                    meta['mtime'] = os.stat(outfile).st_mtime
+                    if previous is not None and previous != meta['sha256']:
+                        blobs.release(previous)
+
+                # Deduplicated files are shared as they are, so only keep others compressed
+                codec = getCodec(match(rules, filename)) if blobs is None else None
+                if codec is not None and meta.get('notModified') is not True:
+                    self.store.logger.debug("C: Compressing " + outfile + " with " + codec.name)
+                    stored = codec.compress(outfile, self.store.fetcher.chunkSize)
+                    # getFile() decompresses it again when it needs the plain copy
+                    discard(outfile)
+                    info = os.stat(stored)
+                    meta.update({'codec': codec.name, 'stored': stored, 'storedSize': info.st_size,
+                                 'mtime': info.st_mtime})
+
+            with self.transaction():
+                entry = self.descriptor['files'].get(filename)
+                if entry is None:
+                    self.store.logger.error("C: File was deleted from context while being retrieved")
+                    discard(outfile)
+                    return None
+
+                retrieved = meta.pop('notModified', False) is False
+                fetched = meta.pop('fetched', None) or time.time()
+                if retrieved:
+                    self.store.maps.release(outfile)
+                    self.store.memory.invalidate(outfile)
+                    replaced = entry.get('stored')
+                    for key in ('codec', 'stored', 'storedSize'):
+                        entry.pop(key, None)
+                    entry.update(meta)
+                    if replaced is not None and replaced != entry.get('stored'):
+                        discard(replaced)
+                    entry['path'] = outfile
+                    entry['loaded'] = True
+                    if entry.pop('blocks', None) is not None:
+                        discard(outfile + ".blocks")
+                entry['fetched'] = fetched
+
+                # Update stored manifest
+                self._touch(filename)
+                path = entry['path']
+
+        if retrieved and not linked:
+            self.store.writeThrough(self, filename)
+
+        # Make room for the new file if the area or the context is over its limits
+        self.store.enforceCapacity(self, filename)
+
+        # Return file
+        return path
+
+    def getRange(self, filename: str, offset: int, length: int) -> bytes:
+        '''
+        Return length bytes of a file starting at offset (fewer at the end of the
+        file). A file held in local storage is read directly; otherwise only the
+        blocks covering the range are retrieved, with HTTP Range requests, and kept
+        in a sparse block file. Once every block is held the file is assembled and
+        treated as retrieved by getFile().
+
+        If the store area is not writable or the range cannot be retrieved, this
+        method will return None
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return None
+
+        with self.lock:
+            entry = self.descriptor['files'].get(filename)
+            if entry is None:
+                self.store.logger.error("C: File is not known in context, aborting")
+                return None
+            held = entry['loaded'] is True and isIntact(entry)
+
+        if held:
+            handle = self.openFile(filename)
+            if handle is None:
+                return None
+            with handle:
+                handle.seek(offset)
+                return handle.read(length)
+
+        blockFile = str(self.path / (filename + ".blocks"))
+        with self._entryLock(filename):
+            with self.transaction():
+                entry = self.descriptor['files'].get(filename)
+                if entry is None:
+                    self.store.logger.error("C: File was deleted from context, aborting")
+                    return None
+                sources = self._sources(entry)
+                blocks = entry.get('blocks')
+            if blocks is None or not os.path.isfile(blockFile):
+                blocks = BlockMap(self.store.blockSize)
+                discard(blockFile)
+            else:
+                blocks = BlockMap.fromEntry(blocks)
+
+            if blocks.size is not None:
+                length = max(0, min(length, blocks.size - offset))
+            if length <= 0:
+                return b''
+
+            size = blocks.blockSize
+            for first, last in blocks.missing(offset // size, (offset + length - 1) // size):
+                self.store.logger.debug("C: Retrieving blocks " + str(first) + "-" + str(last) + " of " + filename)
+                try:
+                    with self.store.throttle.scope(self.name):
+                        meta = self.store.fetcher.fetchRangeFrom(sources, first * size, (last + 1) * size - 1,
+                                                                 blockFile, rangeValidator(blocks.validators))
+                except urllib.error.HTTPError as err:
+                    if err.code == 416:
+                        # The range starts past the end of the file
+                        break
+                    self.store.logger.error("C: Failed to retrieve range, " + str(err))
+                    return None
+                except (OSError, http.client.HTTPException) as err:
+                    self.store.logger.error("C: Failed to retrieve range, " + str(err))
+                    return None
+                self.store.metrics.count('rangeRequests', self.name)
+                self.store.metrics.count('bytes', self.name, meta['transferred'])
+
+                blocks.validators = {key: meta[key] for key in ('etag', 'lastModified') if key in meta}
+                blocks.size = meta['total']
+                if meta['full']:
+                    # The server sent everything, possibly a new version
+                    blocks.addAll()
+                    break
+                if meta['end'] >= meta['start']:
+                    blocks.add(meta['start'] // size, meta['end'] // size)
+
+            if not os.path.isfile(blockFile):
+                # Nothing was retrieved, the range starts past the end of the file
+                return b''
+            if blocks.size is not None and offset >= blocks.size:
+                data = b''
+            else:
+                with open(blockFile, 'rb') as handle:
+                    handle.seek(offset)
+                    data = handle.read(length if blocks.size is None else min(length, blocks.size - offset))
+                    handle.close()
+
+            with self.transaction():
+                entry = self.descriptor['files'].get(filename)
+                if entry is None:
+                    self.store.logger.error("C: File was deleted from context while being retrieved")
+                    discard(blockFile)
+                    return None
+                if blocks.complete():
+                    self._assemble(filename, blockFile, blocks)
+                else:
+                    entry['blocks'] = blocks.toEntry()
+                    self.updateDescriptor(filename)
+
+        if blocks.complete():
+            self.store.enforceCapacity(self, filename)
+        return data
+
+    def _assemble(self, filename: str, blockFile: str, blocks: BlockMap):
+        '''
+        Make a complete block file the local copy of a file
+        '''
+        self.store.logger.debug("C: Assembling " + filename + " from blocks")
+        outfile = str(self.path / filename)
+        entry = self.descriptor['files'][filename]
+        sha256 = hashFile(blockFile, self.store.fetcher.chunkSize)
+        self.store.maps.release(outfile)
+        self.store.memory.invalidate(outfile)
+        if 'path' in entry:
+            self._removeCopies(entry)
+        os.replace(blockFile, outfile)
+        if self.store.blobs is not None:
+            self.store.blobs.adopt(outfile, sha256)
+        for key in LOCAL_KEYS + ('etag', 'lastModified'):
+            entry.pop(key, None)
+        entry.update(blocks.validators)
+        entry.update({'size': blocks.size, 'sha256': sha256, 'mtime': os.stat(outfile).st_mtime,
+                      'path': outfile, 'loaded': True, 'fetched': time.time()})
+        self._touch(filename)
+
+    def peekFile(self, filename: str) -> dict:
+        '''
+        Return a copy of the entry of a file held intact in local storage, or None,
+        without retrieving anything or recording an access. Changes stored by other
+        processes are picked up first
+        '''
+        with self.lock:
+            self.journal.sync(self.descriptor)
+            entry = self.descriptor['files'].get(filename)
+            if entry is None or entry.get('loaded') is not True or not isIntact(entry):
+                return None
+            return copy.deepcopy(entry)
+
+    def copyFrom(self, other, filename: str) -> str:
+        '''
+        Store a copy of a file held by another Context, e.g. the same context in
+        another tier, without retrieving it. The entry keeps the URL, hash and
+        validators of the original. Returns the path of the copy, or None if other
+        does not hold the file
+
+        If the store area is not writable, this method will return None
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return None
+
+        source = other.peekFile(filename)
+        if source is None:
+            return None
+
+        self.store.logger.debug("C: Copying " + filename + " from " + str(other.path))
+        return self._install(filename, source, lambda outfile: copyContent(source, outfile))
+
+    def _install(self, filename: str, source: dict, fill) -> str:
+        '''
+        Store the content fill(outfile) writes as a file held with the URL, hash
+        and validators of the entry source. Returns the path of the file, or None
+        if fill raised OSError
+        '''
+        outfile = str(self.path / filename)
+        with self._entryLock(filename):
+            with self.transaction():
+                entry = self.descriptor['files'].get(filename, {})
+                replaced = entry.get('stored') if 'path' in entry else None
+                previous = entry.get('sha256') if 'path' in entry else None
+            try:
+                fill(outfile)
+            except OSError as err:
+                self.store.logger.error("C: Failed to copy file, " + str(err))
+                return None
+
+            blobs = self.store.blobs
+            if blobs is not None and 'sha256' in source:
+                blobs.adopt(outfile, source['sha256'])
+                if previous is not None and previous != source['sha256']:
+                    blobs.release(previous)
+
+            with self.transaction():
+                self.store.maps.release(outfile)
+                self.store.memory.invalidate(outfile)
+                if replaced is not None:
+                    discard(replaced)
+                info = os.stat(outfile)
+                entry = {key: value for key, value in self.descriptor['files'].get(filename, {}).items()
+                         if key == 'ttl'}
+                entry.update({key: source[key] for key in ('url', 'urls', 'sha256', 'etag', 'lastModified', 'fetched')
+                              if key in source})
+                entry.update({'size': info.st_size, 'mtime': info.st_mtime, 'path': outfile, 'loaded': True})
+                self.descriptor['files'][filename] = entry
+                self._touch(filename)
+
+        self.store.enforceCapacity(self, filename)
+        return outfile
+
+    def _record(self, filename: str):
+        '''
+        Let the prefetcher learn from a request made by the application
+        '''
+        if self.prefetcher is not None and not self.prefetcher.isBackground():
+            self.prefetcher.record(filename)
+
+    def _foreground(self):
+        '''
+        Return the context manager holding back prefetches during a retrieval
+        '''
+        if self.prefetcher is None:
+            return contextlib.nullcontext()
+        return self.prefetcher.foreground()
+
+    def setPrefetch(self, workers: int = 2, readAhead: int = 0, bandwidth: float = None, diskBudget: int = None):
+        '''
+        Configure background prefetching: up to workers files are retrieved at a
+        time. If readAhead is above 0, each getFile() call queues up to readAhead
+        files predicted to be requested next, from the order of earlier requests
+        and from the manifest order when files are read in sequence.
+
+        bandwidth limits the average rate of prefetching in bytes per second, and
+        diskBudget the bytes held by prefetched files which have not been read yet.
+        '''
+        previous, self.prefetcher = self.prefetcher, Prefetcher(self, workers, readAhead, bandwidth, diskBudget)
+        if previous is not None:
+            previous.stop()
+
+    def prefetch(self, filenames: list, priority: int = HINT):
+        '''
+        Queue files to be retrieved in the background, lower priority values first.
+        Predicted files are queued with priority 10 (READAHEAD)
+
+        If the store area is not writable, this method will return without queuing anything
+        '''
         if not self.store.writable:
             self.store.logger.error("C: Storage in not writable, aborting")
+            return
+
+        with self.lock:
+            if self.prefetcher is None:
+                self.prefetcher = Prefetcher(self)
+        self.prefetcher.prefetch(filenames, priority)
+
+    def _materialise(self, filename: str, path: str) -> str:
+        '''
+        Make sure the plain copy of a file kept compressed is present, returning its path
+        '''
+        with self.lock:
+            entry = self.descriptor['files'].get(filename)
+            if entry is None or 'stored' not in entry:
+                return path
+            stored, size, codec = entry['stored'], entry.get('size'), getCodec(entry['codec'])
+
+        with self._entryLock(filename):
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                return path
+            if codec is None:
+                self.store.logger.error("C: Codec " + entry['codec'] + " is not available, cannot decompress " + stored)
+                return None
+            self.store.logger.debug("C: Decompressing " + stored)
+            try:
+                codec.decompress(stored, path, self.store.fetcher.chunkSize)
+            except (OSError, EOFError) as err:
+                self.store.logger.error("C: Failed to decompress " + stored + ", " + str(err))
+                return None
+
+        # The plain copy takes room of its own
+        self._recount(filename)
+        self.store.enforceCapacity(self, filename)
+        return path
+
+    def openFile(self, filename: str):
+        '''
+        Return a binary file object reading the content of a file, retrieving it
+        as getFile() does. A file kept compressed is decompressed as it is read,
+        without a plain copy being written. The caller must close it
+
+        If the file cannot be retrieved, this method will return None
+        '''
+        path = self._obtain(filename)
+        if path is None:
             return None
+        with self.lock:
+            entry = self.descriptor['files'].get(filename, {})
+            stored, codec = entry.get('stored'), getCodec(entry.get('codec'))
+        if stored is None:
+            return open(path, 'rb')
+        if codec is None:
+            self.store.logger.error("C: Codec " + entry['codec'] + " is not available, cannot read " + stored)
+            return None
+        return codec.open(stored)
+
+    def setCompression(self, rules: list):
+        '''
+        Keep files compressed in local storage. rules is a list of (pattern, codec)
+        pairs: a file retrieved from now on is compressed with the codec of the first
+        glob pattern matching its name ('gzip', and 'zstd' or 'lz4' if the zstandard
+        or lz4 package is installed). None or an empty list turns compression off.
+        Has no effect if the StorageArea deduplicates files
+
+        Servers are only asked for gzip-encoded transfers, which are decoded as they
+        are received, in contexts with compression rules; files that are themselves
+        gzip (a .gz name or a gzip content type) are always stored as sent
+
+        If the store area is not writable, this method will return without updating anything
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return
+
+        rules = [[pattern, codec] for pattern, codec in rules or []]
+        for pattern, codec in rules:
+            if getCodec(codec) is None:
+                self.store.logger.error("C: Codec " + str(codec) + " is not available, aborting")
+                return
+
+        with self.transaction():
+            if rules:
+                self.descriptor['compression'] = rules
+            else:
+                self.descriptor.pop('compression', None)
+            self.writeDescriptor()
+
+    def setMirrors(self, mirrors: dict):
+        '''
+        Declare mirrors of the remote locations of this Context: mirrors maps a
+        base URL to a list of base URLs serving the same files, e.g.
+        {'https://archive.org/data/': ['https://mirror.net/archive/']}. Every file
+        whose URL starts with a base may then also be retrieved from its mirrors.
+        None or {} removes them
+
+        If the store area is not writable, this method will return without updating anything
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return
+
+        with self.transaction():
+            if mirrors:
+                self.descriptor['mirrors'] = {base: list(alternatives) for base, alternatives in mirrors.items()}
+            else:
+                self.descriptor.pop('mirrors', None)
+            self.writeDescriptor()
+
+    def _sources(self, entry: dict) -> list:
+        '''
+        Return every URL a file can be retrieved from, its primary source first
+        '''
+        sources = []
+        for url in entry.get('urls', [entry['url']]):
+            for candidate in rewrite(url, self.descriptor.get('mirrors')):
+                if candidate not in sources:
+                    sources.append(candidate)
+        return sources
 
+    def compact(self) -> int:
+        '''
+        Remove the plain copies of files kept compressed, which getFile() made.
+        Returns the number of bytes freed
+        '''
+        freed = 0
+        with self.transaction():
+            for filename, entry in self.descriptor['files'].items():
+                if 'stored' in entry and os.path.isfile(entry['path']):
+                    self.store.maps.release(entry['path'])
+                    freed += os.path.getsize(entry['path'])
+                    os.remove(entry['path'])
+                    self._recount(filename)
+        return freed
+
+    def _lookup(self, filename: str, overwrite: bool) -> tuple:
+        '''
+        Check the state of a file for getFile(). Returns whether the file is known,
+        the path of a usable local copy (or None) and the validators to revalidate
+        a stale copy with (or None)
+        '''
         # If filename does not exist, abort
         if not filename in self.descriptor['files']:
             self.store.logger.error("C: File is not known in context, aborting")
-            return None
+            return False, None, None
 
         entry = self.descriptor['files'][filename]
         if 'path' in entry:
             path = entry['path']
             # If we are not in overwrite mode and the file already exists in the cache, return file
             if overwrite is False and entry['loaded'] is True:
-                self.store.logger.debug("C: Found existing file " + path)
-                return path
+                if not isIntact(entry):
+                    self.store.logger.info("C: Existing file " + path + " is missing or damaged, retrieving again")
+                elif self.isFresh(filename):
+                    self.store.logger.debug("C: Found existing file " + path)
+                    self._accessed(filename)
+                    return True, path, None
+                else:
+                    self.store.logger.debug("C: Existing file " + path + " is stale, revalidating")
+                    current = {key: entry[key] for key in ('etag', 'lastModified') if key in entry}
+                    return True, None, current or None
 
         # Either the file is not loaded, or we insist on retrieving it
+        return True, None, None
 
-        # Get URL for filename
-        url = entry['url']
+    def mapFile(self, filename: str, overwrite: bool = False) -> memoryview:
+        '''
+        Return a read-only memoryview of a file, retrieving it as getFile() does.
+        The underlying memory map is shared with other callers and released when
+        the file is evicted, deleted or replaced
 
-        # Retrieve the file and update records
-        # Determine filename for output file
-        outfile = str(self.path / filename)
+        If the file cannot be retrieved, this method will return None
+        '''
+        path = self.getFile(filename, overwrite)
+        if path is None:
+            return None
+        return self.store.maps.map(path)
 
-        # Retrieve data into file
-        self.store.logger.info("C: Creating file " + str(outfile) + " from " + url)
-        try:
-            urllib.request.urlretrieve(url, outfile)
-        except urllib.error.HTTPError as err:
-            self.store.logger.error("C: Failed to retrieve file, " + str(err))
+    def arrayFile(self, filename: str, dtype, offset: int = 0, count: int = -1, shape: tuple = None):
+        '''
+        Return a read-only NumPy array of dtype over a file, starting offset bytes in,
+        retrieving it as getFile() does. count items are included, all by default,
+        optionally reshaped to shape
+
+        If the file cannot be retrieved or NumPy is not installed, this method will return None
+        '''
+        path = self.getFile(filename)
+        if path is None:
             return None
+        return self.store.maps.array(path, dtype, offset, count, shape)
 
-        entry['path'] = outfile
-        entry['loaded'] = True
+    def getBytes(self, filename: str) -> bytes:
+        '''
+        Return the content of a file, retrieving it as getFile() does. Files no
+        larger than the memory item size of the StorageArea are kept in its memory
+        cache, if it has one, and later calls return them from there without
+        touching the disk; memory hits and misses are counted separately from
+        those of the disk
 
-        # Update stored manifest
-        self.writeDescriptor()
+        If the file cannot be retrieved, this method will return None
+        '''
+        memory = self.store.memory
+        if memory.enabled():
+            with self.lock:
+                entry = self.descriptor['files'].get(filename)
+                if entry is not None and entry['loaded'] is True and self.isFresh(filename):
+                    data = memory.get(entry['path'], entry.get('mtime'))
+                    if data is not None:
+                        self.store.metrics.count('memoryHits', self.name)
+                        return data
+            self.store.metrics.count('memoryMisses', self.name)
 
-        # Return file
-        return entry['path']
+        handle = self.openFile(filename)
+        if handle is None:
+            return None
+        with self.lock:
+            version = self.descriptor['files'].get(filename, {}).get('mtime')
+        with handle:
+            data = handle.read()
+        if memory.enabled():
+            with self.lock:
+                # Only keep what was read if the file was not replaced meanwhile
+                entry = self.descriptor['files'].get(filename)
+                if entry is not None and entry['loaded'] is True and entry.get('mtime') == version:
+                    memory.put(entry['path'], data, version)
+        return data
+
+    def isFresh(self, filename: str) -> bool:
+        '''
+        Return True if a file was retrieved or revalidated within its time-to-live
+        '''
+        with self.lock:
+            entry = self.descriptor['files'][filename]
+            ttl = entry.get('ttl', self.descriptor.get('ttl'))
+            if ttl is None:
+                return True
+            return time.time() - entry.get('fetched', 0.0) < ttl
+
+    def setTTL(self, ttl: float, filename: str = None):
+        '''
+        Set the time-to-live, in seconds, after which files are revalidated with the
+        remote location. Applies to the whole Context unless a filename is given;
+        None means files never go stale
+
+        If the store area is not writable, this method will return without updating anything
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return
+
+        with self.transaction():
+            if filename is None:
+                self.descriptor['ttl'] = ttl
+                self.writeDescriptor()
+                return
+
+            if not filename in self.descriptor['files']:
+                self.store.logger.error("C: File is not known in context, aborting")
+                return
+            entry = self.descriptor['files'][filename]
+            if ttl is None:
+                entry.pop('ttl', None)
+            else:
+                entry['ttl'] = ttl
+            self.updateDescriptor(filename)
+
+    def _touch(self, filename: str):
+        '''
+        Record an access to a file for the benefit of the eviction policy
+        '''
+        with self.transaction():
+            entry = self.descriptor['files'][filename]
+            entry['atime'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            self.store.policy.accessed(entry)
+            self.updateDescriptor(filename)
+
+    def _accessed(self, filename: str):
+        '''
+        Record a read of a file already held, in memory only: these statistics are
+        stored at the next checkpoint, flush() or close()
+        '''
+        with self.lock:
+            entry = self.descriptor['files'][filename]
+            now = time.time()
+            self._applyAccess(entry, now, 1)
+            pending = self._accesses.get(filename)
+            self._accesses[filename] = (now, 1 if pending is None else pending[1] + 1, entry)
+
+    def _applyAccess(self, entry: dict, atime: float, hits: int):
+        entry['atime'] = max(entry.get('atime', 0.0), atime)
+        entry['hits'] = entry.get('hits', 0) + hits
+        self.store.policy.accessed(entry)
+
+    def _reapplyAccesses(self):
+        '''
+        Carry the access statistics not stored yet over to the entries which
+        changes of other processes have replaced
+        '''
+        files = self.descriptor['files']
+        for filename, (atime, hits, entry) in list(self._accesses.items()):
+            current = files.get(filename)
+            if current is None or current.get('loaded') is not True:
+                del self._accesses[filename]
+            elif current is not entry:
+                self._applyAccess(current, atime, hits)
+                self._accesses[filename] = (atime, hits, current)
+
+    def evictFile(self, filename: str) -> int:
+        '''
+        Remove a file from local storage while keeping it in the Context, so that
+        a later getFile() retrieves it again. Returns the number of bytes freed.
+
+        If the store area is not writable, this method will return 0 without evicting the file
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return 0
+
+        with self.transaction():
+            entry = self.descriptor['files'].get(filename)
+            if entry is None or entry['loaded'] is not True:
+                return 0
+
+            self.store.logger.debug("C: Evicting " + filename + " from context " + self.descriptor['name'])
+            self.store.policy.evicted(entry)
+            self.store.metrics.count('evictions', self.name)
+            freed = heldSize(entry)
+            if self.store.blobs is not None and self.store.blobs.references(entry.get('sha256', '')) > 1:
+                # Other files still share the content
+                freed = 0
+            self._unload(filename)
+            return freed
+
+    def invalidate(self, filename: str, mtime: float = None) -> bool:
+        '''
+        Mark a file whose local copy is missing or damaged as not held, removing
+        what is left of it, so that a later getFile() retrieves it again. If mtime
+        is given, this is only done while the entry still records that mtime.
+        Returns True if the entry was changed
+
+        If the store area is not writable, this method will return False
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return False
+
+        with self.transaction():
+            entry = self.descriptor['files'].get(filename)
+            if entry is None or entry['loaded'] is not True:
+                return False
+            if mtime is not None and entry.get('mtime') != mtime:
+                return False
+
+            self.store.logger.info("C: Invalidating " + filename + " in context " + self.descriptor['name'])
+            self._unload(filename)
+            return True
+
+    def recoverFile(self, filename: str) -> bool:
+        '''
+        Mark a file not recorded as held as held again, when the copy of it found
+        in the Context directory has its recorded size and hash. Returns True if
+        the file was recovered
+
+        If the store area is not writable, this method will return False
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return False
+
+        outfile = str(self.path / filename)
+        with self._entryLock(filename), self.transaction():
+            entry = self.descriptor['files'].get(filename)
+            if entry is None or entry['loaded'] is True or 'sha256' not in entry or not os.path.isfile(outfile):
+                return False
+            if os.path.getsize(outfile) != entry.get('size') or \
+                    hashFile(outfile, self.store.fetcher.chunkSize) != entry['sha256']:
+                return False
+
+            self.store.logger.info("C: Recovered " + filename + " in context " + self.descriptor['name'])
+            if self.store.blobs is not None:
+                self.store.blobs.adopt(outfile, entry['sha256'])
+            entry.update({'path': outfile, 'mtime': os.stat(outfile).st_mtime, 'loaded': True})
+            self.updateDescriptor(filename)
+            return True
+
+    def _unload(self, filename: str):
+        '''
+        Remove the local copies of a file and record that it is not held
+        '''
+        entry = self.descriptor['files'][filename]
+        if 'path' in entry:
+            self._removeCopies(entry)
+        if 'blocks' in entry:
+            discard(str(self.path / (filename + ".blocks")))
+        entry['loaded'] = False
+        for key in LOCAL_KEYS:
+            entry.pop(key, None)
+        self.updateDescriptor(filename)
+
+    def setQuota(self, capacity: int = None, maxFiles: int = None):
+        '''
+        Limit the bytes and/or number of files this Context keeps in local storage.
+        None removes the corresponding limit
+
+        If the store area is not writable, this method will return without updating anything
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return
+
+        with self.transaction():
+            self.descriptor['quota'] = {'capacity': capacity, 'maxFiles': maxFiles}
+            self.writeDescriptor()
+
+        self.store.enforceCapacity(self, None)
+
+    def setRate(self, rate: float):
+        '''
+        Limit the bytes per second this Context receives, within any limit of the
+        StorageArea. None removes the limit. The limit lasts while the StorageArea
+        is open
+        '''
+        self.store.throttle.setRate(rate, self.name)
 
     def deleteFile(self, filename: str):
         '''
@@ -100,38 +988,149 @@ class Context(object):
             self.store.logger.error("C: Storage in not writable, aborting")
             return
 
-                # If filename does not exist, abort
-        if not filename in self.descriptor['files']:
-            self.store.logger.error("C: File is not known in context, aborting")
+        with self.transaction():
+            # If filename does not exist, abort
+            if not filename in self.descriptor['files']:
+                self.store.logger.error("C: File is not known in context, aborting")
+                return
+
+            self._forget(filename)
+
+            # Write descriptor
+            self.updateDescriptor(filename)
+
+    def deleteFiles(self, filenames: list):
+        '''
+        Delete several items from the Context with a single descriptor write.
+        Unknown files are ignored
+
+        If the store area is not writable, this method will return without deleting the files
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
             return
 
-        if 'path' in self.descriptor['files'][filename]:
-            path = self.descriptor['files'][filename]['path']
-            self.store.logger.debug("C: Deleting file " + path)
-            if os.path.isfile(path):
-                os.remove(path)
+        with self.transaction():
+            for filename in filenames:
+                if filename in self.descriptor['files']:
+                    self._forget(filename)
+            self.writeDescriptor()
+
+    def _forget(self, filename: str):
+        '''
+        Remove a file and everything held locally for it from the descriptor,
+        without storing the change
+        '''
+        entry = self.descriptor['files'][filename]
+        if 'path' in entry:
+            self.store.logger.debug("C: Deleting file " + entry['path'])
+            self._removeCopies(entry)
+        self._discardPartial(filename)
 
         # Update dictionary
         del self.descriptor['files'][filename]
+        self._entryLocks.pop(filename, None)
 
-        # Write descriptor
-        self.writeDescriptor()
-
-    def refresh(self):
+    def refresh(self, workers: int = 1, hostLimit: int = 0, progress=None, staleOnly: bool = False) -> dict:
         '''
-        Retrieves retrieves any items in the Cache which are not in the storage
+        Retrieves any items in the Cache which are not in the storage, and revalidates
+        those which are stale. If staleOnly is True, only stale items are revalidated
+        and items not in the storage are left alone.
 
-        If the store area is not writable, this method will return without updating anything
+        Up to workers files are retrieved concurrently, with no more than hostLimit
+        simultaneous transfers from any one host (0 means no limit). If progress is
+        given it is called as progress(filename, result, done, total) each time a
+        file completes.
+
+        Returns a report mapping each filename to a dict with its 'status'
+        ('cached', 'retrieved' or 'failed'), 'path' and 'elapsed' time in seconds.
+
+        If the store area is not writable, this method will return None without updating anything
         '''
         self.store.logger.debug("C: Refreshing context " + self.descriptor['name'])
 
         if not self.store.writable:
             self.store.logger.error("C: Storage in not writable, aborting")
-            return
+            return None
+
+        filenames = self.refreshList(staleOnly)
+        report = {}
+        total = len(filenames)
+
+        if workers <= 1:
+            for filename in filenames:
+                # getFile() takes care of the descriptor
+                report[filename] = self.refreshFile(filename, hostLimit)
+                if progress is not None:
+                    progress(filename, report[filename], len(report), total)
+            return report
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.refreshFile, filename, hostLimit): filename for filename in filenames}
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures[future]
+                report[filename] = future.result()
+                if progress is not None:
+                    progress(filename, report[filename], len(report), total)
+
+        return report
+
+    def refreshList(self, staleOnly: bool = False) -> list:
+        '''
+        Return the files refresh() works through, including those other
+        processes have added
+        '''
+        with self.transaction():
+            filenames = list(self.descriptor['files'].keys())
+            if staleOnly is True:
+                filenames = [filename for filename in filenames
+                             if self.descriptor['files'][filename]['loaded'] is True and not self.isFresh(filename)]
+        return filenames
+
+    def refreshFile(self, filename: str, hostLimit: int = 0, cancel = None) -> dict:
+        '''
+        Retrieve a single file as refresh() does and describe the outcome
+        '''
+        with self.lock:
+            entry = self.descriptor['files'].get(filename)
+            if entry is None:
+                return {'status': 'failed', 'path': None, 'elapsed': 0.0}
+            cached = entry['loaded'] is True and self.isFresh(filename)
+            mtime = entry.get('mtime')
+            url = entry['url']
 
-        for filename, entry in self.descriptor['files'].items():
-            # getFile() takes care of the descriptor
-            self.getFile(filename)
+        start = time.time()
+        if cached:
+            path = self._obtain(filename)
+        else:
+            with self._hostSlot(url, hostLimit), self.store.throttle.scope(self.name, BULK):
+                path = self._obtain(filename, False, cancel)
+        elapsed = time.time() - start
+
+        # Syncing with other processes may have replaced the entry meanwhile
+        with self.lock:
+            entry = self.descriptor['files'].get(filename, {})
+        if path is None:
+            status = 'failed'
+        elif cached or entry.get('mtime') == mtime:
+            status = 'cached'
+        else:
+            status = 'retrieved'
+
+        return {'status': status, 'path': path, 'elapsed': elapsed}
+
+    def _hostSlot(self, url: str, hostLimit: int):
+        '''
+        Return a semaphore bounding concurrent transfers from the host of url
+        '''
+        if hostLimit <= 0:
+            return contextlib.nullcontext()
+
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self._hostSlots:
+                self._hostSlots[host] = threading.BoundedSemaphore(hostLimit)
+            return self._hostSlots[host]
 
     def purge(self):
         '''
@@ -145,53 +1144,344 @@ class Context(object):
             self.store.logger.error("C: Storage in not writable, aborting")
             return
 
-        for filename, entry in self.descriptor['files'].items():
-            if 'path' in entry:
-                path = entry['path']
-                self.store.logger.debug("C: Deleting file " + path)
-                if os.path.isfile(path):
-                    os.remove(path)
+        with self.transaction():
+            for filename, entry in self.descriptor['files'].items():
+                if 'path' in entry:
+                    self.store.logger.debug("C: Deleting file " + entry['path'])
+                    self._removeCopies(entry)
+                self._discardPartial(filename)
 
-        # Update dictionary
-        self.descriptor['files'].clear()
+            # Update dictionary
+            self.descriptor['files'].clear()
+            self._entryLocks.clear()
 
-        # Write descriptor
-        self.writeDescriptor()
+            # Write descriptor
+            self.writeDescriptor()
+
+    def _removeCopies(self, entry: dict):
+        '''
+        Delete the local copies of a file: the plain one, any compressed one, and
+        its blob if nothing else uses it
+        '''
+        self.store.maps.release(entry['path'])
+        self.store.memory.invalidate(entry['path'])
+        discard(entry['path'])
+        if 'stored' in entry:
+            discard(entry['stored'])
+        self._releaseBlob(entry)
+
+    def _releaseBlob(self, entry: dict):
+        '''
+        Let the blob store free the content of a removed file if nothing else uses it
+        '''
+        if self.store.blobs is not None:
+            self.store.blobs.release(entry.get('sha256'))
+
+    def _discardPartial(self, filename: str):
+        '''
+        Remove any partial download kept for a file
+        '''
+        outfile = str(self.path / filename)
+        discard(outfile + ".part", outfile + ".part.json", outfile + ".blocks")
+
+    def updateDescriptor(self, filename: str):
+        '''
+        Record the change to a single file entry in the journal, writing a full
+        descriptor snapshot when a checkpoint is due
+        '''
+        with self.transaction():
+            entry = self.descriptor['files'].get(filename)
+            self._accesses.pop(filename, None)
+            self._recount(filename)
+            if entry is None:
+                due = self.journal.remove(filename)
+            else:
+                due = self.journal.put(filename, entry)
+            if due:
+                self.writeDescriptor()
 
     def writeDescriptor(self):
         '''
-        Dump Context metadata as a file
+        Dump Context metadata as a file, folding in any journalled changes
         '''
-        desc = str(self.path / "desc.json")
-        self.store.logger.debug("C: Writing descriptor in " + desc)
-        with open(desc , 'w') as handle:
-            handle.write(json.dumps(self.descriptor, indent=4))
-            handle.close()
+        self.store.logger.debug("C: Writing descriptor in " + str(self.path))
+        with self.transaction():
+            with self.store.metrics.span('descriptorWrite', self.name):
+                self.journal.checkpoint(self.descriptor)
+            self._accesses.clear()
+            # Changes written in bulk are counted again when next needed
+            self._resetUsage()
+            self.store.metrics.count('descriptorWrites', self.name)
+
+    def usage(self) -> tuple:
+        '''
+        Return the bytes and number of files this Context holds in local storage,
+        counting the content shared by deduplicated files once. These are kept up
+        to date as files are retrieved, evicted and deleted, and only worked out
+        from every entry after changes made in bulk
+        '''
+        with self.lock:
+            files = self.descriptor['files']
+            if self._held is None:
+                self._held = {}
+                self._blobs = {}
+                self._used = 0
+                for filename, entry in files.items():
+                    self._hold(filename, entry)
+            return self._used, len(self._held)
+
+    def _recount(self, filename: str):
+        '''
+        Bring the bytes held for a single file up to date in the running totals
+        '''
+        with self.lock:
+            if self._held is None:
+                return
+            size, sha256 = self._held.pop(filename, (0, None))
+            if sha256 is None:
+                self._used -= size
+            else:
+                self._blobs[sha256][0] -= 1
+                if self._blobs[sha256][0] == 0:
+                    del self._blobs[sha256]
+                    self._used -= size
+                    self.store.shareBlob(sha256, size, -1)
+            entry = self.descriptor['files'].get(filename)
+            if entry is not None:
+                self._hold(filename, entry)
+
+    def _hold(self, filename: str, entry: dict):
+        '''
+        Add a file to the running totals if it is held
+        '''
+        if entry.get('loaded') is not True:
+            return
+        size = heldSize(entry)
+        sha256 = entry.get('sha256') if self.store.blobs is not None else None
+        self._held[filename] = (size, sha256)
+        if sha256 is None:
+            self._used += size
+        elif sha256 in self._blobs:
+            self._blobs[sha256][0] += 1
+        else:
+            self._blobs[sha256] = [1, size]
+            self._used += size
+            self.store.shareBlob(sha256, size, 1)
+
+    def _resetUsage(self):
+        '''
+        Drop the running totals, to be worked out again when next needed
+        '''
+        with self.lock:
+            if self._held is None:
+                return
+            for sha256, (refs, size) in self._blobs.items():
+                self.store.shareBlob(sha256, size, -1)
+            self._held = None
+            self._blobs = {}
+
+    def flush(self):
+        '''
+        Store the access statistics kept in memory, in one batch, and write a
+        descriptor snapshot if there are journalled changes not yet in it
+        '''
+        with self.transaction():
+            if not self.store.writable:
+                return
+            if self._accesses:
+                files = self.descriptor['files']
+                accessed = {filename: files[filename] for filename in self._accesses if filename in files}
+                self._accesses.clear()
+                self.journal.putMany(accessed)
+            if self.journal.pending > 0:
+                self.writeDescriptor()
+
+    def close(self):
+        '''
+        Stop prefetching and flush the descriptor; the Context can still be used afterwards
+        '''
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        self.flush()
+
+    def restore(self, lazy: bool = False):
+        '''
+        Restore the Context metadata from its own descriptor snapshot and journal.
+        If lazy is True, this is deferred until the metadata is first used.
+
+        Unlike load(), the state of files already in the storage is preserved
+        '''
+        with self.lock:
+            if lazy is True:
+                self._pending = True
+                return
+            with self.fileLock:
+                desc = self.journal.read()
+            if desc is None:
+                return
+            self.store.logger.debug("C: Restored context from " + str(self.path))
+            # The name is always that of the directory the context was found in
+            desc.pop('name', None)
+            self.descriptor.update(desc)
+            self._resetUsage()
 
     def deleteDescriptor(self):
         '''
-        Delete Context metadata file
+        Delete Context metadata files
         '''
-        desc = self.path / "desc.json"
-        self.store.logger.debug("C: Deleting descriptor " + str(desc))
-        desc.unlink()
+        self.store.logger.debug("C: Deleting descriptor in " + str(self.path))
+        self.journal.delete()
 
     def export(self, path: str):
         '''
         Dump Context metadata as a file
         '''
-        desc = copy.deepcopy(self.descriptor)
-        for filename, entry in desc['files'].items():
-            entry['loaded'] = False
-            if 'path' in entry:
-                del entry['path']
-
+        desc = self._exportable()
         self.store.logger.debug("C: Exporting context in " + path)
         with open(path, 'w') as handle:
             handle.write(json.dumps(desc, indent=4))
             handle.close()
 
-    def load(self, location: str, merge: bool = False):
+    def _exportable(self) -> dict:
+        '''
+        Return a copy of the descriptor without anything that only applies to local storage
+        '''
+        with self.lock:
+            desc = copy.deepcopy(self.descriptor)
+        desc.pop('quota', None)
+        desc.pop('compression', None)
+        desc.pop('mirrors', None)
+        for filename, entry in desc['files'].items():
+            entry['loaded'] = False
+            for key in LOCAL_KEYS:
+                entry.pop(key, None)
+        return desc
+
+    def exportBundle(self, target, compression: str = None) -> list:
+        '''
+        Write the Context metadata and the files it holds into a single tar
+        archive, target being a path or a binary file object, compressed with
+        compression ('gz', 'bz2', 'xz' or None). The archive is streamed, so
+        neither it nor any file is held in memory. Returns the files written
+
+        See importBundle()
+        '''
+        self.store.logger.debug("C: Exporting context bundle")
+        with openBundle(target, 'w', compression) as tar:
+            return self._writeBundle(tar)
+
+    def _writeBundle(self, tar) -> list:
+        '''
+        Add the descriptor and the files held to an open bundle
+        '''
+        prefix = self.path.name
+        desc = self._exportable()
+        addDescriptor(tar, prefix, desc)
+        written = []
+        for filename in desc['files']:
+            entry = self.peekFile(filename)
+            if entry is None or 'sha256' not in entry:
+                continue
+            try:
+                if 'stored' in entry:
+                    codec = getCodec(entry['codec'])
+                    if codec is None:
+                        raise OSError('Codec ' + entry['codec'] + ' is not available')
+                    handle = codec.open(entry['stored'])
+                else:
+                    handle = open(entry['path'], 'rb')
+            except OSError as err:
+                self.store.logger.error("C: Cannot bundle " + filename + ", " + str(err))
+                continue
+            with handle:
+                addMember(tar, prefix + "/" + FILES + "/" + filename, handle, entry['size'], entry.get('mtime', 0))
+            written.append(filename)
+        return written
+
+    def importBundle(self, source, skipExisting: bool = True, name: str = None) -> dict:
+        '''
+        Import the context called name, by default the first one, from a bundle
+        written by exportBundle() or StorageArea.exportBundle(), source being a
+        path or a binary file object. The archive is read as a stream.
+
+        Files listed in the bundle are added to the Context and those bundled are
+        stored and marked as held, keeping their URL and validators, without any
+        network access. Each file's hash is checked as it is stored. If
+        skipExisting is True, files already held with the same hash are left as
+        they are. Returns the filenames 'imported', 'skipped' and 'failed'
+
+        If the store area is not writable, this method will return None
+        '''
+        if not self.store.writable:
+            self.store.logger.error("C: Storage in not writable, aborting")
+            return None
+
+        chosen = []
+        def resolve(bundled):
+            if chosen or (name is not None and bundled != name):
+                return None
+            chosen.append(bundled)
+            return self
+
+        self.store.logger.debug("C: Importing context bundle")
+        try:
+            with openBundle(source, 'r') as tar:
+                report = readBundle(tar, resolve, skipExisting)
+        except tarfile.TarError as err:
+            self.store.logger.error("C: Failed to read bundle, " + str(err))
+            return None
+        return {outcome: [filename for context, filename in files] for outcome, files in report.items()}
+
+    def _importDescriptor(self, desc: dict):
+        '''
+        Add the files listed by a bundled descriptor which are not known yet
+        '''
+        with self.transaction():
+            for filename, entry in desc['files'].items():
+                if filename not in self.descriptor['files'] and bundleName(filename):
+                    entry['loaded'] = False
+                    for key in LOCAL_KEYS:
+                        entry.pop(key, None)
+                    self.descriptor['files'][filename] = copy.deepcopy(entry)
+            self.writeDescriptor()
+
+    def _importFile(self, filename: str, source: dict, handle, skipExisting: bool) -> str:
+        '''
+        Store a bundled file read from handle, returning 'imported', 'skipped' or 'failed'
+        '''
+        if source is None or 'sha256' not in source or not bundleName(filename):
+            self.store.logger.error("C: Bundled file " + filename + " is not described, ignoring")
+            return 'failed'
+        if skipExisting is True:
+            held = self.peekFile(filename)
+            if held is not None and held.get('sha256') == source['sha256']:
+                return 'skipped'
+
+        def fill(outfile):
+            temp = outfile + ".copy"
+            digest = hashlib.sha256()
+            try:
+                with open(temp, 'wb') as target:
+                    while True:
+                        chunk = handle.read(self.store.fetcher.chunkSize)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        target.write(chunk)
+            except BaseException:
+                discard(temp)
+                raise
+            if digest.hexdigest() != source['sha256']:
+                discard(temp)
+                raise OSError('Bundled ' + filename + ' does not match its hash')
+            os.replace(temp, outfile)
+
+        self.store.logger.debug("C: Importing " + filename + " from bundle")
+        if self._install(filename, dict(source, fetched=source.get('fetched', time.time())), fill) is None:
+            return 'failed'
+        return 'imported'
+
+    def load(self, location: str, merge: bool = False, incremental: bool = False) -> dict:
         '''
         Populate the Context metadata; determining from a file or URL.
 
@@ -200,12 +1490,19 @@ class Context(object):
         If merge is True, the existing list of files in the context will be merged with
         the new files. If False, the new list will replace the existing list.
         The existing context name and author will always be preserved
+
+        If incremental is True, the new list is compared with the existing one:
+        files with the same URL, and the same hash and size where both lists give
+        them, keep their local copies, so that refresh() only retrieves added and
+        changed files. Local copies of changed files, and of files no longer listed
+        (unless merging), are deleted. Returns a report listing the 'added',
+        'changed', 'removed' and 'unchanged' files
         '''
 
         if urllib.parse.urlparse(location).scheme in ('http', 'https',):
             self.store.logger.debug("C: Populating context from URL " + location)
-            data = urllib.request.urlopen(location)
-            newDesc = json.load(data)
+            with self.store.pool.open(location) as data:
+                newDesc = json.load(data)
         else:
             self.store.logger.debug("C: Populating context from file: " + location)
             with open(location, 'r') as handle:
@@ -215,16 +1512,58 @@ class Context(object):
         # Remove existing loaded status or paths
         for filename, entry in newDesc['files'].items():
             entry['loaded'] = False
-            if 'path' in entry:
-                del entry['path']
+            for key in LOCAL_KEYS:
+                entry.pop(key, None)
 
-        if merge is True:
-            self.descriptor['files'].update(newDesc['files'])
-        else:
-            self.descriptor['author'] = newDesc['author']
-            self.descriptor['files'] = copy.deepcopy(newDesc['files'])
+        if incremental is True:
+            return self._loadIncremental(newDesc, merge)
+
+        with self.transaction():
+            if merge is True:
+                self.descriptor['files'].update(newDesc['files'])
+            else:
+                self.descriptor['author'] = newDesc['author']
+                self.descriptor['files'] = copy.deepcopy(newDesc['files'])
 
-        self.writeDescriptor()
+            self.writeDescriptor()
+
+    def _loadIncremental(self, newDesc: dict, merge: bool) -> dict:
+        '''
+        Apply a new list of files for load(), keeping what is unchanged
+        '''
+        report = {'added': [], 'changed': [], 'removed': [], 'unchanged': []}
+        with self.transaction():
+            files = self.descriptor['files']
+            for filename, new in newDesc['files'].items():
+                entry = files.get(filename)
+                if entry is None:
+                    report['added'].append(filename)
+                    files[filename] = new
+                elif sameContent(entry, new):
+                    report['unchanged'].append(filename)
+                    if entry.get('url') != new.get('url'):
+                        # The local copy is kept, only the sources change
+                        for key in ('urls', 'etag', 'lastModified'):
+                            entry.pop(key, None)
+                    for key, value in new.items():
+                        if key != 'loaded':
+                            entry[key] = value
+                else:
+                    report['changed'].append(filename)
+                    self._forget(filename)
+                    files[filename] = new
+
+            if merge is not True:
+                self.descriptor['author'] = newDesc['author']
+                for filename in [filename for filename in files if filename not in newDesc['files']]:
+                    report['removed'].append(filename)
+                    self._forget(filename)
+
+            self.store.logger.debug("C: Loaded " + str(len(report['added'])) + " added, " +
+                                    str(len(report['changed'])) + " changed and " +
+                                    str(len(report['removed'])) + " removed files")
+            self.writeDescriptor()
+        return report
 
     def listFiles(self):
         '''
@@ -234,4 +1573,34 @@ class Context(object):
             if files['loaded'] is True:
                 print("\t" + name + " " + files['url'] + " " + files['path'])
             else:
-                print("\t" + name + " " + files['url'])
\ No newline at end of file
+                print("\t" + name + " " + files['url'])
+
+def bundleName(filename: str) -> bool:
+    '''
+    True if a filename read from a bundle can safely name a file of the Context
+    '''
+    return filename not in ('', '.', '..') and os.path.basename(filename) == filename \
+        and not filename.startswith('.')
+
+def newEntry(url) -> dict:
+    '''
+    Return the entry of a file added with a URL or a list of URLs
+    '''
+    if isinstance(url, (list, tuple)):
+        if len(url) > 1:
+            return {'url': url[0], 'urls': list(url), 'loaded': False}
+        url = url[0]
+    return {'url': url, 'loaded': False}
+
+def sameContent(entry: dict, new: dict) -> bool:
+    '''
+    True if a manifest entry describes the same content as an existing entry: the
+    same hash and size where both give them, and the same URL unless both give
+    a hash, in which case the content may have moved
+    '''
+    if entry.get('url') != new.get('url') and not ('sha256' in entry and 'sha256' in new):
+        return False
+    for key in ('sha256', 'size'):
+        if key in entry and key in new and entry[key] != new[key]:
+            return False
+    return True
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+'''
+Eviction policies for size-bounded storage areas. A policy ranks the loaded
+entries of the contexts being trimmed; those with the lowest priority are
+evicted first. Entries carry an access time ('atime') and an access counter
+('hits') which Context keeps up to date.
+'''
+
+class EvictionPolicy(object):
+    '''
+    Base class for eviction policies
+    '''
+
+    def priority(self, entry: dict):
+        '''
+        Return the retention priority of an entry, lowest is evicted first
+        '''
+        raise NotImplementedError
+
+    def accessed(self, entry: dict):
+        '''
+        Called each time an entry is read or retrieved
+        '''
+        pass
+
+    def evicted(self, entry: dict):
+        '''
+        Called each time an entry is evicted
+        '''
+        pass
+
+class LRUPolicy(EvictionPolicy):
+    '''
+    Least recently used entries are evicted first
+    '''
+
+    def priority(self, entry: dict):
+        return entry.get('atime', 0.0)
+
+class LFUPolicy(EvictionPolicy):
+    '''
+    Least frequently used entries are evicted first, least recently used among equals
+    '''
+
+    def priority(self, entry: dict):
+        return (entry.get('hits', 0), entry.get('atime', 0.0))
+
+class GDSFPolicy(EvictionPolicy):
+    '''
+    Greedy-Dual-Size-Frequency: favours small, frequently used entries, with an
+    inflation value that ages entries which have not been used since earlier evictions
+    '''
+
+    def __init__(self):
+        self.inflation = None
+
+    def priority(self, entry: dict):
+        if 'gdsf' not in entry:
+            return self._value(entry, 0.0)
+        return entry['gdsf']
+
+    def accessed(self, entry: dict):
+        if self.inflation is None:
+            # Not known after a restart, start from the last recorded priority
+            self.inflation = entry.get('gdsf', 0.0) - self._value(entry, 0.0)
+            self.inflation = max(self.inflation, 0.0)
+        entry['gdsf'] = self._value(entry, self.inflation)
+
+    def evicted(self, entry: dict):
+        self.inflation = max(self.inflation or 0.0, self.priority(entry))
+
+    def _value(self, entry: dict, inflation: float) -> float:
+        return inflation + float(entry.get('hits', 1)) / max(entry.get('size', 1), 1)
+
+POLICIES = {'lru': LRUPolicy, 'lfu': LFUPolicy, 'gdsf': GDSFPolicy}
+
+def makePolicy(policy) -> EvictionPolicy:
+    '''
+    Return a policy instance given either an instance or one of the names in POLICIES
+    '''
+    if isinstance(policy, EvictionPolicy):
+        return policy
+    if policy not in POLICIES:
+        raise ValueError('Unknown eviction policy ' + str(policy))
+    return POLICIES[policy]()
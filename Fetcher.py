@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import threading
+import contextlib
+import http.client
+import urllib
+import urllib.error
+import urllib.parse
+
+from Codecs import transferDecoder, getCodec
+
+class FetchCancelled(Exception):
+    '''
+    Raised when a retrieval is abandoned because its cancel event was set
+    '''
+    pass
+
+class Fetcher(object):
+    '''
+    Fetcher - streams remote resources into the storage. Data is written in chunks
+    to a temporary file beside the destination and hashed as it arrives; the file
+    is only renamed into place once it is complete, so readers never see partial data.
+
+    A partial download is kept together with the validators (ETag/Last-Modified)
+    the server sent for it, and the next attempt resumes it with a Range request.
+    Validators of an existing copy can be sent to make the request conditional.
+
+    If asked to decode, fresh requests accept a gzip Content-Encoding, which is
+    decoded as it arrives; such transfers cannot be resumed. Resources which are
+    themselves gzip files are never decoded, and without decoding the body is
+    stored as sent, whatever its Content-Encoding.
+
+    A file available from several sources is retrieved from the one the selector
+    (a SourceSelector) prefers, failing over to the others. If hedge is set and
+    the source in use has not delivered the file after hedge seconds, the next
+    one is raced against it and the first to finish is kept.
+
+    Bytes received are charged to the throttle (a Throttle), if any, which also
+    bounds the number of files written at a time.
+    '''
+
+    def __init__(self, logger, pool, chunkSize: int = 1048576, selector = None, hedge: float = None,
+                 metrics = None, throttle = None):
+        self.logger = logger
+        self.pool = pool
+        self.chunkSize = chunkSize
+        self.selector = selector
+        self.hedge = hedge
+        self.metrics = metrics
+        self.throttle = throttle
+
+    def fetch(self, url: str, outfile: str, current: dict = None, cancel = None, decode: bool = False) -> dict:
+        '''
+        Retrieve url into outfile, returning the 'size', 'sha256' and 'mtime' of the
+        stored file together with any 'etag' and 'lastModified' validators, and the
+        number of bytes 'transferred' by this call.
+
+        If current holds the validators of the copy already in outfile, the request
+        is conditional and {'notModified': True} is returned when that copy is
+        still valid, without transferring the body.
+
+        If cancel (a threading.Event) is set while the body is streamed, the
+        transfer stops and FetchCancelled is raised; the partial file is kept.
+
+        If decode is True, the server may send the body gzip-encoded.
+
+        Raises urllib.error.URLError if the resource cannot be retrieved
+        '''
+        part = outfile + ".part"
+        state = outfile + ".part.json"
+
+        offset, validator = resumePoint(url, part, state)
+        headers = {}
+        if offset > 0:
+            self.logger.debug("F: Resuming " + url + " at byte " + str(offset))
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+            headers['If-Range'] = validator
+        else:
+            if decode is True and not isGzipName(url):
+                headers['Accept-Encoding'] = 'gzip'
+            if current is not None and 'etag' in current:
+                headers['If-None-Match'] = current['etag']
+            if current is not None and 'lastModified' in current:
+                headers['If-Modified-Since'] = current['lastModified']
+
+        try:
+            response = self.pool.open(url, headers)
+        except urllib.error.HTTPError as err:
+            if err.code == 304 and offset == 0 and current is not None:
+                self.logger.debug("F: " + url + " not modified")
+                return {'notModified': True}
+            if err.code == 416 and offset > 0:
+                # The partial file does not fit the resource any more, start again
+                self.logger.debug("F: Range not satisfiable, discarding " + part)
+                discard(part, state)
+                return self.fetch(url, outfile, current, cancel, decode)
+            raise
+
+        with response:
+            meta = validators(response)
+            decoder = None
+            if decode is True and not isGzipResource(url, response):
+                try:
+                    decoder = transferDecoder(response.headers.get('Content-Encoding'))
+                except ValueError as err:
+                    raise urllib.error.URLError(err)
+
+            if decoder is None and offset > 0 and getattr(response, 'status', None) == 206 \
+                    and rangeStart(response) == offset:
+                digest = hashState(part, self.chunkSize)
+                mode = 'ab'
+            else:
+                offset = 0
+                digest = hashlib.sha256()
+                mode = 'wb'
+
+            # Remember how to resume before any data arrives; a decoded transfer
+            # cannot be resumed with a byte range of the encoded one
+            resumable = bool(meta) and decoder is None
+            if resumable:
+                with open(state, 'w') as handle:
+                    handle.write(json.dumps(dict(meta, url=url)))
+                    handle.close()
+            else:
+                discard(state)
+
+            self.logger.debug("F: Streaming " + url + " into " + part)
+            size = offset
+            transferred = 0
+            try:
+                with self._writer(), open(part, mode) as handle:
+                    while True:
+                        if cancel is not None and cancel.is_set():
+                            raise FetchCancelled(url)
+                        chunk = response.read(self.chunkSize)
+                        if chunk:
+                            transferred += len(chunk)
+                            self._consume(len(chunk))
+                            if decoder is not None:
+                                chunk = decoder.decompress(chunk)
+                        elif decoder is not None:
+                            chunk, decoder = decoder.flush(), None
+                        else:
+                            break
+                        digest.update(chunk)
+                        handle.write(chunk)
+                        size += len(chunk)
+            except zlib.error as err:
+                discard(part, state)
+                raise urllib.error.URLError('Damaged compressed transfer, ' + str(err))
+            except BaseException:
+                # Keep what we have if it can be resumed later
+                if not resumable:
+                    discard(part, state)
+                raise
+
+        os.replace(part, outfile)
+        discard(state)
+
+        meta.update({'size': size, 'sha256': digest.hexdigest(), 'mtime': os.stat(outfile).st_mtime,
+                     'transferred': transferred})
+        return meta
+
+    def fetchFrom(self, urls: list, outfile: str, current: dict = None, cancel = None, size: int = None,
+                  context: str = None, decode: bool = False) -> dict:
+        '''
+        Retrieve a file available from any of urls into outfile as fetch() does,
+        trying them in the order the selector prefers for a file of size bytes.
+        A source that fails is set aside and the next one tried; the error of the
+        last one is raised if none succeeds. Failovers and hedged requests are
+        counted under context
+        '''
+        if self.selector is not None:
+            urls = self.selector.order(urls, size)
+        if self.hedge is not None and len(urls) > 1:
+            return self._hedged(urls, outfile, current, cancel, context, decode)
+
+        for position, url in enumerate(urls):
+            if position > 0:
+                self.logger.info("F: Failing over to " + url)
+                self._count('failovers', context)
+            try:
+                return self._attempt(url, outfile, current, cancel, decode)
+            except FetchCancelled:
+                raise
+            except (OSError, http.client.HTTPException):
+                if position == len(urls) - 1:
+                    raise
+
+    def _attempt(self, url: str, outfile: str, current: dict, cancel, decode: bool) -> dict:
+        '''
+        Retrieve url into outfile, reporting how it went to the selector
+        '''
+        start = time.perf_counter()
+        try:
+            meta = self.fetch(url, outfile, current, cancel, decode)
+        except FetchCancelled:
+            raise
+        except (OSError, http.client.HTTPException) as err:
+            self.logger.info("F: Failed to retrieve " + url + ", " + str(err))
+            if self.selector is not None and isSourceFailure(err):
+                self.selector.failed(url)
+            raise
+        if self.selector is not None:
+            self.selector.record(url, time.perf_counter() - start, meta.get('transferred', 0))
+        return meta
+
+    def _hedged(self, urls: list, outfile: str, current: dict, cancel, context: str, decode: bool) -> dict:
+        '''
+        fetchFrom() with hedging: each attempt streams into its own file beside
+        outfile and the first to complete is renamed into place, the others being
+        cancelled and their files removed
+        '''
+        condition = threading.Condition()
+        done = threading.Event()
+        state = {'meta': None, 'error': None, 'running': 0}
+        inherited = self.throttle.current() if self.throttle is not None else None
+
+        def attempt(url, target):
+            try:
+                with self.throttle.scope(*inherited) if inherited is not None else contextlib.nullcontext():
+                    meta = self._attempt(url, target, current, AnyEvent(done, cancel), decode)
+                with condition:
+                    if state['meta'] is None:
+                        if meta.get('notModified') is not True:
+                            os.replace(target, outfile)
+                        state['meta'] = meta
+                        done.set()
+            except FetchCancelled:
+                pass
+            except Exception as err:
+                # Whatever went wrong is raised by the caller, not lost with this thread
+                with condition:
+                    state['error'] = err
+            finally:
+                with condition:
+                    try:
+                        discard(target, target + ".part", target + ".part.json")
+                    finally:
+                        state['running'] -= 1
+                        condition.notify_all()
+
+        pending = list(urls)
+        launched = 0.0
+        with condition:
+            while True:
+                if state['meta'] is not None:
+                    return state['meta']
+                idle = state['running'] == 0
+                if idle and (not pending or cancel is not None and cancel.is_set()):
+                    if cancel is not None and cancel.is_set():
+                        raise FetchCancelled(urls[0])
+                    raise state['error']
+                slow = state['running'] == 1 and time.monotonic() - launched >= self.hedge
+                if pending and (idle or slow):
+                    url = pending.pop(0)
+                    if launched > 0.0:
+                        self.logger.info(("F: Failing over to " if idle else "F: Hedging with ") + url)
+                        self._count('failovers' if idle else 'hedges', context)
+                    target = outfile + ".hedge" + str(len(urls) - len(pending))
+                    state['running'] += 1
+                    launched = time.monotonic()
+                    threading.Thread(target=attempt, args=(url, target), daemon=True).start()
+                condition.wait(min(self.hedge, 0.5))
+
+    def fetchRangeFrom(self, urls: list, start: int, end: int, target: str, validator: str = None) -> dict:
+        '''
+        Retrieve a range of a file available from any of urls as fetchRange()
+        does, failing over from one source to the next. Since validators differ
+        between sources, a source may send the whole file instead of the range
+        '''
+        if self.selector is not None:
+            urls = self.selector.order(urls)
+        for position, url in enumerate(urls):
+            try:
+                return self.fetchRange(url, start, end, target, validator)
+            except (OSError, http.client.HTTPException) as err:
+                if self.selector is not None and isSourceFailure(err):
+                    self.selector.failed(url)
+                if position == len(urls) - 1 or isinstance(err, urllib.error.HTTPError) and err.code == 416:
+                    raise
+                self.logger.info("F: Failing over to " + urls[position + 1])
+
+    def _writer(self):
+        if self.throttle is None:
+            return contextlib.nullcontext()
+        return self.throttle.writer()
+
+    def _consume(self, size: int):
+        if self.throttle is not None:
+            self.throttle.consume(size)
+
+    def _count(self, name: str, context: str):
+        if self.metrics is not None:
+            self.metrics.count(name, context)
+
+    def fetchRange(self, url: str, start: int, end: int, target: str, validator: str = None) -> dict:
+        '''
+        Retrieve bytes start to end (inclusive) of url into the same positions of
+        target, a sparse file which is created if needed.
+
+        If validator (an ETag or Last-Modified value) is given, the server only
+        sends the range if the resource still matches it. When the server sends
+        the whole resource instead, it is written from the start of target and
+        'full' is True in the result.
+
+        Returns the 'start' and 'end' positions written, the 'total' size of the
+        resource (None if unknown), 'full', any validators and the number of
+        bytes 'transferred'.
+
+        Raises urllib.error.URLError if the range cannot be retrieved
+        '''
+        headers = {'Range': 'bytes=' + str(start) + '-' + str(end)}
+        if validator is not None:
+            headers['If-Range'] = validator
+
+        with self.pool.open(url, headers) as response:
+            meta = validators(response)
+            partial = getattr(response, 'status', None) == 206
+            if partial and rangeStart(response) != start:
+                raise urllib.error.URLError('Unexpected range in response for ' + url)
+            position = start if partial else 0
+
+            self.logger.debug("F: Streaming bytes " + str(position) + "- of " + url + " into " + target)
+            written = 0
+            with self._writer(), open(target, 'r+b' if os.path.exists(target) else 'wb') as handle:
+                handle.seek(position)
+                while True:
+                    chunk = response.read(self.chunkSize)
+                    if not chunk:
+                        break
+                    self._consume(len(chunk))
+                    handle.write(chunk)
+                    written += len(chunk)
+                if not partial:
+                    handle.truncate()
+
+        meta.update({'start': position, 'end': position + written - 1, 'full': not partial,
+                     'total': rangeTotal(response) if partial else written, 'transferred': written})
+        return meta
+
+class AnyEvent(object):
+    '''
+    Set when any of the given threading.Events (None ones aside) is set
+    '''
+
+    def __init__(self, *events):
+        self.events = [event for event in events if event is not None]
+
+    def is_set(self) -> bool:
+        return any(event.is_set() for event in self.events)
+
+def isGzipName(url: str) -> bool:
+    '''
+    True if the path of url names a gzip file
+    '''
+    return urllib.parse.urlsplit(url).path.lower().endswith(('.gz', '.tgz'))
+
+def isGzipResource(url: str, response) -> bool:
+    '''
+    True if a response carries a gzip file, which is to be stored as it is
+    rather than decoded
+    '''
+    contentType = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    return isGzipName(url) or contentType in ('application/gzip', 'application/x-gzip')
+
+def isSourceFailure(err) -> bool:
+    '''
+    True if an error says the source is unwell, rather than that it lacks the file
+    '''
+    return not isinstance(err, urllib.error.HTTPError) or err.code >= 500 or err.code == 429
+
+def resumePoint(url: str, part: str, state: str) -> tuple:
+    '''
+    Return the offset to resume a partial download from and the validator to send
+    with it, or (0, None) if it cannot be resumed
+    '''
+    if not os.path.isfile(part) or not os.path.isfile(state):
+        return 0, None
+    try:
+        with open(state, 'r') as handle:
+            saved = json.load(handle)
+            handle.close()
+    except ValueError:
+        return 0, None
+    if saved.get('url') != url:
+        return 0, None
+
+    validator = rangeValidator(saved)
+    if validator is None:
+        return 0, None
+    return os.path.getsize(part), validator
+
+def rangeValidator(meta: dict) -> str:
+    '''
+    Return the validator to send in If-Range for a copy with the given validators, or None
+    '''
+    # Weak ETags cannot be used in If-Range
+    validator = meta.get('etag')
+    if validator is None or validator.startswith('W/'):
+        validator = meta.get('lastModified')
+    return validator
+
+def validators(response) -> dict:
+    '''
+    Return the cache validators sent with a response
+    '''
+    meta = {}
+    etag = response.headers.get('ETag')
+    if etag is not None:
+        meta['etag'] = etag
+    lastModified = response.headers.get('Last-Modified')
+    if lastModified is not None:
+        meta['lastModified'] = lastModified
+    return meta
+
+def rangeStart(response) -> int:
+    '''
+    Return the first byte position of a 206 response, from its Content-Range
+    '''
+    contentRange = response.headers.get('Content-Range', '')
+    try:
+        return int(contentRange.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return -1
+
+def rangeTotal(response) -> int:
+    '''
+    Return the full size of the resource from the Content-Range of a 206 response,
+    or None if the server did not say
+    '''
+    contentRange = response.headers.get('Content-Range', '')
+    try:
+        return int(contentRange.split('/')[1])
+    except (IndexError, ValueError):
+        return None
+
+def hashState(path: str, chunkSize: int = 1048576):
+    '''
+    Return a SHA-256 object updated with the contents of a local file
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        while True:
+            chunk = handle.read(chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest
+
+def hashFile(path: str, chunkSize: int = 1048576) -> str:
+    '''
+    Return the SHA-256 of a local file
+    '''
+    return hashState(path, chunkSize).hexdigest()
+
+def discard(*paths):
+    '''
+    Remove temporary files, ignoring those that do not exist
+    '''
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+def copyContent(entry: dict, target: str):
+    '''
+    Write the plain content of the file recorded in a descriptor entry into
+    target, decompressing it if only a compressed copy is held
+    '''
+    temp = target + ".copy"
+    path = entry['path']
+    if 'stored' in entry and not (os.path.isfile(path) and os.path.getsize(path) == entry.get('size')):
+        codec = getCodec(entry['codec'])
+        if codec is None:
+            raise OSError('Codec ' + entry['codec'] + ' is not available')
+        codec.decompress(entry['stored'], temp)
+    else:
+        shutil.copyfile(path, temp)
+    os.replace(temp, target)
+
+def isIntact(entry: dict) -> bool:
+    '''
+    Cheaply check that the file recorded in a descriptor entry is present and has
+    the recorded size and modification time
+    '''
+    if 'path' not in entry:
+        return False
+    # A file kept compressed is checked through its compressed copy
+    try:
+        info = os.stat(entry.get('stored', entry['path']))
+    except OSError:
+        return False
+    if 'storedSize' in entry:
+        if info.st_size != entry['storedSize']:
+            return False
+    elif 'size' in entry and info.st_size != entry['size']:
+        return False
+    if 'mtime' in entry and info.st_mtime != entry['mtime']:
+        return False
+    return True
+
+def heldSize(entry: dict) -> int:
+    '''
+    Return the bytes local storage holds for a descriptor entry: those of its
+    compressed copy and, while it is present, of its plain copy
+    '''
+    if 'stored' not in entry:
+        return entry.get('size', 0)
+    held = entry.get('storedSize', 0)
+    if os.path.isfile(entry['path']):
+        held += entry.get('size', 0)
+    return held
@@ -3,8 +3,6 @@
 
     To do/think about:
     - returning/conflicting sessions,
-    - Multiple openings of the same StorageArea
-    - locking contexts
     - test getFile('file://')
     - Revise writable (use StorageArea.writable, vs in-line check with os.access())
     - more tests
@@ -22,6 +20,7 @@ import logging
 import shutil
 
 from StorageArea import StorageArea
+from AsyncContext import AsyncContext
 
 class SimpleCache(object):
     '''
@@ -44,23 +43,67 @@ class SimpleCache(object):
     # S.get() retrieves the file if necessary and returns the path of the file locally
     fits_image_filename = fits.open(S.get("ick906030_prev.fits"))
 
+    # S.read() returns the content; with memoryCapacity set, small files are
+    # kept in memory between calls
+    table = S.read("calibration.xml")
+
     '''
-    def __init__(self):
+    def __init__(self, memoryCapacity: int = None, memoryItemSize: int = 1048576):
         self.home = pathlib.Path.home()
-        self.store = StorageArea(str(self.home / 'EuclidCache'))
+        self.store = StorageArea(str(self.home / 'EuclidCache'), memoryCapacity=memoryCapacity,
+                                 memoryItemSize=memoryItemSize)
         self.context = self.store.addContext('files', True)
 
-    def load(self, url: str):
-        self.context.load(url, True)
-        self.context.refresh()
+    def load(self, url: str, workers: int = 1, hostLimit: int = 0, progress=None) -> dict:
+        self.context.load(url, True, True)
+        return self.context.refresh(workers, hostLimit, progress)
 
     def get(self, file: str):
         return self.context.getFile(file)
 
+    def read(self, file: str) -> bytes:
+        return self.context.getBytes(file)
+
+    def map(self, file: str):
+        return self.context.mapFile(file)
+
+    def array(self, file: str, dtype, offset: int = 0, count: int = -1, shape: tuple = None):
+        return self.context.arrayFile(file, dtype, offset, count, shape)
+
     def files(self):
         return self.context.listFiles()
 
+    def close(self):
+        self.store.close()
+
     def destroy(self):
         self.context.purge()
         self.store.deleteContext('files')
 
+class AsyncSimpleCache(object):
+    '''
+    Awaitable version of SimpleCache for asyncio applications, sharing the same
+    EuclidCache directory, e.g.:
+
+    S = FileCache.AsyncSimpleCache()
+    await S.load("http://vospace.esac.esa.int/vospace/sh/5e558f8785e775a165124178f045ba7c52e49552?dl=1")
+    fits_image_filename = fits.open(await S.get("ick906030_prev.fits"))
+
+    '''
+    def __init__(self, concurrency: int = 8):
+        self.cache = SimpleCache()
+        self.context = AsyncContext(self.cache.context, concurrency)
+
+    async def load(self, url: str, progress=None) -> dict:
+        await self.context.load(url, True, True)
+        return await self.context.refresh(progress)
+
+    async def get(self, file: str):
+        return await self.context.getFile(file)
+
+    def files(self):
+        return self.cache.files()
+
+    def close(self):
+        self.context.close()
+        self.cache.close()
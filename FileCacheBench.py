@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of the FileCache hot paths against an in-process HTTP server serving
+synthetic files, so that runs are reproducible and need no network.
+
+Each benchmark is repeated and the timings of every run are reported, together
+with their minimum, median, mean and standard deviation, as JSON. Passing the
+output of an earlier run with --compare prints the change of each median and
+fails if any benchmark slowed down by more than --threshold.
+
+    python FileCacheBench.py --files 200 --size 65536 --output before.json
+    python FileCacheBench.py --files 200 --size 65536 --compare before.json
+'''
+
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import statistics
+
+from StorageArea import StorageArea
+from StandInServer import StandInServer
+
+# Version of the results format
+FORMAT = 1
+
+class Bench(object):
+    '''
+    Bench - sets up areas and contexts for the benchmarks and times them
+    '''
+
+    def __init__(self, server: StandInServer, files: int, size: int, contexts: int, workers: int):
+        self.server = server
+        self.files = files
+        self.size = size
+        self.contexts = contexts
+        self.workers = workers
+        self.urls = [server.addSynthetic("/bench/" + str(i), size, i) for i in range(files)]
+        self.root = tempfile.mkdtemp(prefix="FileCacheBench")
+
+    def area(self, **kwargs) -> StorageArea:
+        '''
+        Open a new, empty StorageArea
+        '''
+        return StorageArea(tempfile.mkdtemp(dir=self.root), **kwargs)
+
+    def populate(self, area: StorageArea, name: str = "bench"):
+        '''
+        Add a context holding every synthetic file to area
+        '''
+        ctxt = area.addContext(name)
+        for i, url in enumerate(self.urls):
+            ctxt.addFile(url, "f" + str(i))
+        ctxt.flush()
+        return ctxt
+
+    def getFileCold(self) -> tuple:
+        ctxt = self.populate(self.area())
+        start = time.perf_counter()
+        for i in range(self.files):
+            ctxt.getFile("f" + str(i))
+        elapsed = time.perf_counter() - start
+        ctxt.store.close()
+        return elapsed, self.files
+
+    def getFileWarm(self) -> tuple:
+        ctxt = self.populate(self.area())
+        ctxt.refresh(self.workers)
+        start = time.perf_counter()
+        for i in range(self.files):
+            ctxt.getFile("f" + str(i))
+        elapsed = time.perf_counter() - start
+        ctxt.store.close()
+        return elapsed, self.files
+
+    def refresh(self) -> tuple:
+        ctxt = self.populate(self.area())
+        start = time.perf_counter()
+        ctxt.refresh(self.workers)
+        elapsed = time.perf_counter() - start
+        ctxt.store.close()
+        return elapsed, self.files
+
+    def openArea(self) -> tuple:
+        area = self.area()
+        for i in range(self.contexts):
+            self.populate(area, "c" + str(i))
+        area.close()
+        start = time.perf_counter()
+        StorageArea(str(area.storagePath)).close()
+        return time.perf_counter() - start, self.contexts
+
+    def openAreaLazy(self) -> tuple:
+        area = self.area()
+        for i in range(self.contexts):
+            self.populate(area, "c" + str(i))
+        area.close()
+        start = time.perf_counter()
+        StorageArea(str(area.storagePath), lazy=True).close()
+        return time.perf_counter() - start, self.contexts
+
+    def writeDescriptor(self) -> tuple:
+        ctxt = self.populate(self.area())
+        start = time.perf_counter()
+        ctxt.writeDescriptor()
+        elapsed = time.perf_counter() - start
+        ctxt.store.close()
+        return elapsed, 1
+
+    def addFile(self) -> tuple:
+        ctxt = self.area().addContext("bench")
+        start = time.perf_counter()
+        for i, url in enumerate(self.urls):
+            ctxt.addFile(url, "f" + str(i))
+        elapsed = time.perf_counter() - start
+        ctxt.store.close()
+        return elapsed, self.files
+
+    def eviction(self) -> tuple:
+        '''
+        Cold retrieval in an area only half the size of the data, so that every
+        file beyond the first half evicts another
+        '''
+        ctxt = self.populate(self.area(capacity=self.size * max(1, self.files // 2)))
+        start = time.perf_counter()
+        for i in range(self.files):
+            ctxt.getFile("f" + str(i))
+        elapsed = time.perf_counter() - start
+        ctxt.store.close()
+        return elapsed, self.files
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+# Benchmarks in the order they run
+BENCHMARKS = ('getFileCold', 'getFileWarm', 'refresh', 'addFile', 'writeDescriptor',
+              'eviction', 'openArea', 'openAreaLazy')
+
+def summarise(runs: list, operations: int) -> dict:
+    '''
+    Return the statistics of the timings of a benchmark
+    '''
+    median = statistics.median(runs)
+    return {'runs': runs, 'operations': operations, 'unit': 's',
+            'min': min(runs), 'median': median, 'mean': statistics.mean(runs),
+            'stdev': statistics.stdev(runs) if len(runs) > 1 else 0.0,
+            'perOperation': median / operations if operations else None}
+
+def run(args) -> dict:
+    '''
+    Run the selected benchmarks and return the results document
+    '''
+    server = StandInServer(args.latency)
+    bench = Bench(server, args.files, args.size, args.contexts, args.workers)
+    results = {}
+    try:
+        for name in args.only or BENCHMARKS:
+            runs = []
+            for repeat in range(args.repeat):
+                elapsed, operations = getattr(bench, name)()
+                runs.append(elapsed)
+            results[name] = summarise(runs, operations)
+            print(name + ": median " + format(results[name]['median'], '.4f') + " s", file=sys.stderr)
+    finally:
+        bench.close()
+        server.stop()
+
+    return {'format': FORMAT, 'timestamp': time.time(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'parameters': {'files': args.files, 'size': args.size, 'latency': args.latency,
+                           'contexts': args.contexts, 'workers': args.workers, 'repeat': args.repeat},
+            'results': results}
+
+def compare(current: dict, baseline: dict, threshold: float) -> bool:
+    '''
+    Print the change of each median relative to baseline. Returns False if any
+    benchmark is slower by more than threshold (a ratio, e.g. 1.2)
+    '''
+    if current['parameters'] != baseline['parameters']:
+        print("Warning: parameters differ from the baseline", file=sys.stderr)
+
+    passed = True
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        ratio = result['median'] / before['median'] if before['median'] > 0 else float('inf')
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            passed = False
+        print("%-16s %10.4f %10.4f %6.2fx%s" % (name, before['median'], result['median'], ratio, flag),
+              file=sys.stderr)
+    return passed
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark FileCache against a local HTTP server")
+    parser.add_argument('--files', type=int, default=100, help="number of files per context")
+    parser.add_argument('--size', type=int, default=65536, help="size of each file in bytes")
+    parser.add_argument('--latency', type=float, default=0.0, help="server delay per request in seconds")
+    parser.add_argument('--contexts', type=int, default=20, help="number of contexts for openArea")
+    parser.add_argument('--workers', type=int, default=4, help="workers for refresh")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each benchmark")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help="benchmarks to run")
+    parser.add_argument('--output', help="file to write the results to, standard output by default")
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.2, help="slowdown ratio treated as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    document = json.dumps(results, indent=4)
+    if args.output is None:
+        print(document)
+    else:
+        with open(args.output, 'w') as handle:
+            handle.write(document)
+            handle.close()
+
+    if args.compare is not None:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+            handle.close()
+        if not compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    logging.getLogger('FileCache').disabled = True
+    sys.exit(main())
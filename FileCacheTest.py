@@ -13,13 +13,44 @@ import inspect
 import shutil
 import os
 import stat
+import hashlib
+import json
+import threading
+import time
+import asyncio
+import contextlib
+import struct
+import io
+import urllib.error
+import gzip
+import sqlite3
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import FileCache
+import FileCacheBench
+from StandInServer import StandInServer, StandInHandler
+from Throttle import INTERACTIVE, BULK, PREFETCH
+from Verifier import Verifier
+from FileLock import FileLock
 
 class FileCacheTest(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
     def setUp(self):
         self.home = pathlib.Path.home()
+        self.server.reset()
 
     def test_initEmpty(self):
         path = self.home / getUid()
@@ -274,6 +305,1326 @@ class FileCacheTest(unittest.TestCase):
         S.listContexts()
         shutil.rmtree(str(self.home / 'EuclidCache'))
 
+    def test_refreshParallel(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        for url, filename in makeSources(src, 12):
+            C1.addFile(url, filename)
+        C1.addFile((src / "missing.dat").as_uri(), "missing.dat")
+        seen = []
+        report = C1.refresh(workers=4, hostLimit=2, progress=lambda f, r, d, t: seen.append((f, d, t)))
+        self.assertEqual(len(report), 13)
+        self.assertEqual(len(seen), 13)
+        self.assertEqual(report["missing.dat"]['status'], 'failed')
+        for i in range(12):
+            self.assertEqual(report["f" + str(i) + ".dat"]['status'], 'retrieved')
+            self.assertTrue(os.path.isfile(report["f" + str(i) + ".dat"]['path']))
+        report = C1.refresh(workers=4)
+        self.assertEqual(report["f0.dat"]['status'], 'cached')
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_journal(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        S1 = FileCache.StorageArea(str(path))
+        ctxt = getUid()
+        C1 = S1.addContext(ctxt)
+        for url, filename in makeSources(src, 5):
+            C1.addFile(url, filename)
+        C1.getFile("f0.dat")
+        C1.deleteFile("f4.dat")
+        self.assertFalse((C1.path / "desc.json").exists())
+        self.assertEqual(len((C1.path / "desc.log").read_text().splitlines()), 7)
+
+        # Reopening replays the journal and keeps the loaded state
+        S2 = FileCache.StorageArea(str(path))
+        C2 = S2.contexts[ctxt]
+        self.assertEqual(len(C2.descriptor['files']), 4)
+        self.assertTrue(C2.descriptor['files']["f0.dat"]['loaded'])
+
+        with S2:
+            C2.addFile(src.as_uri() + "/f4.dat", "f4.dat")
+        self.assertEqual((C2.path / "desc.log").read_text(), "")
+        S3 = FileCache.StorageArea(str(path))
+        self.assertEqual(len(S3.contexts[ctxt].descriptor['files']), 5)
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_getFileIntegrity(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        S1 = FileCache.StorageArea(str(path), chunkSize=64)
+        C1 = S1.addContext(getUid())
+        url, filename = makeSources(src, 1)[0]
+        C1.addFile(url, filename)
+        local = C1.getFile(filename)
+        entry = C1.descriptor['files'][filename]
+        self.assertEqual(entry['size'], 1000)
+        self.assertEqual(entry['sha256'], hashlib.sha256((src / filename).read_bytes()).hexdigest())
+        self.assertFalse(os.path.exists(local + ".part"))
+
+        # A truncated file is noticed and retrieved again
+        with open(local, 'r+b') as handle:
+            handle.truncate(10)
+        self.assertEqual(C1.getFile(filename), local)
+        self.assertEqual(os.path.getsize(local), 1000)
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_getFileResume(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        data = os.urandom(100000)
+        url = self.server.add("/big.dat", data)
+        C1.addFile(url, "big.dat")
+
+        # Leave a partial download behind as an interrupted run would
+        (C1.path / "big.dat.part").write_bytes(data[:40000])
+        (C1.path / "big.dat.part.json").write_text(json.dumps({'url': url, 'etag': StandInHandler.etag(data)}))
+
+        local = C1.getFile("big.dat")
+        self.assertEqual(pathlib.Path(local).read_bytes(), data)
+        self.assertEqual(self.server.requests[-1][1].get('Range'), 'bytes=40000-')
+        self.assertEqual(C1.descriptor['files']["big.dat"]['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertFalse((C1.path / "big.dat.part").exists())
+        self.assertFalse((C1.path / "big.dat.part.json").exists())
+        shutil.rmtree(str(path))
+
+    def test_getFileResumeUnsupported(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        data = os.urandom(50000)
+        url = self.server.add("/big.dat", data)
+        C1.addFile(url, "big.dat")
+        self.server.ranges = False
+        (C1.path / "big.dat.part").write_bytes(data[:20000])
+        (C1.path / "big.dat.part.json").write_text(json.dumps({'url': url, 'etag': StandInHandler.etag(data)}))
+        local = C1.getFile("big.dat")
+        self.assertEqual(pathlib.Path(local).read_bytes(), data)
+
+        # A stale partial file with a different validator is discarded
+        self.server.ranges = True
+        (C1.path / "big.dat.part").write_bytes(os.urandom(20000))
+        (C1.path / "big.dat.part.json").write_text(json.dumps({'url': url, 'etag': '"stale"'}))
+        local = C1.getFile("big.dat", True)
+        self.assertEqual(pathlib.Path(local).read_bytes(), data)
+        shutil.rmtree(str(path))
+
+    def test_capacityLRU(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        S1 = FileCache.StorageArea(str(path), capacity=2500)
+        C1 = S1.addContext(getUid())
+        for url, filename in makeSources(src, 4):
+            C1.addFile(url, filename)
+        C1.getFile("f0.dat")
+        C1.getFile("f1.dat")
+        C1.getFile("f0.dat")
+        C1.getFile("f2.dat")
+        files = C1.descriptor['files']
+        self.assertFalse(files["f1.dat"]['loaded'])
+        self.assertFalse((C1.path / "f1.dat").exists())
+        self.assertTrue(files["f0.dat"]['loaded'])
+        self.assertTrue(files["f2.dat"]['loaded'])
+        self.assertEqual(S1.usage(), (2000, 2))
+
+        # An evicted file is retrieved again transparently
+        self.assertTrue(os.path.isfile(C1.getFile("f1.dat")))
+        self.assertFalse(files["f0.dat"]['loaded'])
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_capacityQuota(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        S1 = FileCache.StorageArea(str(path), policy='lfu')
+        C1 = S1.addContext(getUid())
+        C2 = S1.addContext(getUid())
+        for url, filename in makeSources(src, 3):
+            C1.addFile(url, filename)
+            C2.addFile(url, filename)
+        C2.refresh()
+        C1.refresh()
+        C1.getFile("f0.dat")
+        C1.setQuota(maxFiles=1)
+        self.assertEqual(S1.usage([C1]), (1000, 1))
+        self.assertTrue(C1.descriptor['files']["f0.dat"]['loaded'])
+        self.assertEqual(S1.usage([C2]), (3000, 3))
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_getFileRevalidate(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        data = os.urandom(5000)
+        C1.addFile(self.server.add("/a.dat", data), "a.dat")
+        C1.addFile(self.server.add("/b.dat", data), "b.dat")
+        local = C1.getFile("a.dat")
+        C1.setTTL(0)
+
+        # Stale but unchanged: a conditional request and no body
+        mtime = os.path.getmtime(local)
+        self.assertEqual(C1.getFile("a.dat"), local)
+        self.assertEqual(self.server.requests[-1][1].get('If-None-Match'), StandInHandler.etag(data))
+        self.assertEqual(os.path.getmtime(local), mtime)
+
+        # Changed at the source: transferred again
+        update = os.urandom(6000)
+        self.server.add("/a.dat", update)
+        report = C1.refresh(staleOnly=True)
+        self.assertEqual(list(report.keys()), ["a.dat"])
+        self.assertEqual(report["a.dat"]['status'], 'retrieved')
+        self.assertEqual(pathlib.Path(local).read_bytes(), update)
+        self.assertFalse(C1.descriptor['files']["b.dat"]['loaded'])
+
+        # A per-file TTL overrides that of the context
+        C1.setTTL(3600, "a.dat")
+        count = len(self.server.requests)
+        C1.getFile("a.dat")
+        self.assertEqual(len(self.server.requests), count)
+        shutil.rmtree(str(path))
+
+    def test_connectionReuse(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), retries=2)
+        S1.pool.backoff = 0.01
+        C1 = S1.addContext(getUid())
+        C2 = S1.addContext(getUid())
+        for i in range(5):
+            url = self.server.add("/r" + str(i), os.urandom(2000))
+            C1.addFile(url, "r" + str(i))
+            C2.addFile(url, "r" + str(i))
+        C1.refresh()
+        C2.refresh()
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertEqual(len(set(port for name, headers, port in self.server.requests)), 1)
+
+        # Transient failures are retried
+        self.server.failures["/r0"] = 2
+        self.assertIsNotNone(C1.getFile("r0", True))
+        self.server.failures["/r1"] = 3
+        self.assertIsNone(C1.getFile("r1", True))
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_redirectWithoutLocation(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        url = self.server.add("/moved", b'body')
+        self.server.redirects["/moved"] = None
+        with self.assertRaises(urllib.error.HTTPError):
+            S1.pool.open(url)
+        C1.addFile(url, "moved")
+        self.assertIsNone(C1.getFile("moved"))
+        self.assertFalse(C1.descriptor['files']["moved"]['loaded'])
+        self.assertFalse(os.path.exists(str(C1.path / "moved")))
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_redirectLoop(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        url = self.server.add("/loop", b'body')
+        self.server.redirects["/loop"] = "/loop"
+        with self.assertRaises(urllib.error.HTTPError):
+            S1.pool.open(url)
+        C1.addFile(url, "loop")
+        self.assertIsNone(C1.getFile("loop"))
+        self.assertFalse(C1.descriptor['files']["loop"]['loaded'])
+        self.assertEqual(len(self.server.requests), 2 * (S1.pool.maxRedirects + 1))
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_initLazy(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        names = [getUid() for i in range(3)]
+        for name in names:
+            S1.addContext(name).addFile("http://localhost/" + name, name)
+
+        S2 = FileCache.StorageArea(str(path), lazy=True)
+        self.assertEqual(sorted(S2.contexts.keys()), sorted(names))
+        self.assertFalse(any(ctxt.restored for ctxt in S2.contexts.values()))
+        self.assertIn(names[0], S2.contexts[names[0]].descriptor['files'])
+        self.assertTrue(S2.contexts[names[0]].restored)
+        self.assertFalse(S2.contexts[names[1]].restored)
+
+        S3 = FileCache.StorageArea(str(path), lazy=True, prefetch=True)
+        S3.warmer.join()
+        self.assertTrue(all(ctxt.restored for ctxt in S3.contexts.values()))
+        shutil.rmtree(str(path))
+
+    def test_sharedArea(self):
+        area = getUid()
+        path = self.home / area
+        ctxt = getUid()
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(ctxt)
+        data = os.urandom(20000)
+        C1.addFile(self.server.add("/shared.dat", data), "shared.dat")
+
+        # Each opening of the area stands in for a separate process
+        areas = [FileCache.StorageArea(str(path)) for i in range(4)]
+        self.server.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda S: results.append(S.contexts[ctxt].getFile("shared.dat")), args=(S,))
+                   for S in areas]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(pathlib.Path(results[0]).read_bytes(), data)
+
+        # Updates from different openings are merged rather than overwritten
+        self.server.delay = 0.0
+        areas[0].contexts[ctxt].addFile("http://localhost/a", "a")
+        areas[1].contexts[ctxt].addFile("http://localhost/b", "b")
+        areas[0].contexts[ctxt].writeDescriptor()
+        areas[2].contexts[ctxt].deleteFile("a")
+        areas[3].contexts[ctxt].flush()
+        S2 = FileCache.StorageArea(str(path))
+        self.assertEqual(sorted(S2.contexts[ctxt].descriptor['files'].keys()), ["b", "shared.dat"])
+        self.assertTrue(S2.contexts[ctxt].descriptor['files']["shared.dat"]['loaded'])
+        shutil.rmtree(str(path))
+
+    def test_asyncContext(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        for i in range(3):
+            C1.addFile(self.server.add("/as" + str(i), os.urandom(3000)), "as" + str(i))
+        self.server.delay = 0.1
+
+        A = FileCache.AsyncContext(C1, 2)
+
+        async def main():
+            paths = await asyncio.gather(*[A.getFile("as" + str(i % 3)) for i in range(60)])
+            report = await A.refresh()
+            return paths, report
+
+        paths, report = asyncio.run(main())
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(set(paths)), 3)
+        self.assertEqual(set(result['status'] for result in report.values()), {'cached'})
+        self.assertTrue(all(entry['loaded'] for entry in C1.descriptor['files'].values()))
+
+        # The same AsyncContext serves another event loop
+        self.assertEqual(asyncio.run(main())[0], paths)
+        A.close()
+        shutil.rmtree(str(path))
+
+    def test_asyncCancel(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        C1.addFile(self.server.add("/slow", os.urandom(3000)), "slow")
+        self.server.delay = 0.3
+
+        async def main():
+            A = FileCache.AsyncContext(C1)
+            task = asyncio.ensure_future(A.getFile("slow"))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.5)
+            A.close()
+
+        asyncio.run(main())
+        self.assertFalse(C1.descriptor['files']["slow"]['loaded'])
+        self.server.delay = 0.0
+        self.assertIsNotNone(C1.getFile("slow"))
+        shutil.rmtree(str(path))
+
+    def test_dedup(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), dedup=True)
+        data = os.urandom(8000)
+        url = self.server.add("/dup.dat", data)
+        C1 = S1.addContext(getUid())
+        C1.addFile(url, "dup.dat")
+        first = C1.getFile("dup.dat")
+        sha = C1.descriptor['files']["dup.dat"]['sha256']
+
+        # A known hash is linked without any transfer
+        export = str(path) + ".json"
+        C1.export(export)
+        C2 = S1.addContext(getUid())
+        C2.load(export)
+        os.remove(export)
+        second = C2.getFile("dup.dat")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(os.path.samefile(first, second))
+
+        # Content retrieved again is folded into the existing blob
+        C3 = S1.addContext(getUid())
+        C3.addFile(url, "copy.dat")
+        third = C3.getFile("copy.dat")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertTrue(os.path.samefile(first, third))
+        self.assertEqual(S1.blobs.references(sha), 3)
+
+        # Shared content is counted once, and evicting a reference frees nothing
+        self.assertEqual(S1.usage(), (8000, 3))
+        self.assertEqual(S1.usage([C1, C2]), (8000, 2))
+        self.assertEqual(C3.usage(), (8000, 1))
+        self.assertEqual(C3.evictFile("copy.dat"), 0)
+        self.assertEqual(S1.usage(), (8000, 2))
+        self.assertIsNotNone(C3.getFile("copy.dat"))
+        S2 = FileCache.StorageArea(str(path), dedup=True, metadata='sqlite')
+        self.assertEqual(S2.usage(), (8000, 3))
+        S2.close()
+
+        # The blob goes with the last reference
+        C1.deleteFile("dup.dat")
+        C2.purge()
+        self.assertTrue(S1.blobs.has(sha))
+        S1.deleteContext(C3.descriptor['name'])
+        self.assertFalse(S1.blobs.has(sha))
+        self.assertEqual(sorted(FileCache.StorageArea(str(path)).contexts.keys()),
+                         sorted([C1.descriptor['name'], C2.descriptor['name']]))
+        shutil.rmtree(str(path))
+
+    def test_metadataIndex(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        sources = makeSources(src, 4)
+
+        # Start from desc.json descriptors, which are imported into the index
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext("one")
+        for url, filename in sources:
+            C1.addFile(url, filename)
+        C1.getFile("f0.dat")
+
+        # Opened lazily, contexts are still imported before area-wide queries
+        S0 = FileCache.StorageArea(str(path), metadata='sqlite', lazy=True)
+        self.assertEqual(S0.findFile("f0.dat"), ["one"])
+        self.assertEqual(S0.usage(), (1000, 1))
+        S0.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            S0.index.findFile("f0.dat")
+
+        S2 = FileCache.StorageArea(str(path), metadata='sqlite')
+        self.assertTrue((path / "index.db").is_file())
+        C2 = S2.addContext("two")
+        for url, filename in sources[1:]:
+            C2.addFile(url, filename)
+        C2.getFile("f1.dat")
+        S2.contexts["one"].deleteFile("f3.dat")
+        self.assertEqual(S2.findFile("f1.dat"), ["one", "two"])
+        self.assertEqual(S2.findFile("f3.dat"), ["two"])
+        self.assertEqual(S2.findURL(sources[2][0]), [("one", "f2.dat"), ("two", "f2.dat")])
+        self.assertEqual(S2.unloaded(), [("one", "f1.dat"), ("one", "f2.dat"), ("two", "f2.dat"), ("two", "f3.dat")])
+        self.assertEqual(S2.usage(), (2000, 2))
+        self.assertEqual(S2.usage([C2]), (1000, 1))
+
+        # Reopening reads everything back from the index
+        S3 = FileCache.StorageArea(str(path), metadata='sqlite')
+        self.assertEqual(sorted(S3.contexts["one"].descriptor['files'].keys()), ["f0.dat", "f1.dat", "f2.dat"])
+        self.assertTrue(S3.contexts["two"].descriptor['files']["f1.dat"]['loaded'])
+
+        # Descriptors still move in and out as JSON
+        export = str(path) + ".json"
+        S3.contexts["two"].export(export)
+        C4 = S3.addContext("three")
+        C4.load(export)
+        os.remove(export)
+        self.assertEqual(S3.findFile("f3.dat"), ["three", "two"])
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_logLevel(self):
+        path = self.home / getUid()
+        other = self.home / getUid()
+        logger = logging.getLogger('FileCache')
+        try:
+            FileCache.StorageArea(str(path), logLevel=logging.DEBUG)
+            # Areas opened without a level leave it alone
+            FileCache.StorageArea(str(other))
+            self.assertEqual(logger.level, logging.DEBUG)
+        finally:
+            logger.setLevel(logging.ERROR)
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(other))
+
+    def test_metrics(self):
+        area = getUid()
+        path = self.home / area
+        metricsFile = str(self.home / (area + ".prom"))
+        S1 = FileCache.StorageArea(str(path), retries=1, metricsFile=metricsFile)
+        S1.pool.backoff = 0.01
+        name = getUid()
+        C1 = S1.addContext(name)
+        url = self.server.add("/t0", os.urandom(3000))
+        C1.addFile(url, "t0")
+        C1.addFile(self.server.add("/t1", os.urandom(1000)), "t1")
+
+        spans = []
+        @contextlib.contextmanager
+        def tracer(spanName, attributes):
+            spans.append((spanName, dict(attributes)))
+            yield
+
+        S1.metrics.addTracer(tracer)
+        C1.getFile("t0")
+        C1.getFile("t0")
+        self.server.failures["/t1"] = 1
+        C1.getFile("t1")
+        C1.evictFile("t1")
+        C1.writeDescriptor()
+
+        counters = S1.metrics.snapshot()['counters']
+        self.assertEqual(counters['hits'], {name: 1})
+        self.assertEqual(counters['misses'], {name: 2})
+        self.assertEqual(counters['downloads'], {name: 2})
+        self.assertEqual(counters['bytes'], {name: 4000})
+        self.assertEqual(counters['retries'], {None: 1})
+        self.assertEqual(counters['evictions'], {name: 1})
+        self.assertEqual(counters['descriptorWrites'], {name: 1})
+        self.assertAlmostEqual(S1.metrics.hitRate(name), 1 / 3)
+        histogram = S1.metrics.snapshot()['histograms']['download'][name]
+        self.assertEqual(histogram['count'], 2)
+        self.assertEqual(spans[0], ('download', {'url': url, 'filename': "t0", 'context': name}))
+        self.assertEqual([span[0] for span in spans], ['download', 'download', 'descriptorWrite'])
+
+        S1.close()
+        with open(metricsFile) as handle:
+            exposition = handle.read()
+        self.assertIn('filecache_hits_total{context="' + name + '"} 1', exposition)
+        self.assertIn('filecache_retries_total 1', exposition)
+        self.assertIn('filecache_download_seconds_count{context="' + name + '"} 2', exposition)
+        self.assertIn('filecache_download_seconds_bucket{context="' + name + '",le="+Inf"} 2', exposition)
+        os.remove(metricsFile)
+        shutil.rmtree(str(path))
+
+    def test_compression(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        text = b"<TR><TD>1.0</TD><TD>2.0</TD></TR>\n" * 2000
+        binary = os.urandom(5000)
+        self.server.gzip = True
+        C1.addFile(self.server.add("/t.vot", text), "t.vot")
+        C1.addFile(self.server.add("/b.bin", binary), "b.bin")
+        C1.setCompression([("*.lzma", "lzma")])
+        self.assertNotIn('compression', C1.descriptor)
+        C1.setCompression([("*.vot", "gzip")])
+
+        # The transfer is compressed, and so is the stored copy
+        local = C1.getFile("t.vot")
+        self.assertEqual(pathlib.Path(local).read_bytes(), text)
+        self.assertEqual(self.server.requests[-1][1].get('Accept-Encoding'), 'gzip')
+        self.assertLess(S1.metrics.snapshot()['counters']['bytes'][C1.name], len(text) / 5)
+        entry = C1.descriptor['files']["t.vot"]
+        self.assertEqual(entry['codec'], 'gzip')
+        self.assertEqual(entry['size'], len(text))
+        self.assertEqual(entry['sha256'], hashlib.sha256(text).hexdigest())
+        self.assertLess(entry['storedSize'], len(text) / 5)
+        self.assertEqual(S1.usage([C1]), (entry['storedSize'] + len(text), 1))
+
+        # Plain copies are removed, and made again on demand without a transfer
+        self.assertEqual(C1.compact(), len(text))
+        self.assertFalse(os.path.exists(local))
+        self.assertEqual(S1.usage([C1]), (entry['storedSize'], 1))
+        count = len(self.server.requests)
+        with C1.openFile("t.vot") as handle:
+            self.assertEqual(handle.read(), text)
+        self.assertEqual(C1.getFile("t.vot"), local)
+        self.assertEqual(pathlib.Path(local).read_bytes(), text)
+        self.assertEqual(len(self.server.requests), count)
+
+        # Files which match no rule are stored as they are
+        self.assertEqual(pathlib.Path(C1.getFile("b.bin")).read_bytes(), binary)
+        self.assertNotIn('codec', C1.descriptor['files']["b.bin"])
+
+        # A refresh keeps only the compressed copy
+        C1.evictFile("t.vot")
+        self.assertEqual(C1.refreshFile("t.vot")['status'], 'retrieved')
+        self.assertFalse(os.path.exists(local))
+        self.assertEqual(C1.getFile("t.vot"), local)
+
+        # Gzip files are neither asked for encoded nor decoded
+        packed = gzip.compress(text, mtime=0)
+        C1.addFile(self.server.add("/p.vot.gz", packed), "p.vot.gz")
+        self.assertEqual(pathlib.Path(C1.getFile("p.vot.gz")).read_bytes(), packed)
+        self.assertNotIn('gzip', self.server.requests[-1][1].get('Accept-Encoding', ''))
+
+        # Contexts without compression take transfers as they are
+        C2 = S1.addContext(getUid())
+        C2.addFile(self.server.add("/t2.vot", text), "t2.vot")
+        self.assertEqual(pathlib.Path(C2.getFile("t2.vot")).read_bytes(), text)
+        self.assertNotIn('gzip', self.server.requests[-1][1].get('Accept-Encoding', ''))
+        self.assertEqual(S1.metrics.snapshot()['counters']['bytes'][C2.name], len(text))
+
+        exported = str(self.home / (area + ".json"))
+        C1.export(exported)
+        with open(exported) as handle:
+            desc = json.load(handle)
+        self.assertNotIn('compression', desc)
+        self.assertNotIn('codec', desc['files']["t.vot"])
+        os.remove(exported)
+
+        stored = entry['stored']
+        C1.evictFile("t.vot")
+        self.assertFalse(os.path.exists(stored))
+        shutil.rmtree(str(path))
+
+    def test_compressedCapacity(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), capacity=3000)
+        C1 = S1.addContext(getUid())
+        C1.setCompression([("*.txt", "gzip")])
+        for i in range(5):
+            C1.addFile(self.server.add("/k" + str(i) + ".txt", bytes([65 + i]) * 2000), "k" + str(i) + ".txt")
+
+        # Plain copies made on demand count against the capacity
+        for i in range(5):
+            self.assertIsNotNone(C1.getFile("k" + str(i) + ".txt"))
+            self.assertLessEqual(S1.usage()[0], 3000)
+
+        # Evicting frees the compressed copy and any plain one
+        held = C1.descriptor['files']["k4.txt"]['storedSize'] + 2000
+        self.assertEqual(S1.usage(), (held, 1))
+        self.assertEqual(C1.evictFile("k4.txt"), held)
+
+        # A single eviction does not pass for the whole overflow
+        S1.capacity = 50
+        for i in range(3):
+            with C1.openFile("k" + str(i) + ".txt") as handle:
+                handle.read()
+        used, count = S1.usage()
+        self.assertLessEqual(used, 50)
+        shutil.rmtree(str(path))
+
+    def test_usageTotals(self):
+        path = self.home / getUid()
+        name = getUid()
+        S1 = FileCache.StorageArea(str(path), capacity=2500)
+        C1 = S1.addContext(name)
+        C1.addFiles([(self.server.add("/u" + str(i), os.urandom(1000)), "u" + str(i)) for i in range(6)])
+
+        def counted(ctxt):
+            held = [entry['size'] for entry in ctxt.descriptor['files'].values() if entry['loaded'] is True]
+            return sum(held), len(held)
+
+        # Totals follow retrievals and evictions without being worked out again
+        C1.getFile("u0")
+        totals = C1._held
+        for i in range(1, 6):
+            C1.getFile("u" + str(i))
+            self.assertEqual(C1.usage(), counted(C1))
+        self.assertIs(C1._held, totals)
+        self.assertEqual(S1.usage(), (2000, 2))
+        C1.deleteFile("u5")
+        self.assertEqual(C1.usage(), (1000, 1))
+
+        # And changes of other processes are picked up
+        S2 = FileCache.StorageArea(str(path))
+        S2.contexts[name].getFile("u0")
+        C1.sync()
+        self.assertEqual(C1.usage(), counted(C1))
+        self.assertEqual(C1.usage(), (2000, 2))
+        shutil.rmtree(str(path))
+
+    def test_tiers(self):
+        shared = self.home / getUid()
+        local1 = self.home / getUid()
+        local2 = self.home / getUid()
+        name = getUid()
+        data = [os.urandom(1000) for i in range(3)]
+        urls = [self.server.add("/tier" + str(i), data[i]) for i in range(3)]
+
+        # The first node retrieves the file and writes it through to the shared tier
+        S1 = FileCache.StorageArea(str(local1), tiers=[str(shared)])
+        C1 = S1.addContext(name)
+        for i in range(3):
+            C1.addFile(urls[i], "t" + str(i))
+        C1.getFile("t0")
+        self.assertEqual(len(self.server.requests), 1)
+        S1.close()
+
+        # The second node fills from the shared tier without a transfer
+        S2 = FileCache.StorageArea(str(local2), capacity=1500, tiers=[str(shared)], writeThrough=False)
+        C2 = S2.addContext(name)
+        for i in range(3):
+            C2.addFile(urls[i], "t" + str(i))
+        self.assertEqual(pathlib.Path(C2.getFile("t0")).read_bytes(), data[0])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(S2.metrics.snapshot()['counters']['tierHits'], {name: 1})
+
+        # Files evicted under pressure are demoted to the shared tier
+        C2.getFile("t1")
+        self.assertFalse(C2.descriptor['files']["t0"]['loaded'])
+        C2.getFile("t2")
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(S2.metrics.snapshot()['counters']['demotions'], {name: 1})
+        self.assertIsNotNone(S2.tiers[0].findContext(name).peekFile("t1"))
+        self.assertIsNone(S2.tiers[0].findContext(name).peekFile("t2"))
+        C2.getFile("t1")
+        self.assertEqual(len(self.server.requests), 3)
+        S2.close()
+
+        # A read-only area serves the files it holds
+        S3 = FileCache.StorageArea(str(shared))
+        C3 = S3.contexts[name]
+        C3.addFile(self.server.add("/tier3", os.urandom(10)), "t3")
+        S3.writable = False
+        self.assertEqual(pathlib.Path(C3.getFile("t0")).read_bytes(), data[0])
+        self.assertIsNone(C3.getFile("t3"))
+        self.assertEqual(len(self.server.requests), 3)
+        for path in (shared, local1, local2):
+            shutil.rmtree(str(path))
+
+    def test_getRange(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), blockSize=1000)
+        C1 = S1.addContext(getUid())
+        data = os.urandom(10000)
+        C1.addFile(self.server.add("/cube.fits", data), "cube.fits")
+
+        # A range past the end of a file nothing is held of yet is empty
+        C1.addFile(self.server.add("/small.fits", data[:1000]), "small.fits")
+        self.assertEqual(C1.getRange("small.fits", 10 ** 7, 10), b'')
+        self.assertEqual(C1.getRange("small.fits", 990, 100), data[990:1000])
+        self.assertEqual(C1.getRange("small.fits", 5000, 10), b'')
+        del self.server.requests[:]
+
+        # Only the blocks covering a range are retrieved, and kept
+        self.assertEqual(C1.getRange("cube.fits", 0, 80), data[:80])
+        self.assertEqual(self.server.requests[-1][1].get('Range'), 'bytes=0-999')
+        self.assertEqual(C1.getRange("cube.fits", 500, 100), data[500:600])
+        self.assertEqual(C1.getRange("cube.fits", 2500, 3000), data[2500:5500])
+        self.assertEqual(self.server.requests[-1][1].get('Range'), 'bytes=2000-5999')
+        self.assertEqual(self.server.requests[-1][1].get('If-Range'), StandInHandler.etag(data))
+        self.assertEqual(C1.getRange("cube.fits", 9990, 100), data[9990:])
+        self.assertEqual(C1.getRange("cube.fits", 20000, 10), b'')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertFalse(C1.descriptor['files']["cube.fits"]['loaded'])
+
+        # Which blocks are held is local to this area
+        exported = str(self.home / (area + ".json"))
+        C1.export(exported)
+        with open(exported) as handle:
+            self.assertNotIn('blocks', json.load(handle)['files']["cube.fits"])
+        os.remove(exported)
+
+        # The file is assembled once every block is held
+        self.assertEqual(C1.getRange("cube.fits", 0, 10000), data)
+        self.assertEqual([request[1].get('Range') for request in self.server.requests[3:]],
+                         ['bytes=1000-1999', 'bytes=6000-8999'])
+        entry = C1.descriptor['files']["cube.fits"]
+        self.assertTrue(entry['loaded'])
+        self.assertEqual(entry['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertNotIn('blocks', entry)
+        self.assertEqual(pathlib.Path(C1.getFile("cube.fits")).read_bytes(), data)
+        self.assertEqual(C1.getRange("cube.fits", 4000, 10), data[4000:4010])
+        self.assertEqual(len(self.server.requests), 5)
+
+        # Blocks of a changed file are replaced by the new version
+        C1.addFile(self.server.add("/other.fits", data), "other.fits")
+        C1.getRange("other.fits", 0, 10)
+        update = os.urandom(3000)
+        self.server.add("/other.fits", update)
+        self.assertEqual(C1.getRange("other.fits", 2000, 10), update[2000:2010])
+        self.assertTrue(C1.descriptor['files']["other.fits"]['loaded'])
+        self.assertEqual(C1.getRange("other.fits", 0, 10), update[:10])
+        shutil.rmtree(str(path))
+
+    def test_loadIncremental(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        C1.addFiles([(self.server.add("/i" + str(i), os.urandom(500)), "i" + str(i)) for i in range(4)])
+        self.assertEqual(C1.journal.pending, 0)
+        self.assertEqual(len(C1.descriptor['files']), 4)
+        C1.refresh()
+        manifest = str(self.home / (area + ".json"))
+        C1.export(manifest)
+        paths = {filename: entry['path'] for filename, entry in C1.descriptor['files'].items()}
+
+        # i1 changes, i2 goes and i4 arrives
+        with open(manifest) as handle:
+            desc = json.load(handle)
+        update = os.urandom(600)
+        self.server.add("/i1", update)
+        desc['files']["i1"].update({'sha256': hashlib.sha256(update).hexdigest(), 'size': len(update)})
+        del desc['files']["i2"]
+        desc['files']["i4"] = {'url': self.server.add("/i4", os.urandom(500)), 'loaded': False}
+        with open(manifest, 'w') as handle:
+            json.dump(desc, handle)
+
+        count = len(self.server.requests)
+        report = C1.load(manifest, incremental=True)
+        self.assertEqual(report, {'added': ["i4"], 'changed': ["i1"], 'removed': ["i2"], 'unchanged': ["i0", "i3"]})
+        self.assertTrue(C1.descriptor['files']["i0"]['loaded'])
+        self.assertTrue(os.path.exists(paths["i0"]))
+        self.assertFalse(os.path.exists(paths["i1"]))
+        self.assertFalse(os.path.exists(paths["i2"]))
+        self.assertNotIn("i2", C1.descriptor['files'])
+        refreshed = C1.refresh()
+        self.assertEqual(sorted(request[0] for request in self.server.requests[count:]), ["/i1", "/i4"])
+        self.assertEqual(refreshed["i0"]['status'], 'cached')
+        self.assertEqual(pathlib.Path(C1.getFile("i1")).read_bytes(), update)
+
+        # A file with the same hash at a new URL is kept
+        body = pathlib.Path(paths["i3"]).read_bytes()
+        moved = self.server.add("/moved/i3", body)
+        desc['files']["i3"]['url'] = moved
+        with open(manifest, 'w') as handle:
+            json.dump(desc, handle)
+        report = C1.load(manifest, incremental=True)
+        self.assertIn("i3", report['unchanged'])
+        self.assertEqual(C1.descriptor['files']["i3"]['url'], moved)
+        self.assertTrue(C1.descriptor['files']["i3"]['loaded'])
+        self.assertTrue(os.path.exists(paths["i3"]))
+
+        # Merging keeps files the manifest does not list
+        del desc['files']["i3"]
+        with open(manifest, 'w') as handle:
+            json.dump(desc, handle)
+        report = C1.load(manifest, True, True)
+        self.assertEqual(report['removed'], [])
+        self.assertTrue(C1.descriptor['files']["i3"]['loaded'])
+        os.remove(manifest)
+
+        C1.deleteFiles(["i0", "i3", "unknown"])
+        self.assertEqual(sorted(C1.descriptor['files']), ["i1", "i4"])
+        self.assertFalse(os.path.exists(paths["i0"]))
+        self.assertEqual(C1.journal.pending, 0)
+        shutil.rmtree(str(path))
+
+    def test_verify(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        name = getUid()
+        C1 = S1.addContext(name)
+        bodies = {"v" + str(i): os.urandom(800) for i in range(4)}
+        C1.addFiles([(self.server.add("/" + filename, body), filename) for filename, body in bodies.items()])
+        C1.refresh()
+        report = S1.verify()
+        self.assertEqual(report, {'checked': 4, 'missing': [], 'damaged': [], 'recoverable': [], 'orphans': []})
+
+        # v0 is truncated, v1 deleted, and stray files appear beside them
+        with open(str(C1.path / "v0"), 'r+b') as handle:
+            handle.truncate(100)
+        os.remove(str(C1.path / "v1"))
+        (C1.path / "stray").write_bytes(b'stray')
+        (C1.path / "ghost.part").write_bytes(b'ghost')
+        (C1.path / "v2.part").write_bytes(b'partial')
+        report = S1.verify()
+        self.assertEqual(report['missing'], [(name, "v1")])
+        self.assertEqual(report['damaged'], [(name, "v0")])
+        self.assertEqual(report['orphans'], [str(C1.path / "ghost.part"), str(C1.path / "stray")])
+
+        S1.reconcile()
+        self.assertFalse(C1.descriptor['files']["v0"]['loaded'])
+        self.assertFalse(C1.descriptor['files']["v1"]['loaded'])
+        self.assertFalse(os.path.exists(str(C1.path / "v0")))
+        self.assertFalse(os.path.exists(str(C1.path / "stray")))
+        self.assertTrue(os.path.exists(str(C1.path / "v2.part")))
+        self.assertEqual(S1.verify()['checked'], 2)
+        self.assertEqual(pathlib.Path(C1.getFile("v0")).read_bytes(), bodies["v0"])
+
+        # Same size and mtime: only a rehash finds the corruption
+        v3 = str(C1.path / "v3")
+        info = os.stat(v3)
+        with open(v3, 'r+b') as handle:
+            handle.write(b'\0' * 16)
+        os.utime(v3, ns=(info.st_atime_ns, info.st_mtime_ns))
+        self.assertEqual(S1.verify()['damaged'], [])
+        self.assertEqual(S1.verify(rehash=True)['damaged'], [(name, "v3")])
+
+        # A good copy of a file not recorded as held is recovered with a rehash
+        (C1.path / "v1").write_bytes(bodies["v1"])
+        self.assertEqual(S1.verify()['orphans'], [str(C1.path / "v1")])
+        report = S1.reconcile(rehash=True)
+        self.assertEqual(report['recoverable'], [(name, "v1")])
+        self.assertTrue(C1.descriptor['files']["v1"]['loaded'])
+        self.assertFalse(C1.descriptor['files']["v3"]['loaded'])
+        S1.close()
+
+        # Checked again when the area is opened
+        os.remove(str(C1.path / "v2"))
+        S2 = FileCache.StorageArea(str(path), verifyOnOpen=True)
+        self.assertFalse(S2.contexts[name].descriptor['files']["v2"]['loaded'])
+        self.assertTrue(S2.contexts[name].descriptor['files']["v1"]['loaded'])
+        S2.close()
+        shutil.rmtree(str(path))
+
+    def test_reconcileShared(self):
+        path = self.home / getUid()
+        name = getUid()
+        body = os.urandom(1000)
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(name)
+        C1.addFiles([(self.server.add("/w" + str(i), body), "w" + str(i)) for i in range(3)])
+        S2 = FileCache.StorageArea(str(path))
+        C2 = S2.contexts[name]
+
+        # Files another opening has just retrieved are not orphans
+        local = C1.getFile("w0")
+        self.assertEqual(S2.reconcile()['orphans'], [])
+        self.assertTrue(os.path.isfile(local))
+
+        # Nor are those retrieved between the check and the removal
+        (C2.path / "w1").write_bytes(body)
+        (C2.path / "stray").write_bytes(body)
+        verifier = Verifier(S2)
+        self.assertEqual(verifier.run()['orphans'], [str(C2.path / "stray"), str(C2.path / "w1")])
+        local = C1.getFile("w1", True)
+        self.assertFalse(verifier.removeOrphan(local))
+        self.assertEqual(pathlib.Path(local).read_bytes(), body)
+        self.assertTrue(verifier.removeOrphan(str(C2.path / "stray")))
+        self.assertFalse(os.path.exists(str(C2.path / "stray")))
+        S1.close()
+        S2.close()
+        shutil.rmtree(str(path))
+
+    def test_mirrors(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), retries=0)
+        C1 = S1.addContext(getUid())
+        dead = "http://127.0.0.1:1"
+        body = os.urandom(1000)
+        good = self.server.add("/m1", body)
+        C1.addFile([dead + "/m1", good], "m1")
+        self.assertEqual(C1.descriptor['files']["m1"]['url'], dead + "/m1")
+        self.assertEqual(pathlib.Path(C1.getFile("m1")).read_bytes(), body)
+        self.assertEqual(S1.metrics.snapshot()['counters']['failovers'][C1.name], 1)
+        self.assertFalse(S1.sources.healthy(dead))
+
+        # The failed host is set aside, and mirrors apply to every file of the context
+        C1.addFile(dead + "/data/m2", "m2")
+        self.server.add("/mirror/data/m2", body)
+        C1.setMirrors({dead + "/": [good[:-len("/m1")] + "/mirror/"]})
+        self.assertIsNotNone(C1.getFile("m2"))
+        self.assertEqual(S1.metrics.snapshot()['counters']['failovers'][C1.name], 1)
+        self.assertEqual(C1.getRange("m1", 10, 5), body[10:15])
+
+        # Once every source failed, getFile gives up
+        C1.addFile([dead + "/m3", good[:-len("/m1")] + "/absent"], "m3")
+        self.assertIsNone(C1.getFile("m3"))
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_hedge(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), hedge=0.05)
+        C1 = S1.addContext(getUid())
+        slow = StandInServer(delay=0.5)
+        body = os.urandom(5000)
+        C1.addFile([slow.add("/h1", body), self.server.add("/h1", body)], "h1")
+        start = time.time()
+        self.assertEqual(pathlib.Path(C1.getFile("h1")).read_bytes(), body)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(S1.metrics.snapshot()['counters']['hedges'][C1.name], 1)
+
+        # The losing request cleans up after itself
+        time.sleep(0.7)
+        self.assertEqual(S1.verify()['orphans'], [])
+        self.assertEqual([name for name in os.listdir(str(C1.path)) if name.startswith("h1")], ["h1"])
+
+        # Errors outside the transfer itself reach the caller instead of leaving it waiting
+        blocked = C1.path / "blocked"
+        (blocked / "inside").mkdir(parents=True)
+        outcome = []
+        caller = threading.Thread(target=lambda: outcome.append(
+            self.assertRaises(OSError, S1.fetcher.fetchFrom, [slow.add("/h2", body), self.server.add("/h2", body)],
+                              str(blocked))), daemon=True)
+        caller.start()
+        caller.join(5.0)
+        self.assertFalse(caller.is_alive())
+        self.assertEqual(len(outcome), 1)
+        slow.stop()
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_throttle(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), chunkSize=16384, rate=100000)
+        C1 = S1.addContext(getUid())
+        for i in range(3):
+            C1.addFile(self.server.add("/t" + str(i), os.urandom(150000)), "t" + str(i))
+
+        # A full bucket lets 100000 bytes through at once, the rest waits
+        start = time.time()
+        C1.getFile("t0")
+        self.assertGreater(time.time() - start, 0.35)
+        S1.throttle.setRate(None)
+        C1.setRate(1000000)
+        self.assertEqual(S1.throttle.rate(C1.name), 1000000)
+        start = time.time()
+        C1.getFile("t1")
+        self.assertLess(time.time() - start, 0.35)
+        C1.setRate(None)
+        self.assertIsNone(S1.throttle.rate(C1.name))
+
+        # Writer slots go to interactive retrievals before bulk and prefetch ones
+        throttle = S1.throttle
+        throttle.setWriters(1)
+        order = []
+        def write(priority):
+            with throttle.scope(C1.name, priority), throttle.writer():
+                order.append(priority)
+        with throttle.writer():
+            threads = []
+            for priority in (PREFETCH, BULK, INTERACTIVE):
+                threads.append(threading.Thread(target=write, args=(priority,)))
+                threads[-1].start()
+                time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [INTERACTIVE, BULK, PREFETCH])
+
+        # A refresh within the limit still completes
+        throttle.setWriters(None)
+        self.assertEqual(C1.refresh(workers=2)["t2"]['status'], 'retrieved')
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_getBytes(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path), memoryCapacity=3000, memoryItemSize=1500)
+        C1 = S1.addContext(getUid())
+        bodies = {"b" + str(i): os.urandom(1000) for i in range(4)}
+        bodies["big"] = os.urandom(2000)
+        C1.addFiles([(self.server.add("/" + filename, body), filename) for filename, body in bodies.items()])
+
+        self.assertEqual(C1.getBytes("b0"), bodies["b0"])
+        self.assertEqual(C1.getBytes("b0"), bodies["b0"])
+        self.assertEqual(C1.getBytes("big"), bodies["big"])
+        self.assertEqual(C1.getBytes("big"), bodies["big"])
+        counters = S1.metrics.snapshot()['counters']
+        self.assertEqual(counters['memoryHits'][C1.name], 1)
+        self.assertEqual(counters['memoryMisses'][C1.name], 3)
+        self.assertEqual(S1.memory.usage(), (1000, 1))
+
+        # Least recently used files make room for new ones
+        C1.getBytes("b1")
+        C1.getBytes("b2")
+        C1.getBytes("b0")
+        C1.getBytes("b3")
+        self.assertIsNone(S1.memory.get(C1.descriptor['files']["b1"]['path'], C1.descriptor['files']["b1"]['mtime']))
+        self.assertEqual(S1.memory.usage(), (3000, 3))
+
+        # Deleting, overwriting and purging drop the copies in memory
+        C1.deleteFile("b2")
+        self.assertEqual(S1.memory.usage(), (2000, 2))
+        update = os.urandom(1000)
+        self.server.add("/b0", update)
+        C1.getFile("b0", True)
+        self.assertEqual(S1.memory.usage(), (1000, 1))
+        self.assertEqual(C1.getBytes("b0"), update)
+        C1.purge()
+        self.assertEqual(S1.memory.usage(), (0, 0))
+        self.assertIsNone(C1.getBytes("b0"))
+        S1.close()
+        shutil.rmtree(str(path))
+
+    def test_bundle(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        name = getUid()
+        C1 = S1.addContext(name)
+        C1.setCompression([["*.txt", "gzip"]])
+        bodies = {"u0.bin": os.urandom(3000), "u1.txt": b'text ' * 600, "u2.bin": os.urandom(100)}
+        C1.addFiles([(self.server.add("/" + filename, body), filename) for filename, body in bodies.items()])
+        C1.getFile("u0.bin")
+        C1.getFile("u1.txt")
+        bundle = str(self.home / (area + ".tar.gz"))
+        self.assertEqual(S1.exportBundle(bundle, compression='gz'), {name: ["u0.bin", "u1.txt"]})
+
+        # Imported files are held without any request being made
+        count = len(self.server.requests)
+        other = self.home / getUid()
+        S2 = FileCache.StorageArea(str(other))
+        report = S2.importBundle(bundle)
+        self.assertEqual(report, {'imported': [(name, "u0.bin"), (name, "u1.txt")], 'skipped': [], 'failed': []})
+        C2 = S2.contexts[name]
+        self.assertFalse(C2.descriptor['files']["u2.bin"]['loaded'])
+        for filename in ("u0.bin", "u1.txt"):
+            self.assertTrue(C2.descriptor['files'][filename]['loaded'])
+            self.assertEqual(pathlib.Path(C2.getFile(filename)).read_bytes(), bodies[filename])
+        self.assertEqual(len(self.server.requests), count)
+        self.assertEqual(S2.verify()['orphans'], [])
+
+        # Files already held are skipped, and a context can import under another name
+        report = S2.importBundle(bundle)
+        self.assertEqual(report['skipped'], [(name, "u0.bin"), (name, "u1.txt")])
+        stream = io.BytesIO()
+        C1.exportBundle(stream)
+        stream.seek(0)
+        C3 = S2.addContext(getUid())
+        self.assertEqual(C3.importBundle(stream), {'imported': ["u0.bin", "u1.txt"], 'skipped': [], 'failed': []})
+        self.assertEqual(C3.getBytes("u1.txt"), bodies["u1.txt"])
+        self.assertIsNone(C3.importBundle(io.BytesIO(b'not a bundle')))
+        self.assertEqual(len(self.server.requests), count)
+
+        os.remove(bundle)
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(other))
+
+    def test_prefetch(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        for i in range(6):
+            C1.addFile(self.server.add("/p" + str(i), bytes([i]) * 1000), "p" + str(i))
+
+        # Explicit hints, retrieved by priority
+        C1.setPrefetch(workers=1)
+        with C1.prefetcher.foreground():
+            C1.prefetch(["p3"], 5)
+            C1.prefetch(["p1", "p2"])
+            time.sleep(0.1)
+            self.assertEqual(C1.prefetcher.pending(), ["p1", "p2", "p3"])
+        self.assertTrue(C1.prefetcher.wait(10))
+        self.assertEqual([request[0] for request in self.server.requests], ["/p1", "/p2", "/p3"])
+        count = len(self.server.requests)
+        self.assertIsNotNone(C1.getFile("p2"))
+        self.assertEqual(len(self.server.requests), count)
+
+        # Queued prefetches wait for a foreground retrieval
+        self.server.delay = 0.2
+        foreground = threading.Thread(target=C1.getFile, args=("p4",))
+        foreground.start()
+        time.sleep(0.05)
+        C1.prefetch(["p5"])
+        foreground.join()
+        self.assertTrue(C1.prefetcher.wait(10))
+        self.assertEqual([request[0] for request in self.server.requests[count:]], ["/p4", "/p5"])
+        self.server.delay = 0
+        C1.close()
+        shutil.rmtree(str(path))
+
+    def test_prefetchReadAhead(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        for i in range(8):
+            C1.addFile(self.server.add("/r" + str(i), bytes([i]) * 1000), "r" + str(i))
+
+        # Requests running through the manifest in order are read ahead, within
+        # the disk budget
+        C1.setPrefetch(workers=1, readAhead=2, diskBudget=1000)
+        C1.getFile("r0")
+        C1.getFile("r1")
+        self.assertFalse(C1.prefetcher.wait(0.5))
+        self.assertEqual([request[0] for request in self.server.requests], ["/r0", "/r1", "/r2"])
+        self.assertEqual(C1.prefetcher.pending(), ["r3"])
+
+        # Reading a prefetched file makes room for the next one
+        C1.getFile("r2")
+        self.assertFalse(C1.prefetcher.wait(0.5))
+        self.assertEqual([request[0] for request in self.server.requests[3:]], ["/r3"])
+        self.assertFalse(C1.descriptor['files']["r4"]['loaded'])
+
+        # Learnt transitions are predicted
+        C1.prefetcher.stop()
+        C1.prefetcher.record("r7")
+        C1.prefetcher.record("r0")
+        self.assertEqual(C1.prefetcher.predict("r7", "r7")[0], "r0")
+        C1.close()
+        shutil.rmtree(str(path))
+
+    def test_mapFile(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        data = struct.pack("<16d", *range(16))
+        C1.addFile(self.server.add("/m.dat", data), "m.dat")
+        view = C1.mapFile("m.dat")
+        self.assertEqual(view.tobytes(), data)
+        self.assertTrue(view.readonly)
+        local = C1.descriptor['files']["m.dat"]['path']
+        self.assertTrue(S1.maps.isMapped(local))
+        self.assertEqual(C1.mapFile("m.dat")[8:16].tobytes(), data[8:16])
+        self.assertEqual(len(self.server.requests), 1)
+
+        # A replaced file is mapped afresh
+        update = struct.pack("<16d", *range(16, 32))
+        self.server.add("/m.dat", update)
+        C1.getFile("m.dat", True)
+        self.assertFalse(S1.maps.isMapped(local))
+        self.assertEqual(C1.mapFile("m.dat").tobytes(), update)
+        self.assertEqual(view.tobytes(), data)
+        view.release()
+
+        C1.deleteFile("m.dat")
+        self.assertFalse(S1.maps.isMapped(local))
+        shutil.rmtree(str(path))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_arrayFile(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        C1.addFile(self.server.add("/a.dat", b"HEADER.." + struct.pack("<12d", *range(12))), "a.dat")
+        array = C1.arrayFile("a.dat", "<f8", 8, shape=(3, 4))
+        self.assertEqual(array.shape, (3, 4))
+        self.assertEqual(array[2, 3], 11.0)
+        del array
+        shutil.rmtree(str(path))
+
+    def test_bench(self):
+        output = self.home / (getUid() + ".json")
+        self.assertEqual(FileCacheBench.main(['--files', '4', '--size', '2000', '--contexts', '2',
+                                              '--repeat', '2', '--output', str(output)]), 0)
+        results = json.loads(output.read_text())
+        self.assertEqual(set(results['results']), set(FileCacheBench.BENCHMARKS))
+        self.assertEqual(len(results['results']['getFileCold']['runs']), 2)
+        self.assertEqual(results['results']['getFileCold']['operations'], 4)
+
+        # A run is compared with its own results
+        self.assertEqual(FileCacheBench.main(['--files', '4', '--size', '2000', '--contexts', '2', '--repeat', '1',
+                                              '--only', 'getFileWarm', '--output', str(output),
+                                              '--compare', str(output), '--threshold', '1000']), 0)
+        output.unlink()
+
+    def test_journalCheckpoint(self):
+        area = getUid()
+        path = self.home / area
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        C1.journal.checkpointInterval = 3
+        for i in range(7):
+            C1.addFile("http://localhost/" + str(i), str(i))
+        self.assertTrue((C1.path / "desc.json").exists())
+        self.assertEqual(len((C1.path / "desc.log").read_text().splitlines()), 1)
+        shutil.rmtree(str(path))
+
+    def test_entryLocks(self):
+        area = getUid()
+        path = self.home / area
+        src = self.home / getUid()
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(getUid())
+        for url, filename in makeSources(src, 4):
+            C1.addFile(url, filename)
+        locks = lambda: sorted(item.name for item in C1.path.glob(".f*.lock"))
+
+        # Lock files only exist while retrievals hold them
+        with C1._entryLock("f0.dat"):
+            self.assertEqual(locks(), [".f0.dat.lock"])
+        self.assertEqual(C1.refresh()["f1.dat"]['status'], 'retrieved')
+        self.assertEqual(locks(), [])
+
+        # Whoever waits for a lock file being removed locks a fresh one
+        lockPath = str(C1.path / ".f3.dat.lock")
+        first = FileLock(lockPath)
+        second = FileLock(lockPath)
+        first.acquire()
+        waiter = threading.Thread(target=second.acquire)
+        waiter.start()
+        time.sleep(0.1)
+        first.release(True)
+        waiter.join()
+        self.assertTrue(os.path.exists(lockPath))
+        self.assertFalse(FileLock(lockPath).acquire(False))
+        shutil.rmtree(str(path))
+        shutil.rmtree(str(src))
+
+    def test_refreshShared(self):
+        path = self.home / getUid()
+        name = getUid()
+        S1 = FileCache.StorageArea(str(path))
+        C1 = S1.addContext(name)
+        C1.addFile(self.server.add("/x", os.urandom(500)), "x")
+        S2 = FileCache.StorageArea(str(path))
+        C2 = S2.contexts[name]
+        C2.addFile(self.server.add("/y", os.urandom(500)), "y")
+        C2.writeDescriptor()
+
+        # Files another opening added are refreshed, and retrievals reported as such
+        report = C1.refresh()
+        self.assertEqual(sorted(report), ["x", "y"])
+        self.assertEqual({result['status'] for result in report.values()}, {'retrieved'})
+        self.assertEqual(len(self.server.requests), 2)
+        shutil.rmtree(str(path))
+
+    def test_accessStats(self):
+        for metadata in ('json', 'sqlite'):
+            area = getUid()
+            path = self.home / area
+            src = self.home / getUid()
+            S1 = FileCache.StorageArea(str(path), metadata=metadata)
+            name = getUid()
+            C1 = S1.addContext(name)
+            for url, filename in makeSources(src, 2):
+                C1.addFile(url, filename)
+            C1.getFile("f0.dat")
+            C1.getFile("f1.dat")
+            log = C1.path / "desc.log"
+            size = log.stat().st_size if log.exists() else 0
+            version = C1.journal.version if metadata == 'sqlite' else None
+
+            # Reads of files already held are kept in memory
+            for i in range(5):
+                C1.getFile("f0.dat")
+            C1.getFile("f1.dat")
+            self.assertEqual(C1.descriptor['files']["f0.dat"]['hits'], 6)
+            self.assertEqual(log.stat().st_size if log.exists() else 0, size)
+            if metadata == 'sqlite':
+                self.assertEqual(C1.journal.version, version)
+
+            # Changes of another opening do not lose them
+            S2 = FileCache.StorageArea(str(path), metadata=metadata)
+            S2.contexts[name].addFile("http://localhost/other", "other")
+            S2.flush()
+            C1.sync()
+            self.assertEqual(C1.descriptor['files']["f0.dat"]['hits'], 6)
+
+            # And they are stored, in one batch, when the area is flushed
+            S1.flush()
+            if metadata == 'sqlite':
+                self.assertEqual(C1.journal.version, version + 2)
+            S3 = FileCache.StorageArea(str(path), metadata=metadata)
+            files = S3.contexts[name].descriptor['files']
+            self.assertEqual((files["f0.dat"]['hits'], files["f1.dat"]['hits']), (6, 2))
+            shutil.rmtree(str(path))
+            shutil.rmtree(str(src))
+
 
 '''
       self.assertEqual('foo'.upper(), 'FOO')
@@ -293,6 +1644,18 @@ class FileCacheTest(unittest.TestCase):
 def getUid():
     return str(uuid.uuid4())[:8]
 
+def makeSources(src: pathlib.Path, count: int, size: int = 1000):
+    '''
+    Create count local files of size bytes and return (url, filename) pairs for them
+    '''
+    src.mkdir()
+    sources = []
+    for i in range(count):
+        filename = "f" + str(i) + ".dat"
+        (src / filename).write_bytes(os.urandom(size))
+        sources.append(((src / filename).as_uri(), filename))
+    return sources
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase( FileCacheTest )
     unittest.TextTestRunner(verbosity=2).run(suite)
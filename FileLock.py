@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking on this platform, threads are still serialised
+    fcntl = None
+
+class FileLock(object):
+    '''
+    FileLock - an exclusive lock shared by the threads of this process and by other
+    processes, based on flock() on a lock file. It is reentrant: the thread holding
+    it may acquire it again.
+
+    If the lock file cannot be created (e.g. a read-only storage area) only the
+    threads of this process are serialised. The lock file may be removed as the
+    lock is released; whoever was waiting for it locks the file created in its place.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._handle = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        '''
+        Take the lock, waiting for it unless blocking is False. Returns True if it was taken
+        '''
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._handle = self._lockFile(blocking)
+            except BaseException:
+                self._lock.release()
+                raise
+            if self._handle is False:
+                self._handle = None
+                self._lock.release()
+                return False
+        self._depth += 1
+        return True
+
+    def _lockFile(self, blocking: bool):
+        '''
+        Open and flock() the lock file, returning its handle, None if it cannot be
+        created, or False if it is held elsewhere and blocking is False
+        '''
+        while True:
+            try:
+                handle = open(self.path, 'a')
+            except OSError:
+                return None
+            try:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                return False
+            except BaseException:
+                handle.close()
+                raise
+            # The file may have been removed by its previous holder, in which case
+            # the lock is taken again on the file now in its place
+            try:
+                if os.stat(self.path).st_ino == os.fstat(handle.fileno()).st_ino:
+                    return handle
+            except OSError:
+                pass
+            handle.close()
+
+    def release(self, remove: bool = False):
+        '''
+        Release the lock. If remove is True and this is the outermost hold, the
+        lock file is deleted first; whoever waits for it then locks a new one
+        '''
+        self._depth -= 1
+        if self._depth == 0 and self._handle is not None:
+            if remove:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+            fcntl.flock(self._handle.fileno(), fcntl.LOCK_UN)
+            self._handle.close()
+            self._handle = None
+        self._lock.release()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import pathlib
+
+class Journal(object):
+    '''
+    Journal - persistent form of a Context descriptor. The descriptor is kept as a
+    compact snapshot (desc.json) together with an append-only log of per-file
+    updates (desc.log). The snapshot is only rewritten at checkpoints, and the log
+    is replayed on top of it when the descriptor is read back.
+
+    Several processes may share a Journal provided they hold the context's lock
+    while calling sync(), append() and checkpoint(): sync() picks up the records
+    other processes appended, or re-reads everything after they checkpointed.
+    '''
+
+    def __init__(self, path: pathlib.Path, logger, checkpointInterval: int = 1000):
+        self.snapshot = path / "desc.json"
+        self.log = path / "desc.log"
+        self.logger = logger
+        self.checkpointInterval = checkpointInterval
+        self.pending = 0
+        self.offset = 0
+        self.identity = None
+
+    def read(self) -> dict:
+        '''
+        Return the descriptor held in the snapshot with the log replayed on top,
+        or None if nothing has been stored yet
+        '''
+        self.identity = self._identity()
+        self.offset = 0
+        if self.snapshot.is_file():
+            self.logger.debug("J: Reading snapshot " + str(self.snapshot))
+            with open(str(self.snapshot), 'r') as handle:
+                descriptor = json.load(handle)
+                handle.close()
+        elif self.log.is_file():
+            # Changes were journalled before the first checkpoint
+            descriptor = {'files': {}}
+        else:
+            return None
+
+        self.pending = self.replay(descriptor)
+        return descriptor
+
+    def sync(self, descriptor: dict) -> bool:
+        '''
+        Bring descriptor up to date with changes stored by other processes.
+        Returns True if there were any
+        '''
+        if self._identity() != self.identity:
+            # Somebody wrote a new snapshot, start again from it
+            self.logger.debug("J: Snapshot changed, re-reading " + str(self.snapshot))
+            fresh = self.read()
+            if fresh is None:
+                return False
+            fresh.pop('name', None)
+            for key in [key for key in descriptor if key != 'name' and key not in fresh]:
+                del descriptor[key]
+            descriptor.update(fresh)
+            return True
+
+        applied = self.replay(descriptor)
+        self.pending += applied
+        return applied > 0
+
+    def modified(self) -> float:
+        '''
+        Return the time the descriptor was last changed, 0 if it was never stored
+        '''
+        latest = 0.0
+        for path in (self.snapshot, self.log):
+            try:
+                latest = max(latest, path.stat().st_mtime)
+            except OSError:
+                pass
+        return latest
+
+    def replay(self, descriptor: dict) -> int:
+        '''
+        Apply the records in the log past the current offset to descriptor,
+        returning the number applied
+        '''
+        try:
+            if self.log.stat().st_size <= self.offset:
+                return 0
+        except OSError:
+            return 0
+
+        self.logger.debug("J: Replaying log " + str(self.log))
+        count = 0
+        with open(str(self.log), 'rb') as handle:
+            handle.seek(self.offset)
+            for line in handle:
+                if not line.endswith(b"\n"):
+                    # A record left incomplete by an interrupted process
+                    break
+                self.offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    self.logger.error("J: Ignoring damaged log record")
+                    continue
+                apply(descriptor, record)
+                count += 1
+            handle.close()
+        return count
+
+    def put(self, filename: str, entry: dict) -> bool:
+        '''
+        Record the new state of a file entry. Returns True when a checkpoint is due
+        '''
+        return self.append({'put': filename, 'entry': entry})
+
+    def putMany(self, entries: dict) -> bool:
+        '''
+        Record the new state of several file entries in a single write. Returns
+        True when a checkpoint is due
+        '''
+        if not entries:
+            return False
+        return self.append(*[{'put': filename, 'entry': entry} for filename, entry in entries.items()])
+
+    def remove(self, filename: str) -> bool:
+        '''
+        Record the removal of a file entry. Returns True when a checkpoint is due
+        '''
+        return self.append({'del': filename})
+
+    def append(self, *records) -> bool:
+        '''
+        Append records to the log. Returns True when a checkpoint is due
+        '''
+        lines = "".join(json.dumps(record, separators=(',', ':')) + "\n" for record in records)
+        with open(str(self.log), 'ab') as handle:
+            handle.write(lines.encode('utf-8'))
+            self.offset = handle.tell()
+            handle.close()
+        self.pending += len(records)
+        return self.pending >= self.checkpointInterval
+
+    def checkpoint(self, descriptor: dict):
+        '''
+        Atomically replace the snapshot with descriptor and empty the log
+        '''
+        self.logger.debug("J: Writing snapshot " + str(self.snapshot))
+        temp = str(self.snapshot) + ".tmp"
+        with open(temp, 'w') as handle:
+            handle.write(json.dumps(descriptor, separators=(',', ':')))
+            handle.close()
+        os.replace(temp, str(self.snapshot))
+
+        # Records already in the snapshot are harmless if we die before this point,
+        # replaying them is idempotent
+        if self.log.is_file():
+            open(str(self.log), 'w').close()
+        self.pending = 0
+        self.offset = 0
+        self.identity = self._identity()
+
+    def delete(self):
+        '''
+        Delete the snapshot and the log
+        '''
+        self.logger.debug("J: Deleting " + str(self.snapshot))
+        for path in (self.snapshot, self.log):
+            if path.is_file():
+                path.unlink()
+        self.pending = 0
+        self.offset = 0
+        self.identity = None
+
+    def _identity(self) -> tuple:
+        '''
+        Return a value which changes whenever a new snapshot is written
+        '''
+        try:
+            info = self.snapshot.stat()
+        except OSError:
+            return None
+        return (info.st_ino, info.st_mtime_ns, info.st_size)
+
+def apply(descriptor: dict, record: dict):
+    '''
+    Apply a single log record to a descriptor
+    '''
+    if 'put' in record:
+        descriptor['files'][record['put']] = record['entry']
+    elif 'del' in record:
+        descriptor['files'].pop(record['del'], None)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import mmap
+import threading
+
+try:
+    import numpy
+except ImportError:
+    # Array views are not available without NumPy
+    numpy = None
+
+class MapRegistry(object):
+    '''
+    MapRegistry - read-only memory maps of files in a StorageArea. A file is
+    mapped once and the mapping is shared by every caller until the file is
+    evicted, deleted or replaced, so repeated access needs no copying.
+
+    Views handed out keep their mapping alive; release() closes the mapping
+    itself as soon as no view refers to it any more.
+    '''
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self._maps = {}
+
+    def map(self, path: str) -> memoryview:
+        '''
+        Return a read-only memoryview of the contents of path
+        '''
+        with self.lock:
+            info = os.stat(path)
+            identity = (info.st_ino, info.st_mtime_ns, info.st_size)
+            mapped = self._maps.get(path)
+            if mapped is not None and mapped[1] != identity:
+                # The file was replaced since it was mapped
+                self._close(path, self._maps.pop(path)[0])
+                mapped = None
+
+            if mapped is None:
+                if info.st_size == 0:
+                    # Empty files cannot be mapped
+                    return memoryview(b'')
+                self.logger.debug("M: Mapping " + path)
+                with open(path, 'rb') as handle:
+                    mapped = (mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ), identity)
+                self._maps[path] = mapped
+            return memoryview(mapped[0])
+
+    def array(self, path: str, dtype, offset: int = 0, count: int = -1, shape: tuple = None):
+        '''
+        Return a read-only NumPy array over the contents of path, starting offset
+        bytes in, or None if NumPy is not installed
+        '''
+        if numpy is None:
+            self.logger.error("M: NumPy is not installed, cannot create an array view")
+            return None
+        data = numpy.frombuffer(self.map(path), dtype=dtype, count=count, offset=offset)
+        if shape is not None:
+            data = data.reshape(shape)
+        return data
+
+    def isMapped(self, path: str) -> bool:
+        return path in self._maps
+
+    def release(self, path: str):
+        '''
+        Drop the mapping of a file, if any
+        '''
+        with self.lock:
+            mapped = self._maps.pop(path, None)
+        if mapped is not None:
+            self._close(path, mapped[0])
+
+    def releaseAll(self):
+        with self.lock:
+            maps = self._maps
+            self._maps = {}
+        for path, mapped in maps.items():
+            self._close(path, mapped[0])
+
+    def _close(self, path: str, mapping):
+        self.logger.debug("M: Releasing " + path)
+        try:
+            mapping.close()
+        except BufferError:
+            # Views are still in use; the mapping goes when the last one does
+            pass
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import threading
+import collections
+
+class MemoryCache(object):
+    '''
+    MemoryCache - the contents of small, frequently read files of a StorageArea
+    kept in memory, by local path. At most capacity bytes are held, in files of
+    at most maxItem bytes; the least recently used files are dropped first.
+
+    Each content is stored with the version (modification time) of the file it
+    was read from and only returned for that version, so a file replaced by
+    another process is not served stale. Files evicted, deleted or replaced
+    here are dropped with invalidate(). A capacity of None or 0 turns the cache off.
+    '''
+
+    def __init__(self, logger, capacity: int = None, maxItem: int = 1048576):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.maxItem = maxItem
+        self._items = collections.OrderedDict()
+        self._used = 0
+
+    def enabled(self) -> bool:
+        return bool(self.capacity)
+
+    def get(self, path: str, version) -> bytes:
+        '''
+        Return the content held for path if it is of the given version, or None
+        '''
+        with self.lock:
+            item = self._items.get(path)
+            if item is None or item[1] != version:
+                return None
+            self._items.move_to_end(path)
+            return item[0]
+
+    def put(self, path: str, data: bytes, version):
+        '''
+        Hold the content of path, if it fits, dropping what was used least recently to make room
+        '''
+        if not self.enabled() or len(data) > min(self.maxItem, self.capacity):
+            return
+        with self.lock:
+            self._drop(path)
+            self._items[path] = (data, version)
+            self._used += len(data)
+            while self._used > self.capacity:
+                oldest = next(iter(self._items))
+                self.logger.debug("K: Dropping " + oldest + " from memory")
+                self._drop(oldest)
+
+    def invalidate(self, path: str):
+        with self.lock:
+            self._drop(path)
+
+    def clear(self):
+        with self.lock:
+            self._items.clear()
+            self._used = 0
+
+    def setLimits(self, capacity: int, maxItem: int = None):
+        '''
+        Change the capacity and, if given, the largest file held. What no longer fits is dropped
+        '''
+        with self.lock:
+            self.capacity = capacity
+            if maxItem is not None:
+                self.maxItem = maxItem
+            for path in [path for path, item in self._items.items() if len(item[0]) > self.maxItem]:
+                self._drop(path)
+            while self._items and self._used > (self.capacity or 0):
+                self._drop(next(iter(self._items)))
+
+    def usage(self) -> tuple:
+        '''
+        Return the bytes and number of files held
+        '''
+        with self.lock:
+            return self._used, len(self._items)
+
+    def _drop(self, path: str):
+        item = self._items.pop(path, None)
+        if item is not None:
+            self._used -= len(item[0])
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import pathlib
+import sqlite3
+import threading
+
+from Journal import Journal
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS contexts (
+    name TEXT PRIMARY KEY,
+    meta TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    modified REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    context TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    url TEXT,
+    loaded INTEGER NOT NULL,
+    size INTEGER,
+    atime REAL,
+    sha256 TEXT,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (context, filename)
+);
+CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+CREATE INDEX IF NOT EXISTS files_url ON files (url);
+CREATE INDEX IF NOT EXISTS files_loaded ON files (loaded, context);
+CREATE INDEX IF NOT EXISTS files_atime ON files (atime);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+'''
+
+class MetadataIndex(object):
+    '''
+    MetadataIndex - metadata of all the contexts of a StorageArea held in a single
+    SQLite database, as an alternative to a desc.json per context. Entries are
+    indexed by filename, URL, loaded state, access time and hash, so questions
+    about the whole area are answered without reading every descriptor.
+
+    Every update is its own transaction and SQLite arbitrates between processes.
+    '''
+
+    def __init__(self, path: pathlib.Path, logger):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.RLock()
+        self.logger.debug("I: Opening index " + str(path))
+        self.db = sqlite3.connect(str(path), timeout=60.0, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def journal(self, name: str, path: pathlib.Path):
+        '''
+        Return the persistence object for a context, used in place of its Journal
+        '''
+        return IndexJournal(self, name, path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def has(self, name: str) -> bool:
+        '''
+        True if the context called name is stored in the index
+        '''
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM contexts WHERE name = ?", (name,)).fetchone() is not None
+
+    def findFile(self, filename: str) -> list:
+        '''
+        Return the names of the contexts containing filename
+        '''
+        with self.lock:
+            rows = self.db.execute("SELECT context FROM files WHERE filename = ? ORDER BY context", (filename,))
+            return [row[0] for row in rows]
+
+    def findURL(self, url: str) -> list:
+        '''
+        Return (context, filename) pairs for the entries retrieved from url
+        '''
+        with self.lock:
+            rows = self.db.execute("SELECT context, filename FROM files WHERE url = ? ORDER BY context, filename", (url,))
+            return [tuple(row) for row in rows]
+
+    def unloaded(self) -> list:
+        '''
+        Return (context, filename) pairs for the entries not in local storage
+        '''
+        with self.lock:
+            rows = self.db.execute("SELECT context, filename FROM files WHERE loaded = 0 ORDER BY context, filename")
+            return [tuple(row) for row in rows]
+
+    def usage(self, names: list = None, dedup: bool = False) -> tuple:
+        '''
+        Return the bytes and number of files in local storage for the given contexts,
+        all of them by default. Files kept compressed count with their compressed size.
+        With dedup, files with the same hash share their content and count it once
+        '''
+        where = "WHERE loaded = 1"
+        params = ()
+        if names is not None:
+            where += " AND context IN (" + ",".join("?" * len(names)) + ")"
+            params = tuple(names)
+        held = "COALESCE(json_extract(entry, '$.storedSize'), size)"
+        if dedup:
+            query = "SELECT COALESCE(SUM(held), 0), COALESCE(SUM(files), 0) FROM (SELECT MAX(" + held + ") AS held, " \
+                    "COUNT(*) AS files FROM files " + where + " GROUP BY COALESCE(sha256, context || '/' || filename))"
+        else:
+            query = "SELECT COALESCE(SUM(" + held + "), 0), COUNT(*) FROM files " + where
+        with self.lock:
+            used, count = self.db.execute(query, params).fetchone()
+            return used, count
+
+    def compressed(self, names: list = None) -> list:
+        '''
+        Return the (context, filename, size) of the files kept compressed in local
+        storage for the given contexts, all of them by default
+        '''
+        query = "SELECT context, filename, size FROM files WHERE loaded = 1 " \
+                "AND json_extract(entry, '$.stored') IS NOT NULL"
+        params = ()
+        if names is not None:
+            query += " AND context IN (" + ",".join("?" * len(names)) + ")"
+            params = tuple(names)
+        with self.lock:
+            return [tuple(row) for row in self.db.execute(query, params)]
+
+class IndexJournal(object):
+    '''
+    Persistence of one context in a MetadataIndex, with the interface of Journal
+    '''
+
+    def __init__(self, index: MetadataIndex, name: str, path: pathlib.Path):
+        self.index = index
+        self.name = name
+        self.path = path
+        self.pending = 0
+        self.checkpointInterval = 0
+        self.version = None
+
+    def read(self) -> dict:
+        '''
+        Return the descriptor of the context, or None if nothing has been stored yet.
+        A context which still has a desc.json is imported on first use
+        '''
+        with self.index.lock:
+            row = self.index.db.execute("SELECT meta, version FROM contexts WHERE name = ?", (self.name,)).fetchone()
+            if row is None:
+                legacy = Journal(self.path, self.index.logger).read()
+                if legacy is not None:
+                    self.index.logger.debug("I: Importing descriptor of " + self.name)
+                    self.checkpoint(legacy)
+                return legacy
+
+            descriptor = json.loads(row[0])
+            descriptor['files'] = {}
+            for filename, entry in self.index.db.execute(
+                    "SELECT filename, entry FROM files WHERE context = ?", (self.name,)):
+                descriptor['files'][filename] = json.loads(entry)
+            self.version = row[1]
+            return descriptor
+
+    def sync(self, descriptor: dict) -> bool:
+        '''
+        Bring descriptor up to date with changes stored by other processes.
+        Returns True if there were any
+        '''
+        with self.index.lock:
+            row = self.index.db.execute("SELECT version FROM contexts WHERE name = ?", (self.name,)).fetchone()
+            if row is None or row[0] == self.version:
+                return False
+            fresh = self.read()
+            fresh.pop('name', None)
+            for key in [key for key in descriptor if key != 'name' and key not in fresh]:
+                del descriptor[key]
+            descriptor.update(fresh)
+            return True
+
+    def modified(self) -> float:
+        with self.index.lock:
+            row = self.index.db.execute("SELECT modified FROM contexts WHERE name = ?", (self.name,)).fetchone()
+            return 0.0 if row is None else row[0]
+
+    def put(self, filename: str, entry: dict) -> bool:
+        with self.index.lock:
+            with Transaction(self.index.db):
+                self._bump()
+                self.index.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      row(self.name, filename, entry))
+        return False
+
+    def putMany(self, entries: dict) -> bool:
+        '''
+        Store several file entries in one transaction
+        '''
+        if not entries:
+            return False
+        with self.index.lock:
+            with Transaction(self.index.db):
+                self._bump()
+                self.index.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                          [row(self.name, filename, entry) for filename, entry in entries.items()])
+        return False
+
+    def remove(self, filename: str) -> bool:
+        with self.index.lock:
+            with Transaction(self.index.db):
+                self._bump()
+                self.index.db.execute("DELETE FROM files WHERE context = ? AND filename = ?", (self.name, filename))
+        return False
+
+    def checkpoint(self, descriptor: dict):
+        '''
+        Replace everything stored for the context with descriptor, in one transaction
+        '''
+        meta = {key: value for key, value in descriptor.items() if key != 'files'}
+        with self.index.lock:
+            with Transaction(self.index.db):
+                self.index.db.execute("INSERT OR IGNORE INTO contexts (name, meta) VALUES (?, ?)",
+                                      (self.name, json.dumps(meta)))
+                self.index.db.execute("UPDATE contexts SET meta = ? WHERE name = ?", (json.dumps(meta), self.name))
+                self._bump()
+                self.index.db.execute("DELETE FROM files WHERE context = ?", (self.name,))
+                self.index.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                          [row(self.name, filename, entry)
+                                           for filename, entry in descriptor['files'].items()])
+
+    def delete(self):
+        with self.index.lock:
+            with Transaction(self.index.db):
+                self.index.db.execute("DELETE FROM files WHERE context = ?", (self.name,))
+                self.index.db.execute("DELETE FROM contexts WHERE name = ?", (self.name,))
+        self.version = None
+
+    def _bump(self):
+        '''
+        Note a change to the context, creating its record if needed
+        '''
+        self.index.db.execute("INSERT OR IGNORE INTO contexts (name, meta) VALUES (?, ?)",
+                              (self.name, json.dumps({'name': self.name})))
+        self.index.db.execute("UPDATE contexts SET version = version + 1, modified = ? WHERE name = ?",
+                              (time.time(), self.name))
+        self.version = self.index.db.execute("SELECT version FROM contexts WHERE name = ?",
+                                             (self.name,)).fetchone()[0]
+
+class Transaction(object):
+    '''
+    Wraps statements on an autocommit connection in BEGIN IMMEDIATE ... COMMIT
+    '''
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
+
+def row(context: str, filename: str, entry: dict) -> tuple:
+    '''
+    Return the files table row for an entry
+    '''
+    return (context, filename, entry.get('url'), 1 if entry.get('loaded') is True else 0,
+            entry.get('size'), entry.get('atime'), entry.get('sha256'), json.dumps(entry))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import bisect
+import threading
+import contextlib
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# Prefix of the metric names in the Prometheus exposition
+PREFIX = "filecache_"
+
+class Metrics(object):
+    '''
+    Metrics - counters and latency histograms of the operations of a StorageArea,
+    broken down by context. Values accumulate for the life of the StorageArea;
+    snapshot() returns them and writePrometheus() writes them in the Prometheus
+    text format, e.g. for the node exporter's textfile collector.
+
+    Counters: hits, misses, downloads, bytes, notModified, failures, retries,
+    failovers, hedges, evictions, descriptorWrites, tierHits, demotions,
+    rangeRequests, memoryHits and memoryMisses.
+    Histograms: download and descriptorWrite.
+
+    Tracers added with addTracer() are called as tracer(name, attributes=...) at
+    the start of every timed operation and must return a context manager which
+    is held for its duration; an OpenTelemetry tracer's start_as_current_span
+    fits.
+    '''
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tracers = []
+        self.reset()
+
+    def reset(self):
+        '''
+        Set every counter and histogram back to zero
+        '''
+        with self.lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def count(self, name: str, context: str = None, value: int = 1):
+        '''
+        Add value to a counter
+        '''
+        with self.lock:
+            counter = self._counters.setdefault(name, {})
+            counter[context] = counter.get(context, 0) + value
+
+    def observe(self, name: str, seconds: float, context: str = None):
+        '''
+        Record a duration in a histogram
+        '''
+        with self.lock:
+            histogram = self._histograms.setdefault(name, {})
+            if context not in histogram:
+                histogram[context] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)}
+            series = histogram[context]
+            series['count'] += 1
+            series['sum'] += seconds
+            position = bisect.bisect_left(BUCKETS, seconds)
+            if position < len(BUCKETS):
+                series['buckets'][position] += 1
+
+    def addTracer(self, tracer):
+        self.tracers.append(tracer)
+
+    def removeTracer(self, tracer):
+        self.tracers.remove(tracer)
+
+    @contextlib.contextmanager
+    def span(self, name: str, context: str = None, **attributes):
+        '''
+        Time the enclosed block into the histogram name, within a span of every tracer
+        '''
+        if context is not None:
+            attributes['context'] = context
+        with contextlib.ExitStack() as stack:
+            for tracer in list(self.tracers):
+                try:
+                    stack.enter_context(tracer(name, attributes=attributes))
+                except Exception as err:
+                    self.logger.error("T: Tracer failed, " + str(err))
+            start = time.perf_counter()
+            try:
+                yield attributes
+            finally:
+                self.observe(name, time.perf_counter() - start, context)
+
+    def snapshot(self) -> dict:
+        '''
+        Return the current values: {'counters': {name: {context: value}},
+        'histograms': {name: {context: {'count', 'sum', 'buckets'}}}}, where
+        buckets maps each upper bound to the cumulative count. Values not tied
+        to a context are under None
+        '''
+        with self.lock:
+            histograms = {}
+            for name, series in self._histograms.items():
+                histograms[name] = {}
+                for context, values in series.items():
+                    cumulative, buckets = 0, {}
+                    for bound, count in zip(BUCKETS, values['buckets']):
+                        cumulative += count
+                        buckets[bound] = cumulative
+                    histograms[name][context] = {'count': values['count'], 'sum': values['sum'], 'buckets': buckets}
+            return {'counters': {name: dict(series) for name, series in self._counters.items()},
+                    'histograms': histograms}
+
+    def hitRate(self, context: str = None) -> float:
+        '''
+        Return the fraction of getFile() calls served from local storage, for one
+        context or all of them, or None if there were none
+        '''
+        counters = self.snapshot()['counters']
+        def total(name):
+            series = counters.get(name, {})
+            return series.get(context, 0) if context is not None else sum(series.values())
+        hits, misses = total('hits'), total('misses')
+        if hits + misses == 0:
+            return None
+        return hits / (hits + misses)
+
+    def prometheus(self) -> str:
+        '''
+        Return the metrics in the Prometheus text exposition format
+        '''
+        current = self.snapshot()
+        lines = []
+        for name in sorted(current['counters']):
+            metric = PREFIX + snake(name) + "_total"
+            lines.append("# TYPE " + metric + " counter")
+            for context, value in sorted(current['counters'][name].items(), key=labelOrder):
+                lines.append(metric + labels(context) + " " + str(value))
+
+        for name in sorted(current['histograms']):
+            metric = PREFIX + snake(name) + "_seconds"
+            lines.append("# TYPE " + metric + " histogram")
+            for context, values in sorted(current['histograms'][name].items(), key=labelOrder):
+                for bound, count in values['buckets'].items():
+                    lines.append(metric + "_bucket" + labels(context, le=repr(bound)) + " " + str(count))
+                lines.append(metric + "_bucket" + labels(context, le="+Inf") + " " + str(values['count']))
+                lines.append(metric + "_sum" + labels(context) + " " + repr(values['sum']))
+                lines.append(metric + "_count" + labels(context) + " " + str(values['count']))
+        return "\n".join(lines) + "\n"
+
+    def writePrometheus(self, path: str):
+        '''
+        Atomically write the Prometheus exposition to path
+        '''
+        self.logger.debug("T: Writing metrics to " + path)
+        temp = path + ".tmp"
+        with open(temp, 'w') as handle:
+            handle.write(self.prometheus())
+            handle.close()
+        os.replace(temp, path)
+
+def snake(name: str) -> str:
+    '''
+    Return a camelCase name in snake_case
+    '''
+    return "".join("_" + char.lower() if char.isupper() else char for char in name)
+
+def labels(context: str, **extra) -> str:
+    '''
+    Return the label set of a series
+    '''
+    pairs = []
+    if context is not None:
+        escaped = context.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append('context="' + escaped + '"')
+    pairs += [key + '="' + value + '"' for key, value in extra.items()]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def labelOrder(item: tuple) -> str:
+    return "" if item[0] is None else item[0]
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import heapq
+import threading
+import time
+
+from Throttle import PREFETCH
+
+# Priority of explicit hints and of predicted files; lower values are retrieved first
+HINT = 0
+READAHEAD = 10
+
+class Prefetcher(object):
+    '''
+    Prefetcher - retrieves files of a Context in the background before they are
+    asked for. Files are queued by explicit hints (prefetch()) or predicted from
+    the order of recent getFile() calls, and worked through in priority order by
+    a small pool of worker threads.
+
+    Prefetching gives way to the foreground: no queued file is started while a
+    getFile() call is retrieving data, and a file requested in the foreground is
+    taken off the queue. Bandwidth caps the average rate of prefetched bytes, and
+    diskBudget the bytes prefetched but not yet read.
+    '''
+
+    def __init__(self, context, workers: int = 2, readAhead: int = 0,
+                 bandwidth: float = None, diskBudget: int = None):
+        self.context = context
+        self.logger = context.store.logger
+        self.workers = workers
+        self.readAhead = readAhead
+        self.bandwidth = bandwidth
+        self.diskBudget = diskBudget
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self._queue = []
+        self._queued = {}
+        self._sequence = 0
+        self._threads = []
+        self._foreground = 0
+        self._running = 0
+        self._unread = {}
+        self._nextStart = 0.0
+        self._last = None
+        self._transitions = {}
+        self._stopping = False
+
+    def prefetch(self, filenames: list, priority: int = HINT):
+        '''
+        Queue files for retrieval. A file already queued keeps the better of its
+        two priorities
+        '''
+        with self.condition:
+            for filename in filenames:
+                if filename in self._queued and self._queued[filename] <= priority:
+                    continue
+                self._queued[filename] = priority
+                self._sequence += 1
+                heapq.heappush(self._queue, (priority, self._sequence, filename))
+            self._start()
+            self.condition.notify_all()
+
+    def pending(self) -> list:
+        '''
+        Return the queued files, in the order they will be retrieved
+        '''
+        with self.condition:
+            return [filename for priority, sequence, filename in sorted(self._queue)
+                    if self._queued.get(filename) == priority]
+
+    def isBackground(self) -> bool:
+        '''
+        True when called from a prefetch worker
+        '''
+        return getattr(self.local, 'background', False)
+
+    def record(self, filename: str):
+        '''
+        Note a foreground request for filename: drop it from the queue, count it
+        as read and queue the files predicted to follow it
+        '''
+        with self.condition:
+            self._queued.pop(filename, None)
+            if self._unread.pop(filename, None) is not None:
+                self.condition.notify_all()
+
+            last, self._last = self._last, filename
+            if last is not None and last != filename:
+                successors = self._transitions.setdefault(last, {})
+                successors[filename] = successors.get(filename, 0) + 1
+
+        if self.readAhead > 0:
+            predicted = self.predict(last, filename)
+            if predicted:
+                self.logger.debug("A: Reading ahead " + ", ".join(predicted))
+                self.prefetch(predicted, READAHEAD)
+
+    def predict(self, last: str, filename: str) -> list:
+        '''
+        Return up to readAhead files likely to be requested after filename: those
+        which followed it before, most frequent first, then, if the requests are
+        running through the manifest in order, the files after it
+        '''
+        with self.condition:
+            successors = self._transitions.get(filename, {})
+            predicted = sorted(successors, key=lambda name: successors[name], reverse=True)
+
+        with self.context.lock:
+            names = list(self.context.descriptor['files'].keys())
+        if filename in names:
+            position = names.index(filename)
+            if position > 0 and names[position - 1] == last:
+                predicted += names[position + 1:position + 1 + self.readAhead]
+
+        result = []
+        for name in predicted:
+            if name not in result and name != filename:
+                result.append(name)
+        return result[:self.readAhead]
+
+    def foreground(self):
+        '''
+        Return a context manager held while a foreground request retrieves data;
+        prefetch workers do not start new files meanwhile
+        '''
+        return Foreground(self)
+
+    def _start(self):
+        '''
+        Start the worker threads if they are not running
+        '''
+        self._stopping = False
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self) -> str:
+        '''
+        Wait until a queued file may be started and return it, or None when stopping
+        '''
+        with self.condition:
+            while True:
+                if self._stopping:
+                    return None
+                delay = self._nextStart - time.time()
+                if self._queue and self._foreground == 0 and self._withinBudget() and delay <= 0:
+                    priority, sequence, filename = heapq.heappop(self._queue)
+                    if self._queued.get(filename) != priority:
+                        # Superseded by a better priority or taken by the foreground
+                        continue
+                    del self._queued[filename]
+                    self._running += 1
+                    return filename
+                self.condition.wait(delay if self._queue and delay > 0 else None)
+
+    def _withinBudget(self) -> bool:
+        return self.diskBudget is None or sum(self._unread.values()) < self.diskBudget
+
+    def _work(self):
+        self.local.background = True
+        while True:
+            filename = self._next()
+            if filename is None:
+                return
+            try:
+                with self.context.store.throttle.scope(self.context.name, PREFETCH):
+                    size = self._retrieve(filename)
+            except Exception as err:
+                self.logger.error("A: Failed to prefetch " + filename + ", " + str(err))
+                size = 0
+            with self.condition:
+                self._running -= 1
+                if size > 0:
+                    self._unread[filename] = size
+                    if self.bandwidth:
+                        self._nextStart = max(self._nextStart, time.time()) + size / self.bandwidth
+                self.condition.notify_all()
+
+    def _retrieve(self, filename: str) -> int:
+        '''
+        Retrieve a file unless it is already held, returning the bytes transferred
+        '''
+        with self.context.lock:
+            entry = self.context.descriptor['files'].get(filename)
+            if entry is None or (entry['loaded'] is True and self.context.isFresh(filename)):
+                return 0
+            mtime = entry.get('mtime')
+
+        self.logger.debug("A: Prefetching " + filename)
+        if self.context.getFile(filename) is None:
+            return 0
+        with self.context.lock:
+            entry = self.context.descriptor['files'].get(filename, {})
+            if entry.get('mtime') == mtime:
+                return 0
+            return entry.get('size', 0)
+
+    def wait(self, timeout: float = None) -> bool:
+        '''
+        Wait until the queue is empty and no file is being prefetched. Returns False
+        on timeout
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self._queued or self._running > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stop(self):
+        '''
+        Empty the queue and stop the workers once the files in progress are done
+        '''
+        with self.condition:
+            self._queue = []
+            self._queued = {}
+            self._stopping = True
+            self.condition.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self._threads = []
+
+class Foreground(object):
+    '''
+    Marks a foreground retrieval in progress for a Prefetcher
+    '''
+
+    def __init__(self, prefetcher: Prefetcher):
+        self.prefetcher = prefetcher
+
+    def __enter__(self):
+        if not self.prefetcher.isBackground():
+            with self.prefetcher.condition:
+                self.prefetcher._foreground += 1
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if not self.prefetcher.isBackground():
+            with self.prefetcher.condition:
+                self.prefetcher._foreground -= 1
+                self.prefetcher.condition.notify_all()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import urllib.parse
+
+# Weight of the latest measurement in the moving averages
+ALPHA = 0.3
+
+# Transfers smaller than this say little about throughput
+MIN_SAMPLE = 65536
+
+class SourceSelector(object):
+    '''
+    SourceSelector - keeps per-host statistics of retrievals, shared by all the
+    contexts of a StorageArea, and orders the sources of a file so that the
+    fastest healthy one is tried first.
+
+    Each host has exponentially weighted moving averages of the duration of its
+    requests and of its throughput. A host that fails is set aside for cooldown
+    seconds, doubling with each further failure up to maxCooldown; it is only
+    tried again before that if no other source is left. Hosts never measured
+    are tried before measured ones, so that they get measured.
+    '''
+
+    def __init__(self, logger, cooldown: float = 30.0, maxCooldown: float = 600.0):
+        self.logger = logger
+        self.cooldown = cooldown
+        self.maxCooldown = maxCooldown
+        self.lock = threading.Lock()
+        self._hosts = {}
+
+    def order(self, urls: list, size: int = None) -> list:
+        '''
+        Return urls from the most to the least preferred, for a file of size bytes
+        if known. Sources with equal prospects keep their given order
+        '''
+        now = time.monotonic()
+        with self.lock:
+            def rank(url):
+                stats = self._hosts.get(host(url))
+                if stats is None:
+                    return (0, 0.0)
+                unhealthy = 1 if stats['until'] > now else 0
+                if size is not None and stats['throughput'] is not None:
+                    return (unhealthy, size / stats['throughput'])
+                return (unhealthy, stats['latency'] or 0.0)
+            return sorted(urls, key=rank)
+
+    def record(self, url: str, seconds: float, size: int):
+        '''
+        Record a successful retrieval of size bytes from url which took seconds
+        '''
+        with self.lock:
+            stats = self._stats(host(url))
+            stats['latency'] = average(stats['latency'], seconds)
+            if size >= MIN_SAMPLE and seconds > 0:
+                stats['throughput'] = average(stats['throughput'], size / seconds)
+            stats['failures'] = 0
+            stats['until'] = 0.0
+
+    def failed(self, url: str):
+        '''
+        Record a failed retrieval from url, setting its host aside for a while
+        '''
+        with self.lock:
+            stats = self._stats(host(url))
+            stats['failures'] += 1
+            delay = min(self.cooldown * 2 ** (stats['failures'] - 1), self.maxCooldown)
+            stats['until'] = time.monotonic() + delay
+            self.logger.info("R: " + host(url) + " failed, avoiding it for " + str(delay) + "s")
+
+    def healthy(self, url: str) -> bool:
+        with self.lock:
+            stats = self._hosts.get(host(url))
+            return stats is None or stats['until'] <= time.monotonic()
+
+    def statistics(self) -> dict:
+        '''
+        Return a copy of the statistics of every host: {'latency', 'throughput', 'failures'}
+        '''
+        with self.lock:
+            return {name: {key: stats[key] for key in ('latency', 'throughput', 'failures')}
+                    for name, stats in self._hosts.items()}
+
+    def _stats(self, name: str) -> dict:
+        if name not in self._hosts:
+            self._hosts[name] = {'latency': None, 'throughput': None, 'failures': 0, 'until': 0.0}
+        return self._hosts[name]
+
+def host(url: str) -> str:
+    '''
+    Return the scheme and network location a URL is retrieved from
+    '''
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme + "://" + parts.netloc
+
+def average(current: float, value: float) -> float:
+    if current is None:
+        return value
+    return ALPHA * value + (1 - ALPHA) * current
+
+def rewrite(url: str, mirrors: dict) -> list:
+    '''
+    Return url followed by its equivalents on mirrors, a dict mapping a base URL
+    to the list of base URLs which serve the same files
+    '''
+    urls = [url]
+    for base, alternatives in (mirrors or {}).items():
+        if url.startswith(base):
+            urls += [alternative + url[len(base):] for alternative in alternatives]
+    return urls
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import gzip
+import time
+import random
+import hashlib
+import threading
+import http.server
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves the files registered with a StandInServer, with ETag and Range support
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers), self.client_address[1]))
+        time.sleep(server.delay)
+        if server.failures.get(self.path, 0) > 0:
+            server.failures[self.path] -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path in server.redirects:
+            self.send_response(302)
+            if server.redirects[self.path] is not None:
+                self.send_header('Location', server.redirects[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        etag = StandInHandler.etag(body)
+        encoded = server.gzip and 'gzip' in self.headers.get('Accept-Encoding', '') \
+            and self.headers.get('Range') is None
+        if encoded:
+            body = gzip.compress(body, mtime=0)
+            etag = etag[:-1] + '-gzip"'
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        end = len(body) - 1
+        status = 200
+        requested = self.headers.get('Range')
+        ifRange = self.headers.get('If-Range')
+        if requested is not None and server.ranges and ifRange in (None, etag):
+            first, last = requested[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            if start >= len(body):
+                self.send_error(416)
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', 'Wed, 01 Jan 2020 00:00:00 GMT')
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if encoded:
+            self.send_header('Content-Encoding', 'gzip')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(body)))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return '"' + hashlib.md5(body).hexdigest() + '"'
+
+class StandInServer(object):
+    '''
+    In-process HTTP server standing in for a remote archive, used by the tests
+    and the benchmarks. Every request waits delay seconds before it is answered,
+    to model the latency of a real server. If gzip is set, responses are sent
+    with a gzip Content-Encoding to clients which accept it.
+    '''
+
+    def __init__(self, delay: float = 0.0):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.reset()
+        self.delay = delay
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        self.httpd.files = {}
+        self.httpd.requests = []
+        self.httpd.failures = {}
+        self.httpd.redirects = {}
+        self.httpd.ranges = True
+        self.httpd.delay = 0.0
+        self.httpd.gzip = False
+
+    def add(self, name: str, body: bytes) -> str:
+        self.httpd.files[name] = body
+        return 'http://127.0.0.1:' + str(self.httpd.server_address[1]) + name
+
+    def addSynthetic(self, name: str, size: int, seed: int = 0) -> str:
+        '''
+        Serve size pseudo-random bytes under name; the same seed gives the same content
+        '''
+        return self.add(name, random.Random(str(seed) + name).randbytes(size))
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def failures(self):
+        return self.httpd.failures
+
+    @property
+    def redirects(self):
+        '''
+        Paths answered with a 302 to the given location, or without one if it is None
+        '''
+        return self.httpd.redirects
+
+    @property
+    def delay(self):
+        return self.httpd.delay
+
+    @delay.setter
+    def delay(self, value: float):
+        self.httpd.delay = value
+
+    @property
+    def gzip(self):
+        return self.httpd.gzip
+
+    @gzip.setter
+    def gzip(self, value: bool):
+        self.httpd.gzip = value
+
+    @property
+    def ranges(self):
+        return self.httpd.ranges
+
+    @ranges.setter
+    def ranges(self, value: bool):
+        self.httpd.ranges = value
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
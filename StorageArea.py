@@ -4,26 +4,130 @@ import pathlib
 import string
 import logging
 import shutil
+import threading
+import tarfile
 
 from Context import Context
+from Fetcher import Fetcher
+from ConnectionPool import ConnectionPool
+from Eviction import makePolicy
+from BlobStore import BlobStore
+from Journal import Journal
+from MetadataIndex import MetadataIndex
+from MapRegistry import MapRegistry
+from Metrics import Metrics
+from Fetcher import copyContent
+from Verifier import Verifier
+from SourceSelector import SourceSelector
+from Throttle import Throttle
+from MemoryCache import MemoryCache
+from Bundle import openBundle, readBundle
+
+# Directory of the blob store, which is not a context
+BLOBS = ".blobs"
+
+# Database holding the metadata of all contexts, when a metadata index is used
+INDEX = "index.db"
 
 class StorageArea(object):
     '''
     StorageArea containing one or more contexts.
     '''
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, chunkSize: int = 1048576, capacity: int = None,
+                 maxFiles: int = None, policy = 'lru', poolSize: int = 4,
+                 timeout: float = 60.0, retries: int = 3, lazy: bool = False, prefetch = None,
+                 dedup: bool = False, metadata: str = 'json', logLevel: int = None,
+                 metricsFile: str = None, tiers: list = None, writeThrough: bool = True,
+                 blockSize: int = 65536, verifyOnOpen: bool = False, hedge: float = None,
+                 rate: float = None, writers: int = None, memoryCapacity: int = None,
+                 memoryItemSize: int = 1048576):
         '''
         Opens a Storage area, creating the area if necessary
+
+        chunkSize is the size of the blocks in which files are streamed into the area.
+        blockSize is the unit in which Context.getRange() retrieves and caches parts of files.
+        capacity and maxFiles bound the bytes and number of files held across all
+        contexts; when a retrieval takes the area over a limit, files are evicted
+        according to policy ('lru', 'lfu', 'gdsf' or an EvictionPolicy instance).
+
+        All contexts share one pool of keep-alive connections, with up to poolSize
+        connections per host. Requests time out after timeout seconds and are
+        retried up to retries times.
+
+        Files with several sources (see Context.addFile() and Context.setMirrors())
+        are retrieved from the fastest healthy one, as measured by self.sources (a
+        SourceSelector), failing over to the others. If hedge is set, a source which
+        has not delivered a file after hedge seconds is raced by the next one.
+
+        rate limits the bytes per second received by all contexts together, and
+        writers the number of files written at a time. Interactive retrievals are
+        served before refresh() and refresh() before prefetching. Both limits, and
+        rates per context, can be changed later through self.throttle (a Throttle).
+
+        memoryCapacity sets the bytes of an in-memory cache (self.memory, a
+        MemoryCache) holding the contents of files of at most memoryItemSize bytes
+        read with Context.getBytes(). It is off by default.
+
+        If lazy is True, existing contexts are only discovered by name and each
+        descriptor is read when the context is first used. prefetch, a list of
+        context names or True for all of them (most recently used first), has those
+        descriptors read by a background thread.
+
+        If dedup is True, file contents are kept once in a content-addressed blob
+        store and shared by every context that holds them; files whose hash is
+        already known and stored are linked rather than retrieved.
+
+        metadata selects how context descriptors are stored: 'json' keeps a
+        desc.json and journal in each context directory, 'sqlite' keeps all of them
+        in one indexed database, importing existing desc.json files on first use.
+
+        logLevel sets the level of the 'FileCache' logger, which is shared by every
+        StorageArea of the process; without one, the level already set is kept
+        (ERROR if there is none). Operation counts and latencies are collected in
+        self.metrics (see Metrics); if metricsFile is given they are written there
+        in the Prometheus text format on every flush().
+
+        tiers is an ordered list of further StorageAreas (or their paths), e.g. a
+        cache shared between nodes, consulted before the remote location: a file
+        missing here is copied from the first tier holding it under the same
+        context and URL. Files evicted here are demoted to the first writable tier
+        and, unless writeThrough is False, files retrieved are also stored in every
+        writable tier lacking them. Read-only tiers are only read from.
+
+        If verifyOnOpen is True, reconcile() is run once the contexts are found,
+        comparing the recorded size and mtime of every file with local storage.
         '''
         self.contexts = {}
         self.storagePath = None
         self.writable = True
+        self.capacity = capacity
+        self.maxFiles = maxFiles
+        self.policy = makePolicy(policy)
+        self.lock = threading.RLock()
+        self._sharesLock = threading.Lock()
+        self._shares = {}
+        self._shared = 0
+        self.warmer = None
+        self.metricsFile = metricsFile
+        self.writeThroughTiers = writeThrough
 
         # set up logger
         logging.basicConfig()
         self.logger = logging.getLogger('FileCache')
-        self.logger.setLevel(logging.ERROR)
+        if logLevel is not None:
+            self.logger.setLevel(logLevel)
+        elif self.logger.level == logging.NOTSET:
+            self.logger.setLevel(logging.ERROR)
+
+        self.metrics = Metrics(self.logger)
+        self.pool = ConnectionPool(self.logger, poolSize, timeout, retries, metrics=self.metrics)
+        self.sources = SourceSelector(self.logger)
+        self.throttle = Throttle(self.logger, rate, writers)
+        self.fetcher = Fetcher(self.logger, self.pool, chunkSize, self.sources, hedge, self.metrics, self.throttle)
+        self.blockSize = blockSize
+        self.maps = MapRegistry(self.logger)
+        self.memory = MemoryCache(self.logger, memoryCapacity, memoryItemSize)
 
         # Convert string to a Path
         self.logger.debug("S: " + "Opening " + path)
@@ -43,17 +147,58 @@ class StorageArea(object):
             self.logger.debug("S: " + str(self.storagePath) + " is not writable")
             self.writable = False
 
+        self.blobs = None
+        if dedup is True:
+            self.blobs = BlobStore(self.storagePath / BLOBS, self.logger)
+
+        self.index = None
+        if metadata == 'sqlite':
+            self.index = MetadataIndex(self.storagePath / INDEX, self.logger)
+        elif metadata != 'json':
+            raise ValueError('Unknown metadata format ' + str(metadata))
+
         # find existing Contexts and instantiate them Contexts
         # Get all directories
+        self.tiers = []
+        for tier in tiers or []:
+            if not isinstance(tier, StorageArea):
+                tier = StorageArea(str(tier), chunkSize, lazy=True, logLevel=logLevel)
+            self.tiers.append(tier)
+
         self.logger.debug("S: Checking subdirectories")
         for subDir in self.storagePath.iterdir():
-            if subDir.is_dir():
+            if subDir.is_dir() and subDir.name != BLOBS:
                 self.logger.debug("S: Found directory in " + str(subDir.stem))
                 ctxt = self.addContext(str(subDir.stem), False)
-                desc = subDir / "desc.json"
-                if desc.is_file():
-                    self.logger.debug("S: Load context")
-                    ctxt.load(str(desc))
+                self.logger.debug("S: Restore context")
+                # A context not in the index yet is imported now, so that queries
+                # over the whole area see it
+                ctxt.restore(lazy and (self.index is None or self.index.has(ctxt.name)))
+
+        if verifyOnOpen is True:
+            self.reconcile()
+
+        if prefetch:
+            if prefetch is True:
+                prefetch = sorted(self.contexts, key=lambda name: self.contexts[name].journal.modified(), reverse=True)
+            self.warmer = threading.Thread(target=self._warm, args=(list(prefetch),), daemon=True)
+            self.warmer.start()
+
+    def _warm(self, names: list):
+        '''
+        Read the descriptors of the given contexts, in order
+        '''
+        for name in names:
+            ctxt = self.contexts.get(name)
+            if ctxt is not None:
+                self.logger.debug("S: Prefetching context " + name)
+                ctxt.descriptor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
 
     def addContext(self, name: str, createDir: bool = True) -> Context:
         '''
@@ -68,6 +213,9 @@ class StorageArea(object):
 
         # Create a Path object
         saneName = format_filename(name)
+        if saneName == BLOBS:
+            self.logger.error("S: Context name " + name + " is reserved")
+            return None
 
         # Create the directory
         dirPath = self.storagePath / saneName
@@ -117,6 +265,319 @@ class StorageArea(object):
         # Remove the context from the list
         del self.contexts[name]
 
+    def journalFor(self, name: str, path: pathlib.Path):
+        '''
+        Return the object persisting the descriptor of a context
+        '''
+        if self.index is not None:
+            return self.index.journal(name, path)
+        return Journal(path, self.logger)
+
+    def findContext(self, name: str, create: bool = False) -> Context:
+        '''
+        Return the context called name, picking up one that another process added
+        since the area was opened. If there is none, it is created if create is
+        True and the area is writable, otherwise None is returned
+        '''
+        with self.lock:
+            ctxt = self.contexts.get(name)
+            if ctxt is None:
+                if (self.storagePath / format_filename(name)).is_dir():
+                    ctxt = self.addContext(name, False)
+                    ctxt.restore()
+                elif create is True and self.writable:
+                    ctxt = self.addContext(name)
+            return ctxt
+
+    def fillFromTiers(self, ctxt: Context, filename: str, url: str, outfile: str) -> dict:
+        '''
+        Copy a file of ctxt into outfile from the first tier holding it, returning
+        the 'size', 'sha256', 'mtime', validators and 'fetched' time of the copy, or
+        None if no tier holds it
+        '''
+        for tier in self.tiers:
+            tierCtxt = tier.findContext(ctxt.name)
+            if tierCtxt is None:
+                continue
+            entry = tierCtxt.peekFile(filename)
+            if entry is None or entry.get('url') != url:
+                continue
+
+            self.logger.info("S: Copying " + filename + " from tier " + str(tier.storagePath))
+            try:
+                copyContent(entry, outfile)
+            except OSError as err:
+                self.logger.error("S: Failed to copy from tier, " + str(err))
+                continue
+            self.metrics.count('tierHits', ctxt.name)
+            meta = {key: entry[key] for key in ('sha256', 'etag', 'lastModified', 'fetched') if key in entry}
+            info = os.stat(outfile)
+            meta.update({'size': info.st_size, 'mtime': info.st_mtime})
+            return meta
+        return None
+
+    def writeThrough(self, ctxt: Context, filename: str):
+        '''
+        Store a file just retrieved by ctxt in every writable tier which lacks it
+        '''
+        if not self.writeThroughTiers:
+            return
+        for tier in self.tiers:
+            self._storeInTier(tier, ctxt, filename)
+
+    def _storeInTier(self, tier, ctxt: Context, filename: str) -> bool:
+        '''
+        Copy a file of ctxt into tier unless it already holds the same content.
+        Returns True if a copy was made
+        '''
+        if not tier.writable:
+            return False
+        source = ctxt.peekFile(filename)
+        if source is None:
+            return False
+        tierCtxt = tier.findContext(ctxt.name, True)
+        held = tierCtxt.peekFile(filename)
+        if held is not None and held.get('url') == source['url'] and held.get('sha256') == source.get('sha256'):
+            return False
+        return tierCtxt.copyFrom(ctxt, filename) is not None
+
+    def findFile(self, filename: str) -> list:
+        '''
+        Return the names of the contexts containing filename
+        '''
+        if self.index is not None:
+            return self.index.findFile(filename)
+        return sorted(name for name, ctxt in self.contexts.items() if filename in ctxt.descriptor['files'])
+
+    def findURL(self, url: str) -> list:
+        '''
+        Return (context, filename) pairs for the entries retrieved from url
+        '''
+        if self.index is not None:
+            return self.index.findURL(url)
+        return sorted((name, filename) for name, ctxt in self.contexts.items()
+                      for filename, entry in ctxt.descriptor['files'].items() if entry['url'] == url)
+
+    def unloaded(self) -> list:
+        '''
+        Return (context, filename) pairs for the entries not in local storage
+        '''
+        if self.index is not None:
+            return self.index.unloaded()
+        return sorted((name, filename) for name, ctxt in self.contexts.items()
+                      for filename, entry in ctxt.descriptor['files'].items() if entry['loaded'] is not True)
+
+    def usage(self, contexts: list = None) -> tuple:
+        '''
+        Return the bytes and number of files held in local storage by the given
+        contexts, all contexts by default. A file kept compressed counts with its
+        compressed copy and, while it is present, its plain copy
+        '''
+        if self.index is not None:
+            names = None if contexts is None else [ctxt.descriptor['name'] for ctxt in contexts]
+            used, count = self.index.usage(names, self.blobs is not None)
+            for name, filename, size in self.index.compressed(names):
+                ctxt = self.contexts.get(name)
+                if ctxt is not None and os.path.isfile(ctxt.path / filename):
+                    used += size or 0
+            return used, count
+
+        return self._held(list(self.contexts.values()) if contexts is None else contexts)
+
+    def _held(self, contexts: list) -> tuple:
+        '''
+        Return the bytes and number of files held by contexts, from their running totals
+        '''
+        used = 0
+        count = 0
+        for ctxt in contexts:
+            ctxtUsed, ctxtCount = ctxt.usage()
+            used += ctxtUsed
+            count += ctxtCount
+        if self.blobs is None or len(contexts) < 2:
+            return used, count
+
+        # Deduplicated content held by several contexts is only counted once
+        if len(contexts) == len(self.contexts):
+            with self._sharesLock:
+                return used - self._shared, count
+        seen = set()
+        for ctxt in contexts:
+            with ctxt.lock:
+                for sha256, (refs, size) in ctxt._blobs.items():
+                    if sha256 in seen:
+                        used -= size
+                    seen.add(sha256)
+        return used, count
+
+    def shareBlob(self, sha256: str, size: int, delta: int):
+        '''
+        Note that a context started (delta 1) or stopped (delta -1) holding a
+        deduplicated content of size bytes, so that it is counted once for the area
+        '''
+        with self._sharesLock:
+            refs = self._shares.get(sha256, 0)
+            if refs + min(delta, 0) > 0:
+                self._shared += size * delta
+            refs += delta
+            if refs > 0:
+                self._shares[sha256] = refs
+            else:
+                self._shares.pop(sha256, None)
+
+    def enforceCapacity(self, ctxt: Context, keep: str):
+        '''
+        Evict files until ctxt is within its quota and the area within its limits.
+        The file keep of ctxt, if any, is never evicted
+        '''
+        quota = ctxt.descriptor.get('quota')
+        if quota is not None:
+            self._evict([ctxt], quota.get('capacity'), quota.get('maxFiles'), (ctxt, keep))
+        if self.capacity is not None or self.maxFiles is not None:
+            self._evict(list(self.contexts.values()), self.capacity, self.maxFiles, (ctxt, keep))
+
+    def _evict(self, contexts: list, capacity: int, maxFiles: int, keep: tuple):
+        '''
+        Evict files from contexts, in policy order, until they fit capacity and maxFiles
+        '''
+        def fits(used, count):
+            return (capacity is None or used <= capacity) and (maxFiles is None or count <= maxFiles)
+
+        with self.lock:
+            used, count = self._held(contexts)
+            if fits(used, count):
+                return
+
+            candidates = []
+            for ctxt in contexts:
+                with ctxt.lock:
+                    for filename, entry in ctxt.descriptor['files'].items():
+                        if entry.get('loaded') is True and (ctxt, filename) != keep:
+                            candidates.append((self.policy.priority(entry), ctxt, filename))
+            candidates.sort(key=lambda candidate: candidate[0])
+
+            for priority, ctxt, filename in candidates:
+                if fits(used, count):
+                    break
+                self.logger.debug("S: Over capacity, evicting " + filename)
+                self._demote(ctxt, filename)
+                ctxt.evictFile(filename)
+                # Content shared with other files may not be freed, count again
+                used, count = self._held(contexts)
+
+    def _demote(self, ctxt: Context, filename: str):
+        '''
+        Move a file about to be evicted down to the first writable tier
+        '''
+        for tier in self.tiers:
+            if tier.writable:
+                if self._storeInTier(tier, ctxt, filename):
+                    self.metrics.count('demotions', ctxt.name)
+                return
+
+    def verify(self, rehash: bool = False, workers: int = 8) -> dict:
+        '''
+        Check every file held by the area against its descriptor, without changing
+        anything, using up to workers threads. Returns a report with the number of
+        files 'checked', the (context, filename) pairs of those 'missing' or
+        'damaged' and of those 'recoverable', and the paths of 'orphans' (see Verifier).
+
+        Only the recorded size and mtime of each file are compared unless rehash is
+        True, in which case every file is read and its SHA-256 checked as well
+        '''
+        self.logger.debug("S: Verifying " + str(self.storagePath))
+        return Verifier(self, rehash, workers).run()
+
+    def reconcile(self, rehash: bool = False, workers: int = 8, removeOrphans: bool = True) -> dict:
+        '''
+        Verify the area as verify() does and repair what is found: files missing
+        or damaged are recorded as not held, so that they are retrieved again,
+        recoverable files are recorded as held and, if removeOrphans is True,
+        orphaned files are deleted. Returns the report of verify(). Each orphan is
+        checked again, with its context held, just before it is deleted, so files
+        retrieved meanwhile by other processes are kept
+
+        If the store area is not writable, this method will only verify it
+        '''
+        self.logger.debug("S: Reconciling " + str(self.storagePath))
+        verifier = Verifier(self, rehash, workers)
+        report = verifier.run()
+        if not self.writable:
+            self.logger.error("S: Storage in not writable, not reconciling")
+            return report
+
+        for name, filename in report['missing'] + report['damaged']:
+            self.contexts[name].invalidate(filename, verifier.mtimes.get((name, filename)))
+        for name, filename in report['recoverable']:
+            self.contexts[name].recoverFile(filename)
+        if removeOrphans is True:
+            for path in report['orphans']:
+                verifier.removeOrphan(path)
+        return report
+
+    def exportBundle(self, target, contexts: list = None, compression: str = None) -> dict:
+        '''
+        Write the given contexts, all of them by default, with the files they
+        hold into a single tar archive streamed to target, a path or a binary file
+        object, compressed with compression ('gz', 'bz2', 'xz' or None). Returns
+        the files written, by context name. See Context.exportBundle()
+        '''
+        if contexts is None:
+            contexts = sorted(self.contexts)
+        self.logger.debug("S: Exporting bundle of " + str(len(contexts)) + " contexts")
+        written = {}
+        with openBundle(target, 'w', compression) as tar:
+            for name in contexts:
+                written[name] = self.contexts[name]._writeBundle(tar)
+        return written
+
+    def importBundle(self, source, skipExisting: bool = True) -> dict:
+        '''
+        Import every context of a bundle written by exportBundle(), creating
+        those which do not exist, as Context.importBundle() does. Returns the
+        (context, filename) pairs 'imported', 'skipped' and 'failed'
+
+        If the store area is not writable, this method will return None
+        '''
+        if not self.writable:
+            self.logger.error("S: Storage in not writable, aborting")
+            return None
+
+        self.logger.debug("S: Importing bundle")
+        try:
+            with openBundle(source, 'r') as tar:
+                return readBundle(tar, lambda name: self.findContext(name, True), skipExisting)
+        except tarfile.TarError as err:
+            self.logger.error("S: Failed to read bundle, " + str(err))
+            return None
+
+    def flush(self):
+        '''
+        Write descriptor snapshots for all contexts with journalled changes, and
+        the metrics file if there is one
+        '''
+        for name, ctxt in self.contexts.items():
+            ctxt.flush()
+        if self.metricsFile is not None:
+            self.metrics.writePrometheus(self.metricsFile)
+
+    def close(self):
+        '''
+        Close all contexts, idle connections and memory maps
+        '''
+        self.logger.debug("S: Closing " + str(self.storagePath))
+        for name, ctxt in self.contexts.items():
+            ctxt.close()
+        for tier in self.tiers:
+            tier.close()
+        self.pool.close()
+        self.maps.releaseAll()
+        self.memory.clear()
+        if self.index is not None:
+            self.index.close()
+        if self.metricsFile is not None:
+            self.metrics.writePrometheus(self.metricsFile)
+
     def listContexts(self):
         '''
         Output the available Contexts
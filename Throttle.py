@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import contextlib
+
+# Priority classes of retrievals; lower values are served first
+INTERACTIVE = 0
+BULK = 1
+PREFETCH = 2
+
+class Bucket(object):
+    '''
+    Token bucket refilled at rate bytes per second, holding at most one second
+    of tokens. A grant may take it into debt, which later grants wait out
+    '''
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self) -> float:
+        '''
+        Return the seconds until the bucket is out of debt
+        '''
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class Throttle(object):
+    '''
+    Throttle - shares the bandwidth and disk of a StorageArea between retrievals.
+    Bytes received are charged to a global token bucket and to one per context,
+    where rates are set, and no more than writers files are written at a time.
+
+    Every retrieval belongs to a priority class: INTERACTIVE (getFile() and the
+    like), BULK (refresh()) or PREFETCH. While a retrieval of a better class is
+    waiting for bandwidth or a writer slot, worse ones are held back. Rates and
+    the number of writers can be changed at any time.
+    '''
+
+    def __init__(self, logger, rate: float = None, writers: int = None):
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self.writers = writers
+        self._global = None
+        self._contexts = {}
+        self._waiting = {}
+        self._waitingWriters = {}
+        self._writing = 0
+        self.setRate(rate)
+
+    def setRate(self, rate: float, context: str = None):
+        '''
+        Limit the bytes per second received by all retrievals, or by those of a
+        context if one is named. None removes the limit
+        '''
+        with self.condition:
+            bucket = Bucket(rate) if rate else None
+            if context is None:
+                self._global = bucket
+            elif bucket is None:
+                self._contexts.pop(context, None)
+            else:
+                self._contexts[context] = bucket
+            self.condition.notify_all()
+
+    def rate(self, context: str = None) -> float:
+        '''
+        Return the global rate limit, or that of a context, or None
+        '''
+        with self.condition:
+            bucket = self._global if context is None else self._contexts.get(context)
+            return None if bucket is None else bucket.rate
+
+    def setWriters(self, writers: int):
+        '''
+        Limit the number of files written at a time. None removes the limit
+        '''
+        with self.condition:
+            self.writers = writers
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def scope(self, context: str, priority: int = None):
+        '''
+        Charge the retrievals of the calling thread within the block to context,
+        in the given priority class. Without one, an enclosing scope's class is
+        kept, INTERACTIVE by default
+        '''
+        saved = (getattr(self.local, 'context', None), getattr(self.local, 'priority', None))
+        self.local.context = context
+        if priority is not None or saved[1] is None:
+            self.local.priority = INTERACTIVE if priority is None else priority
+        try:
+            yield
+        finally:
+            self.local.context, self.local.priority = saved
+
+    def current(self) -> tuple:
+        '''
+        Return the context and priority class of the calling thread's scope, to
+        carry them over to threads it starts
+        '''
+        return getattr(self.local, 'context', None), self.priority()
+
+    def priority(self) -> int:
+        return getattr(self.local, 'priority', None) or INTERACTIVE
+
+    def consume(self, size: int):
+        '''
+        Charge size bytes received by the calling thread, waiting until the
+        buckets concerned allow them
+        '''
+        context = getattr(self.local, 'context', None)
+        priority = self.priority()
+        with self.condition:
+            if self._global is None and context not in self._contexts:
+                return
+            self._waiting[priority] = self._waiting.get(priority, 0) + 1
+            try:
+                while True:
+                    buckets = [bucket for bucket in (self._global, self._contexts.get(context)) if bucket is not None]
+                    now = time.monotonic()
+                    for bucket in buckets:
+                        bucket.refill(now)
+                    delay = max([bucket.delay() for bucket in buckets] + [0.0])
+                    if delay == 0.0 and not self._ahead(self._waiting, priority):
+                        for bucket in buckets:
+                            bucket.tokens -= size
+                        return
+                    self.condition.wait(delay or None)
+            finally:
+                self._waiting[priority] -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writer(self):
+        '''
+        Hold one of the writer slots for the duration of the block
+        '''
+        priority = self.priority()
+        with self.condition:
+            self._waitingWriters[priority] = self._waitingWriters.get(priority, 0) + 1
+            try:
+                while self.writers is not None and \
+                        (self._writing >= self.writers or self._ahead(self._waitingWriters, priority)):
+                    self.condition.wait()
+            finally:
+                self._waitingWriters[priority] -= 1
+            self._writing += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self._writing -= 1
+                self.condition.notify_all()
+
+    @staticmethod
+    def _ahead(waiting: dict, priority: int) -> bool:
+        '''
+        True if anything of a better class than priority is waiting
+        '''
+        return any(count > 0 for better, count in waiting.items() if better < priority)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import hashlib
+import contextlib
+import concurrent.futures
+
+from Codecs import CODECS, getCodec
+from Fetcher import isIntact
+
+# Files of a context directory which belong to the cache itself
+INTERNAL = ('desc.json', 'desc.log', 'desc.json.tmp')
+
+# Suffixes of the transient files kept beside a file or its compressed copy
+TRANSIENT = ('.part', '.part.json', '.blocks', '.copy', '.tmp', '.link')
+
+HEDGE = re.compile(r'(.*)\.hedge[0-9]+')
+
+class Verifier(object):
+    '''
+    Verifier - checks the files of a StorageArea against their descriptors, in
+    parallel across contexts and files.
+
+    By default only the recorded size and modification time of each file are
+    compared with the file system, which costs one stat() per file and is cheap
+    enough to run on every opening of a large area. With rehash, the content of
+    every file is hashed and compared with its recorded SHA-256 as well.
+
+    Files in context directories which no descriptor refers to are reported as
+    orphans, and so are blobs no file links to any more. Each descriptor is
+    brought up to date with the changes of other processes before its directory
+    is scanned, and removeOrphan() checks an orphan again before deleting it.
+    '''
+
+    def __init__(self, store, rehash: bool = False, workers: int = 8):
+        self.store = store
+        self.rehash = rehash
+        self.workers = workers
+        self.mtimes = {}
+        self.owners = {}
+
+    def run(self, contexts: list = None) -> dict:
+        '''
+        Check the given contexts, all of them by default. Returns a report with
+        the number of files 'checked', (context, filename) pairs of files which are
+        'missing' or 'damaged', those of files not recorded as held whose local
+        copy matches their recorded hash ('recoverable', only found with rehash),
+        and the paths of 'orphans'
+        '''
+        if contexts is None:
+            contexts = list(self.store.contexts.values())
+        report = {'checked': 0, 'missing': [], 'damaged': [], 'recoverable': [], 'orphans': []}
+
+        tasks = []
+        for ctxt in contexts:
+            with ctxt.lock:
+                for filename, entry in ctxt.descriptor['files'].items():
+                    if entry.get('loaded') is True:
+                        tasks.append((ctxt, filename, dict(entry)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            checks = {pool.submit(self._check, entry): (ctxt, filename, entry) for ctxt, filename, entry in tasks}
+            scans = [pool.submit(self._scan, ctxt) for ctxt in contexts]
+            for future in concurrent.futures.as_completed(checks):
+                ctxt, filename, entry = checks[future]
+                status = future.result()
+                report['checked'] += 1
+                if status != 'ok':
+                    self.store.logger.info("V: " + filename + " in context " + ctxt.name + " is " + status)
+                    self.mtimes[(ctxt.name, filename)] = entry.get('mtime')
+                    report[status].append((ctxt.name, filename))
+            for future in scans:
+                orphans, recoverable = future.result()
+                report['orphans'] += orphans
+                report['recoverable'] += recoverable
+
+        if self.store.blobs is not None:
+            report['orphans'] += self._orphanBlobs()
+
+        for key in ('missing', 'damaged', 'recoverable', 'orphans'):
+            report[key].sort()
+        return report
+
+    def _check(self, entry: dict) -> str:
+        '''
+        Return 'ok', 'missing' or 'damaged' for the entry of a held file
+        '''
+        if not os.path.isfile(entry.get('stored', entry['path'])):
+            return 'missing'
+        if not isIntact(entry):
+            return 'damaged'
+        if self.rehash and 'sha256' in entry:
+            try:
+                if self._hash(entry) != entry['sha256']:
+                    return 'damaged'
+            except (OSError, EOFError):
+                return 'damaged'
+        return 'ok'
+
+    def _hash(self, entry: dict) -> str:
+        '''
+        Return the SHA-256 of the plain content of a held file
+        '''
+        if 'stored' in entry:
+            codec = getCodec(entry['codec'])
+            if codec is None:
+                raise OSError('Codec ' + entry['codec'] + ' is not available')
+            handle = codec.open(entry['stored'])
+        else:
+            handle = open(entry['path'], 'rb')
+        digest = hashlib.sha256()
+        with handle:
+            while True:
+                chunk = handle.read(self.store.fetcher.chunkSize)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _scan(self, ctxt) -> tuple:
+        '''
+        Return the orphaned files of a context directory, and the files not
+        recorded as held whose local copy is nevertheless intact
+        '''
+        files, known = self._known(ctxt)
+        orphans = []
+        recoverable = []
+        try:
+            listing = list(os.scandir(str(ctxt.path)))
+        except OSError:
+            return orphans, recoverable
+        for item in listing:
+            if not item.is_file():
+                continue
+            status = self._classify(item.name, item.path, files, known)
+            if status == 'orphan':
+                self.owners[item.path] = ctxt
+                orphans.append(item.path)
+            elif status == 'recoverable':
+                recoverable.append((ctxt.name, item.name))
+        return orphans, recoverable
+
+    def _known(self, ctxt) -> tuple:
+        '''
+        Return the entries of a context, brought up to date with the changes of
+        other processes, and the names of the files they account for
+        '''
+        with ctxt.transaction():
+            files = {filename: dict(entry) for filename, entry in ctxt.descriptor['files'].items()}
+        known = set(files)
+        for entry in files.values():
+            for key in ('path', 'stored'):
+                if key in entry:
+                    known.add(os.path.basename(entry[key]))
+        return files, known
+
+    def _classify(self, name: str, path: str, files: dict, known: set) -> str:
+        '''
+        Return 'orphan' or 'recoverable' for a file of a context directory, or None
+        if it is accounted for
+        '''
+        if name.startswith('.') or name in INTERNAL:
+            return None
+        if name in known:
+            entry = files.get(name)
+            if entry is None or entry.get('loaded') is True:
+                return None
+            if self.rehash and 'sha256' in entry and self._hash({'path': path}) == entry['sha256']:
+                return 'recoverable'
+            return 'orphan'
+        if any(owner in known for owner in owners(name)):
+            return None
+        return 'orphan'
+
+    def removeOrphan(self, path: str) -> bool:
+        '''
+        Delete an orphan found by run(), unless another process has taken it up
+        since. The file is checked again with its context held and, if it is named
+        after an entry, with that entry locked against retrievals. Returns True if
+        it was deleted
+        '''
+        ctxt = self.owners.get(path)
+        if ctxt is None:
+            # A blob stays an orphan as long as nothing links to it
+            try:
+                if os.stat(path).st_nlink > 1:
+                    return False
+            except OSError:
+                return False
+            return self._remove(path)
+
+        name = os.path.basename(path)
+        with ctxt.transaction():
+            held = name in ctxt.descriptor['files']
+        with ctxt._entryLock(name) if held else contextlib.nullcontext(), ctxt.transaction():
+            files, known = self._known(ctxt)
+            if not os.path.isfile(path) or self._classify(name, path, files, known) != 'orphan':
+                self.store.logger.info("V: " + path + " is no longer an orphan, keeping it")
+                return False
+            return self._remove(path)
+
+    def _remove(self, path: str) -> bool:
+        self.store.logger.info("V: Removing orphan " + path)
+        try:
+            os.remove(path)
+        except OSError as err:
+            self.store.logger.error("V: Failed to remove " + path + ", " + str(err))
+            return False
+        return True
+
+    def _orphanBlobs(self) -> list:
+        '''
+        Return the blobs no context file links to
+        '''
+        orphans = []
+        root = self.store.blobs.path
+        if not root.is_dir():
+            return orphans
+        for directory in root.iterdir():
+            if not directory.is_dir():
+                continue
+            for blob in directory.iterdir():
+                try:
+                    if blob.stat().st_nlink <= 1:
+                        orphans.append(str(blob))
+                except OSError:
+                    pass
+        return orphans
+
+def owners(name: str) -> list:
+    '''
+    Return the names of the files a transient file may be kept for
+    '''
+    transient = False
+    for suffix in TRANSIENT:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            transient = True
+            break
+    # Hedged retrievals stream into numbered files of their own
+    hedge = HEDGE.fullmatch(name)
+    if hedge is not None:
+        name = hedge.group(1)
+    elif not transient:
+        return []
+    return [name] + [name[:-len(codec.suffix)] for codec in CODECS.values() if name.endswith(codec.suffix)]